@@ -0,0 +1,358 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Micro benchmarks for the pypureomapi protocol codec.
+
+Every benchmark runs a single codec operation in isolation and reports
+operations per second and the peak number of bytes allocated by one
+operation. Results can be written as JSON and compared against a stored
+baseline, in which case the exit code is nonzero if any benchmark became
+slower or allocates more than the given threshold allows.
+
+Byte allocation figures require the tracemalloc module (Python 3.4 or
+the pytracemalloc backport). Without it they are reported as None and
+not compared. The peak number of objects tracked by the garbage
+collector during one operation is measured on every version, so
+allocation regressions also fail the comparison on Python 2.
+
+Usage:
+	benchmark.py [--save results.json] [--compare baseline.json]
+			[--threshold 0.2] [--mintime 0.2] [--filter substring]
+			[--capture capture]
+
+A capture written by pypureomapi_capture.OmapiRecorder adds benchmarks
+parsing its real traffic, once with the recorded segmentation and once
+fed bytewise. Signatures are not checked there, since the verify
+benchmarks cover them.
+"""
+
+import sys
+import gc
+import json
+import struct
+import optparse
+import timeit
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+import pypureomapi
+import pypureomapi_capture
+
+KEY = "c2VjcmV0a2V5c2VjcmV0a2V5" # base64 of a dummy key
+
+def sample_message():
+	"""A typical host lookup response.
+	@rtype: pypureomapi.OmapiMessage
+	"""
+	msg = pypureomapi.OmapiMessage.open("host")
+	msg.handle = 23
+	msg.rid = 42
+	msg.obj.append(("name", "host-0001"))
+	msg.obj.append(("hardware-address",
+			pypureomapi.pack_mac("00:11:22:33:44:55")))
+	msg.obj.append(("hardware-type", struct.pack("!I", 1)))
+	msg.obj.append(("ip-address", pypureomapi.pack_ip("10.0.0.1")))
+	return msg
+
+def large_message():
+	"""A response carrying a large lease object.
+	@rtype: pypureomapi.OmapiMessage
+	"""
+	msg = sample_message()
+	for index in range(200):
+		msg.obj.append(("attribute-%d" % index, "x" * (index % 64)))
+	return msg
+
+def authenticator(algorithm="hmac-md5.SIG-ALG.REG.INT."):
+	"""
+	@type algorithm: str
+	@rtype: pypureomapi.OmapiHMACAuthenticator
+	"""
+	auth = pypureomapi.OmapiHMACAuthenticator("benchmark", KEY, algorithm)
+	auth.authid = 1
+	return auth
+
+def wire(msg):
+	"""
+	@type msg: pypureomapi.OmapiMessage
+	@rtype: str
+	@returns: the message signed and encoded
+	"""
+	return msg.sign(authenticator())
+
+def parse_whole(data):
+	buff = pypureomapi.InBuffer()
+	buff.feed(data)
+	return buff.parse_message()
+
+def parse_bytewise(data):
+	buff = pypureomapi.InBuffer()
+	for char in data:
+		buff.feed(char)
+		message = buff.parse_message()
+	return message
+
+def lookup_plain(auth, packed_mac):
+	"""Build and sign a host lookup without a template.
+	@rtype: str
+	"""
+	msg = pypureomapi.OmapiMessage.open("host")
+	msg.obj.append(("hardware-address", packed_mac))
+	return msg.sign(auth)
+
+def lookup_template(auth, packed_mac):
+	"""Build and sign a host lookup from its template.
+	@rtype: str
+	"""
+	return pypureomapi.host_by_mac_template.build([packed_mac]).sign(auth)
+
+def capture_benchmarks(path):
+	"""
+	@type path: str
+	@param path: a capture file
+	@rtype: [(str, () -> obj)]
+	"""
+	with open(path, "rb") as capture:
+		records = list(pypureomapi_capture.read_capture(capture))
+	bytewise = list(pypureomapi_capture.rechunk(records, 1))
+	directions = (pypureomapi_capture.kind_sent,
+			pypureomapi_capture.kind_received)
+	return [
+		("replay capture",
+			lambda: pypureomapi_capture.replay(records, None, directions)),
+		("replay capture bytewise",
+			lambda: pypureomapi_capture.replay(bytewise, None, directions)),
+	]
+
+def benchmarks():
+	"""
+	@rtype: [(str, () -> obj)]
+	@returns: named zero argument functions, each performing one operation
+	"""
+	msg = sample_message()
+	large = large_message()
+	auth = authenticator()
+	auth_sha256 = authenticator("hmac-sha256")
+	authenticators = {0: pypureomapi.OmapiNullAuthenticator(), 1: auth}
+	data = wire(sample_message())
+	large_data = wire(large_message())
+	ips = ["10.%d.%d.%d" % (n >> 16, n >> 8 & 255, n & 255)
+			for n in range(1000)]
+	packed_ips = "".join(pypureomapi.pack_ips(ips))
+	macs = ["00:11:22:%02x:%02x:%02x" % (n >> 16, n >> 8 & 255, n & 255)
+			for n in range(1000)]
+	packed_macs = "".join(pypureomapi.pack_macs(macs))
+	mac = pypureomapi.MacAddress("00:11:22:33:44:55")
+	ip = pypureomapi.IPv4Address("192.168.100.200")
+	signed = parse_whole(data)
+	signed_large = parse_whole(large_data)
+	return [
+		("OutBuffer.add_bindict",
+			lambda: pypureomapi.OutBuffer().add_bindict(msg.obj)),
+		("OutBuffer.add_bindict large",
+			lambda: pypureomapi.OutBuffer().add_bindict(large.obj)),
+		("OmapiMessage.as_string", msg.as_string),
+		("OmapiMessage.as_string large", large.as_string),
+		("OmapiMessage.sign", lambda: msg.sign(auth)),
+		("OmapiMessage.sign large", lambda: large.sign(auth)),
+		("OmapiMessage.sign hmac-sha256", lambda: msg.sign(auth_sha256)),
+		("OmapiMessage.verify", lambda: signed.verify(authenticators)),
+		("OmapiMessage.verify large",
+			lambda: signed_large.verify(authenticators)),
+		("InBuffer.parse_message", lambda: parse_whole(data)),
+		("InBuffer.parse_message large", lambda: parse_whole(large_data)),
+		("InBuffer.parse_message bytewise", lambda: parse_bytewise(data)),
+		("InBuffer.parse_message bytewise large",
+			lambda: parse_bytewise(large_data)),
+		("pack_mac", lambda: pypureomapi.pack_mac("00:11:22:33:44:55")),
+		("pack_ip", lambda: pypureomapi.pack_ip("192.168.100.200")),
+		("unpack_mac", lambda: pypureomapi.unpack_mac("\x00\x11\x22\x33\x44\x55")),
+		("unpack_ip", lambda: pypureomapi.unpack_ip("\xc0\xa8\x64\xc8")),
+		("pack_ips 1000", lambda: pypureomapi.pack_ips(ips)),
+		("unpack_ips 1000", lambda: pypureomapi.unpack_ips(packed_ips)),
+		("pack_macs 1000", lambda: pypureomapi.pack_macs(macs)),
+		("unpack_macs 1000", lambda: pypureomapi.unpack_macs(packed_macs)),
+		("lookup message plain", lambda: lookup_plain(auth, mac.packed)),
+		("lookup message template",
+			lambda: lookup_template(auth, mac.packed)),
+		("create_host_message", lambda: pypureomapi.create_host_message(
+			mac.packed, ip.packed).sign(auth)),
+		("MacAddress.packed", lambda: mac.packed),
+		("IPv4Address.packed", lambda: ip.packed),
+	]
+
+def measure_speed(func, mintime):
+	"""
+	@type func: () -> obj
+	@type mintime: float
+	@param mintime: minimum duration of one timing run in seconds
+	@rtype: float
+	@returns: operations per second of the best of three runs
+	"""
+	timer = timeit.Timer(func)
+	number = 1
+	while True:
+		duration = timer.timeit(number)
+		if duration >= mintime:
+			break
+		number *= 2 if duration <= 0 else \
+				max(2, min(10, int(mintime / duration) + 1))
+	best = min([duration] + timer.repeat(2, number))
+	return number / best if best > 0 else float("inf")
+
+def measure_allocation(func):
+	"""
+	@type func: () -> obj
+	@rtype: int or None
+	@returns: peak bytes allocated while running func once or None if
+			tracemalloc is unavailable
+	"""
+	if tracemalloc is None:
+		return None
+	func() # warm up caches
+	tracemalloc.start()
+	try:
+		before = tracemalloc.get_traced_memory()[0]
+		func()
+		peak = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	return peak - before
+
+def peak_objects(func):
+	"""
+	@type func: () -> obj
+	@rtype: int
+	@returns: peak number of objects tracked by the garbage collector that
+			were created while running func once and were alive at the same
+			time, sampled at every function call and return
+	"""
+	func() # warm up caches
+	peak = [0]
+	def sample(frame, event, arg):
+		peak[0] = max(peak[0], gc.get_count()[0])
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		gc.collect() # resets the count of the youngest generation
+		sys.setprofile(sample)
+		try:
+			func()
+		finally:
+			sys.setprofile(None)
+	finally:
+		if enabled:
+			gc.enable()
+	return peak[0]
+
+def count_objects(func):
+	"""
+	@type func: () -> obj
+	@rtype: int
+	@returns: peak_objects of func without the objects of the sampling
+			itself
+	"""
+	return max(0, peak_objects(func) - peak_objects(lambda: None))
+
+def run(mintime, pattern=None, capture=None):
+	"""
+	@type mintime: float
+	@type pattern: str or None
+	@param pattern: only run benchmarks whose name contains pattern
+	@type capture: str or None
+	@param capture: a capture file to add the replay benchmarks for
+	@rtype: {str: {str: float or int or None}}
+	@returns: ops_per_sec, alloc_bytes and alloc_objects for each
+			benchmark name
+	"""
+	results = {}
+	cases = benchmarks()
+	if capture:
+		cases.extend(capture_benchmarks(capture))
+	for name, func in cases:
+		if pattern and pattern not in name:
+			continue
+		results[name] = dict(ops_per_sec=measure_speed(func, mintime),
+				alloc_bytes=measure_allocation(func),
+				alloc_objects=count_objects(func))
+	return results
+
+def compare(results, baseline, threshold):
+	"""
+	@type results: {str: {str: float or int or None}}
+	@type baseline: {str: {str: float or int or None}}
+	@type threshold: float
+	@param threshold: tolerated relative regression, e.g. 0.2 for 20%
+	@rtype: [str]
+	@returns: descriptions of the regressions found
+	"""
+	regressions = []
+	for name in sorted(results):
+		if name not in baseline:
+			continue
+		current, previous = results[name], baseline[name]
+		if current["ops_per_sec"] < \
+				previous["ops_per_sec"] * (1 - threshold):
+			regressions.append("%s: %.0f ops/s, baseline %.0f ops/s" %
+					(name, current["ops_per_sec"], previous["ops_per_sec"]))
+		if current.get("alloc_bytes") is not None and \
+				previous.get("alloc_bytes") is not None and \
+				current["alloc_bytes"] > \
+				previous["alloc_bytes"] * (1 + threshold):
+			regressions.append("%s: %d bytes/op, baseline %d bytes/op" %
+					(name, current["alloc_bytes"], previous["alloc_bytes"]))
+		if current.get("alloc_objects") is not None and \
+				previous.get("alloc_objects") is not None and \
+				current["alloc_objects"] > \
+				max(previous["alloc_objects"] * (1 + threshold),
+					previous["alloc_objects"] + 1):
+			regressions.append("%s: %d objects/op, baseline %d objects/op" %
+					(name, current["alloc_objects"],
+					previous["alloc_objects"]))
+	return regressions
+
+def report(results, out=sys.stdout):
+	for name in sorted(results):
+		alloc = results[name]["alloc_bytes"]
+		out.write("%-40s %14.0f ops/s %12s bytes/op %6d objects/op\n" % (
+				name, results[name]["ops_per_sec"],
+				"-" if alloc is None else alloc,
+				results[name]["alloc_objects"]))
+
+def main(argv):
+	parser = optparse.OptionParser(usage="%prog [options]")
+	parser.add_option("--save", metavar="FILE",
+			help="write the results as JSON to FILE")
+	parser.add_option("--compare", metavar="FILE",
+			help="compare the results against the JSON baseline in FILE")
+	parser.add_option("--threshold", type="float", default=0.2,
+			help="tolerated relative regression [default: %default]")
+	parser.add_option("--mintime", type="float", default=0.2,
+			help="minimum seconds per timing run [default: %default]")
+	parser.add_option("--filter", metavar="SUBSTRING",
+			help="only run benchmarks whose name contains SUBSTRING")
+	parser.add_option("--capture", metavar="FILE",
+			help="also benchmark replaying the traffic captured in FILE")
+	options, args = parser.parse_args(argv)
+	if args:
+		parser.error("no positional arguments expected")
+	results = run(options.mintime, options.filter, options.capture)
+	report(results)
+	if options.save:
+		with open(options.save, "w") as output:
+			json.dump(results, output, indent=1, sort_keys=True)
+	if options.compare:
+		with open(options.compare) as baseline:
+			regressions = compare(results, json.load(baseline),
+					options.threshold)
+		for regression in regressions:
+			sys.stderr.write("regression: %s\n" % regression)
+		if regressions:
+			return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
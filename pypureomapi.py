@@ -28,16 +28,45 @@ __email__       = "info@cygnusnetworks.de"
 __all__ = []
 
 import struct
+import errno
+import binascii
 import hmac
+import hashlib
 import socket
 import random
-import operator
-try:
-	from cStringIO import StringIO
+import os
+import time
+import select
+import threading
+import contextlib
+import functools
+import bisect
+import itertools
+import collections
+try: # the asyncio backport for Python 2, required by AsyncOmapi
+	import trollius as asyncio
+	from trollius import From, Return
+	coroutine = asyncio.coroutine
 except ImportError:
-	import StringIO
+	asyncio = None
+	coroutine = lambda function: function # AsyncOmapi refuses to start
 
 sysrand = random.SystemRandom()
+# Transmission ids are drawn from os.urandom in batches, one system call
+# per tid_batch.size // 4 messages.
+tid_batch = struct.Struct("!256L")
+random_tids = []
+
+net16int = struct.Struct("!H")
+net32int = struct.Struct("!L")
+startup_header = struct.Struct("!LL") # version, headersize
+message_header = struct.Struct("!LLLLLL") # authid, authlen, opcode, handle,
+                                          # tid, rid
+signed_header = struct.Struct("!LLLLL") # message_header without authid
+ip_struct = struct.Struct("!4B")
+mac_struct = struct.Struct("!6B")
+mac_int_struct = struct.Struct("!HL")
+mac_digits_format = "%s%s:%s%s:%s%s:%s%s:%s%s:%s%s"
 
 OMAPI_OP_OPEN    = 1
 OMAPI_OP_REFRESH = 2
@@ -46,6 +75,9 @@ OMAPI_OP_NOTIFY  = 4
 OMAPI_OP_STATUS  = 5
 OMAPI_OP_DELETE  = 6
 
+ISC_R_SUCCESS  = 0
+ISC_R_NOTFOUND = 23
+
 def repr_opcode(opcode):
 	"""
 	@type opcode: int
@@ -65,17 +97,45 @@ class OmapiSizeLimitError(OmapiError):
 	def __init__(self):
 		OmapiError.__init__(self, "Packet size limit reached.")
 
+__all__.append("OmapiTimeoutError")
+class OmapiTimeoutError(OmapiError):
+	"""Deadline exceeded."""
+	def __init__(self):
+		OmapiError.__init__(self, "deadline exceeded")
+
 __all__.append("OmapiErrorNotFound")
 class OmapiErrorNotFound(OmapiError):
 	"""Not found."""
 	def __init__(self):
 		OmapiError.__init__(self, "not found")
 
+def encode_bindict(items):
+	"""Encode a dictionary in a single join.
+
+	>>> encode_bindict([("foo", "bar")])
+	'\\x00\\x03foo\\x00\\x00\\x00\\x03bar\\x00\\x00'
+
+	@type items: [(str, str)] or {str: str}
+	@rtype: str
+	@raises ValueError: for keys or values that are too long
+	"""
+	if not isinstance(items, list):
+		items = items.items()
+	parts = []
+	for key, value in items:
+		if len(key) >= (1 << 16) or len(value) >= (1 << 32):
+			raise ValueError("string too long")
+		parts.extend((net16int.pack(len(key)), key,
+				net32int.pack(len(value)), value))
+	parts.append("\x00\x00") # end marker
+	return "".join(parts)
+
 class OutBuffer:
 	"""Helper class for constructing network packets."""
 	sizelimit = 65536
 	def __init__(self):
-		self.buff = StringIO()
+		self.buff = collections.deque()
+		self.size = 0
 
 	def add(self, data):
 		"""
@@ -83,8 +143,9 @@ class OutBuffer:
 		@returns: self
 		@raises OmapiSizeLimitError:
 		"""
-		self.buff.write(data)
-		if self.buff.tell() > self.sizelimit:
+		self.buff.append(data)
+		self.size += len(data)
+		if self.size > self.sizelimit:
 			raise OmapiSizeLimitError()
 		return self
 
@@ -97,7 +158,7 @@ class OutBuffer:
 		"""
 		if integer < 0 or integer >= (1 << 32):
 			raise ValueError("not a 32bit unsigned integer")
-		return self.add(struct.pack("!L", integer))
+		return self.add(net32int.pack(integer))
 
 	def add_net16int(self, integer):
 		"""
@@ -108,7 +169,7 @@ class OutBuffer:
 		"""
 		if integer < 0 or integer >= (1 << 16):
 			raise ValueError("not a 16bit unsigned integer")
-		return self.add(struct.pack("!H", integer))
+		return self.add(net16int.pack(integer))
 
 	def add_net32string(self, string):
 		"""
@@ -141,24 +202,34 @@ class OutBuffer:
 		@returns: self
 		@raises OmapiSizeLimitError:
 		"""
-		if not isinstance(items, list):
-			items = items.items()
-		for key, value in items:
-			self.add_net16string(key).add_net32string(value)
-		return self.add("\x00\x00") # end marker
+		return self.add(encode_bindict(items))
 
 	def getvalue(self):
 		"""
 		@rtype: str
 		"""
-		return self.buff.getvalue()
+		if len(self.buff) > 1:
+			value = "".join(self.buff)
+			self.buff.clear()
+			self.buff.append(value)
+		return self.buff[0] if self.buff else ""
 
 	def consume(self, length):
-		"""
+		"""Drop length bytes from the front. Only a partially consumed
+		chunk is copied.
 		@type length: int
 		@returns: self
 		"""
-		self.buff = StringIO(self.getvalue()[length:])
+		while length > 0 and self.buff:
+			chunk = self.buff[0]
+			if len(chunk) <= length:
+				self.buff.popleft()
+				self.size -= len(chunk)
+				length -= len(chunk)
+			else:
+				self.buff[0] = chunk[length:]
+				self.size -= length
+				length = 0
 		return self
 
 class OmapiAuthenticatorBase:
@@ -192,25 +263,80 @@ class OmapiNullAuthenticator(OmapiAuthenticatorBase):
 	def sign(self, _):
 		return ""
 
-class OmapiHMACMD5Authenticator(OmapiAuthenticatorBase):
-	authlen = 16
-	algorithm = "hmac-md5.SIG-ALG.REG.INT."
-	def __init__(self, user, key):
+# Signature algorithms usable for OmapiHMACAuthenticator by their OMAPI
+# names. Further hashlib compatible constructors may be added.
+hmac_algorithms = {
+	"hmac-md5.SIG-ALG.REG.INT.": hashlib.md5,
+	"hmac-sha1": hashlib.sha1,
+	"hmac-sha224": hashlib.sha224,
+	"hmac-sha256": hashlib.sha256,
+	"hmac-sha384": hashlib.sha384,
+	"hmac-sha512": hashlib.sha512,
+}
+
+hmac_inner_pad = "".join(chr(x ^ 0x36) for x in range(256))
+hmac_outer_pad = "".join(chr(x ^ 0x5C) for x in range(256))
+
+class OmapiHMACAuthenticator(OmapiAuthenticatorBase):
+	"""HMAC authenticator for any algorithm in hmac_algorithms. The key
+	dependent inner and outer hash states are computed once and copied
+	for every message.
+
+	>>> auth = OmapiHMACAuthenticator("user", "a2V5", "hmac-sha256")
+	>>> auth.authlen
+	32
+	>>> auth.sign("message") == hmac.new("key", "message",
+	...     hashlib.sha256).digest()
+	True
+	"""
+	def __init__(self, user, key, algorithm="hmac-md5.SIG-ALG.REG.INT."):
 		"""
 		@type user: str
 		@type key: str
 		@param key: base64 encoded key
+		@type algorithm: str
 		@raises binascii.Error: for bad base64 encoding
+		@raises ValueError: for unknown algorithms
 		"""
 		OmapiAuthenticatorBase.__init__(self)
+		try:
+			digestmod = hmac_algorithms[algorithm]
+		except KeyError:
+			raise ValueError("unknown signature algorithm %r" % algorithm)
 		self.user = user
+		self.algorithm = algorithm
 		self.key = key.decode("base64")
+		self.inner = digestmod()
+		self.outer = digestmod()
+		self.authlen = self.inner.digest_size
+		padded = self.key
+		if len(padded) > self.inner.block_size:
+			padded = digestmod(padded).digest()
+		padded = padded.ljust(self.inner.block_size, "\0")
+		self.inner.update(padded.translate(hmac_inner_pad))
+		self.outer.update(padded.translate(hmac_outer_pad))
 
 	def auth_object(self):
 		return dict(name=self.user, algorithm=self.algorithm)
 
 	def sign(self, message):
-		return hmac.HMAC(self.key, message).digest()
+		inner = self.inner.copy()
+		inner.update(message)
+		outer = self.outer.copy()
+		outer.update(inner.digest())
+		return outer.digest()
+
+class OmapiHMACMD5Authenticator(OmapiHMACAuthenticator):
+	authlen = 16
+	algorithm = "hmac-md5.SIG-ALG.REG.INT."
+	def __init__(self, user, key):
+		"""
+		@type user: str
+		@type key: str
+		@param key: base64 encoded key
+		@raises binascii.Error: for bad base64 encoding
+		"""
+		OmapiHMACAuthenticator.__init__(self, user, key, self.algorithm)
 
 class OmapiMessage:
 	def __init__(self):
@@ -222,57 +348,113 @@ class OmapiMessage:
 		self.message = []
 		self.obj = []
 		self.signature = ""
+		self.signed_data = None # received signed part, see verify
+		# connection generation of the handle addressed, see
+		# Omapi.check_generation
+		self.generation = None
+		# encoding of message and obj, see OmapiMessageTemplate
+		self.encoded_dicts = None
 
 	def generate_tid(self):
 		"""Generate a random transmission id for this OMAPI message."""
-		self.tid = sysrand.randrange(0, 1<<32)
+		while True:
+			try:
+				self.tid = random_tids.pop()
+				return
+			except IndexError: # list.pop is atomic, extend may race
+				random_tids.extend(tid_batch.unpack(
+						os.urandom(tid_batch.size)))
+
+	def encode_signed_part(self, authlen):
+		"""Encode everything but the authid and the signature.
+		@type authlen: int
+		@rtype: str
+		@raises ValueError: for fields not fitting into their wire types
+		"""
+		try:
+			header = signed_header.pack(authlen, self.opcode, self.handle,
+					self.tid, self.rid)
+		except struct.error:
+			raise ValueError("not a 32bit unsigned integer")
+		if self.encoded_dicts is not None:
+			return header + self.encoded_dicts
+		return "".join((header, encode_bindict(self.message),
+				encode_bindict(self.obj)))
+
+	def encode_wire(self, body, sizelimit=None):
+		"""Frame an encoded signed part with authid and signature.
+		@type body: str
+		@type sizelimit: int or None
+		@param sizelimit: defaults to OutBuffer.sizelimit
+		@rtype: str
+		@raises OmapiSizeLimitError:
+		"""
+		try:
+			data = "".join((net32int.pack(self.authid), body, self.signature))
+		except struct.error:
+			raise ValueError("not a 32bit unsigned integer")
+		if len(data) > (sizelimit or OutBuffer.sizelimit):
+			raise OmapiSizeLimitError()
+		return data
 
-	def as_string(self, forsigning=False):
+	def as_string(self, forsigning=False, sizelimit=None):
 		"""
 		@type forsigning: bool
+		@type sizelimit: int or None
+		@param sizelimit: defaults to OutBuffer.sizelimit
 		@rtype: str
 		@raises OmapiSizeLimitError:
 		"""
-		ret = OutBuffer()
-		if not forsigning:
-			ret.add_net32int(self.authid)
-		ret.add_net32int(len(self.signature))
-		ret.add_net32int(self.opcode)
-		ret.add_net32int(self.handle)
-		ret.add_net32int(self.tid)
-		ret.add_net32int(self.rid)
-		ret.add_bindict(self.message)
-		ret.add_bindict(self.obj)
-		if not forsigning:
-			ret.add(self.signature)
-		return ret.getvalue()
-
-	def sign(self, authenticator):
-		"""Sign this OMAPI message.
+		body = self.encode_signed_part(len(self.signature))
+		if forsigning:
+			if len(body) > (sizelimit or OutBuffer.sizelimit):
+				raise OmapiSizeLimitError()
+			return body
+		return self.encode_wire(body, sizelimit)
+
+	def sign(self, authenticator, sizelimit=None):
+		"""Sign this OMAPI message. The message is encoded once, the
+		encoding is used for both signing and sending.
 		@type authenticator: OmapiAuthenticatorBase
+		@type sizelimit: int or None
+		@param sizelimit: defaults to OutBuffer.sizelimit
+		@rtype: str
+		@returns: the signed message in wire format
+		@raises OmapiSizeLimitError:
 		"""
 		self.authid = authenticator.authid
-		self.signature = "\0" * authenticator.authlen # provide authlen
-		self.signature = authenticator.sign(self.as_string(forsigning=True))
+		body = self.encode_signed_part(authenticator.authlen)
+		self.signature = authenticator.sign(body)
 		assert len(self.signature) == authenticator.authlen
+		return self.encode_wire(body, sizelimit)
 
 	@classmethod
 	def from_fields(cls, authid, opcode, handle, tid, rid, message, obj,
-			signature):
+			signature, signed_data=None):
+		"""
+		@type signed_data: str or None
+		@param signed_data: the received bytes covered by the signature
+		@rtype: OmapiMessage
+		"""
 		self = cls()
 		self.authid, self.opcode = authid, opcode
 		self.handle, self.tid, self.rid = handle, tid, rid
 		self.message, self.obj, self.signature = message, obj, signature
+		self.signed_data = signed_data
 		return self
 
 	def verify(self, authenticators):
-		"""Verify this OMAPI message.
+		"""Verify this OMAPI message. Received messages are verified
+		against the bytes they were parsed from, other messages are
+		encoded for verification.
 		@type authenticators: {int: OmapiAuthenticatorBase}
 		@rtype: bool
 		"""
+		signed_data = self.signed_data
+		if signed_data is None:
+			signed_data = self.as_string(forsigning=True)
 		try:
-			return authenticators[self.authid]. \
-					sign(self.as_string(forsigning=True)) == \
+			return authenticators[self.authid].sign(signed_data) == \
 					self.signature
 		except KeyError:
 			return False
@@ -313,6 +495,44 @@ class OmapiMessage:
 		self.generate_tid()
 		return self
 
+	@classmethod
+	def refresh(cls, handle):
+		"""Create an OMAPI refresh message for given handle.
+		@type handle: int
+		@rtype: OmapiMessage
+		"""
+		self = cls()
+		self.opcode = OMAPI_OP_REFRESH
+		self.handle = handle
+		self.generate_tid()
+		return self
+
+	def result(self):
+		"""
+		@rtype: int
+		@returns: the result code of a status message or ISC_R_SUCCESS if
+				it carries none
+		"""
+		for key, value in self.message:
+			if key == "result" and len(value) == 4:
+				return net32int.unpack(value)[0]
+		return ISC_R_SUCCESS
+
+	def is_stale(self):
+		"""Check whether this OMAPI message reports that the handle of the
+		message it responds to does not name an object.
+		@rtype: bool
+		"""
+		return self.opcode == OMAPI_OP_STATUS and \
+				self.result() == ISC_R_NOTFOUND
+
+	def object_view(self):
+		"""
+		@rtype: OmapiObject
+		@returns: a lazily decoding view on the object of this message
+		"""
+		return OmapiObject(self.obj)
+
 	def is_response(self, other):
 		"""Check whether this OMAPI message is a response to the given
 		OMAPI message.
@@ -327,6 +547,7 @@ class OmapiMessage:
 		self.obj = [(key, value) for key, value in self.obj
 					if key not in update]
 		self.obj.extend(update.items())
+		self.encoded_dicts = None
 
 	def dump(self):
 		print "Omapi message attributes:"
@@ -340,126 +561,298 @@ class OmapiMessage:
 		print "obj:\t\t%r" % self.obj
 		print "signature:\t%r" % self.signature
 
-def parse_map(filterfun, parser):
-	"""
-	@type filterfun: obj -> obj
-	@param parser: parser
-	@returns: parser
-	"""
-	for element in parser:
-		if element is None:
-			yield None
-		else:
-			yield filterfun(element)
-			break
+__all__.append("OmapiMessageTemplate")
+class OmapiMessageTemplate:
+	"""Messages of a fixed shape whose constant parts are encoded once.
+	Building a message only encodes the values of the variable object
+	attributes, signing it only the header and the signature. Messages
+	built from a template must not have their message or obj lists
+	modified other than by update_object.
 
-def parse_chain(*args):
+	>>> template = OmapiMessageTemplate(OMAPI_OP_OPEN, [("type", "host")],
+	...     [("hardware-address", None), ("hardware-type", "\\0\\0\\0\\1")])
+	>>> msg = template.build(["\\0\\1\\2\\3\\4\\5"])
+	>>> plain = OmapiMessage.open("host")
+	>>> plain.obj, plain.tid = list(msg.obj), msg.tid
+	>>> msg.as_string() == plain.as_string()
+	True
 	"""
-	@param args: parsers
-	@returns: parser
-	"""
-	items = []
-	for parser in args:
-		for element in parser(*items):
-			if element is None:
-				yield None
+	def __init__(self, opcode, message, obj):
+		"""
+		@type opcode: int
+		@type message: [(str, str)]
+		@type obj: [(str, str or None)]
+		@param obj: object attributes, those with value None are variable
+				and their values passed to build
+		@raises ValueError: for keys or values that are too long
+		"""
+		self.opcode = opcode
+		self.message = list(message)
+		self.obj = list(obj)
+		self.slots = [] # indices of the variable attributes in obj
+		fragments = [] # encoding between the variable values
+		parts = [encode_bindict(self.message)]
+		for index, (key, value) in enumerate(self.obj):
+			if value is None:
+				# key with its length, without the value and end marker
+				parts.append(encode_bindict([(key, "")])[:-6])
+				fragments.append("".join(parts))
+				self.slots.append(index)
+				parts = []
 			else:
-				items.append(element)
-				break
-	yield tuple(items)
+				parts.append(encode_bindict([(key, value)])[:-2])
+		parts.append("\0\0") # end marker
+		fragments.append("".join(parts))
+		self.head, self.tails = fragments[0], fragments[1:]
+
+	def build(self, values, handle=0):
+		"""
+		@type values: [str]
+		@param values: the values of the variable object attributes in
+				their order
+		@type handle: int
+		@rtype: OmapiMessage
+		@returns: a new message with a random tid
+		@raises ValueError: for the wrong number of values
+		"""
+		if len(values) != len(self.slots):
+			raise ValueError("expected %d values" % len(self.slots))
+		msg = OmapiMessage()
+		msg.opcode = self.opcode
+		msg.handle = handle
+		msg.message = self.message[:]
+		msg.obj = obj = self.obj[:]
+		parts = [self.head]
+		for index, value, tail in zip(self.slots, values, self.tails):
+			obj[index] = (obj[index][0], value)
+			parts += (net32int.pack(len(value)), value, tail)
+		msg.encoded_dicts = "".join(parts)
+		msg.generate_tid()
+		return msg
 
 class InBuffer:
+	"""Incremental decoder for OMAPI messages. Received data is appended
+	to a bytearray and decoded in place by advancing a read offset.
+	Consumed data is only dropped between messages. The parse methods
+	return None if more data is needed and can simply be retried after
+	feeding more data.
+	"""
 	sizelimit = 65536
-	def __init__(self):
-		self.buff = ""
+	def __init__(self, sizelimit=None):
+		"""
+		@type sizelimit: int or None
+		@param sizelimit: maximum number of bytes to buffer for a single
+				message, defaults to InBuffer.sizelimit
+		"""
+		if sizelimit is not None:
+			self.sizelimit = sizelimit
+		self.buff = bytearray()
+		self.readbuffer = bytearray() # see feed_from
+		self.offset = 0 # start of the unparsed data in buff
+		self.needed = 0 # unparsed bytes needed for the next parse to succeed
+		self.partial = None # [header, message, object, position relative
+		                    #  to offset, number of completed parts]
 		self.totalsize = 0
-		self.parsing = None
 
 	def feed(self, data):
 		"""
-		@type data: str
+		@type data: str or memoryview
 		@raises OmapiSizeLimitError:
 		"""
+		if self.offset:
+			del self.buff[:self.offset]
+			self.offset = 0
 		self.buff += data
 		self.totalsize += len(data)
 		if self.totalsize > self.sizelimit:
 			raise OmapiSizeLimitError()
 
+	def feed_from(self, recv_into, size):
+		"""Read data into a reusable buffer and feed it from there, so
+		that no string is allocated per read.
+
+		>>> buff = InBuffer()
+		>>> def recv_into(view, size):
+		...     view[:3] = "abc"
+		...     return 3
+		>>> buff.feed_from(recv_into, 2048), str(buff.buff)
+		(3, 'abc')
+
+		@type recv_into: (memoryview, int) -> int
+		@param recv_into: a function like socket.recv_into
+		@type size: int
+		@param size: maximum number of bytes to read
+		@rtype: int
+		@returns: the number of bytes read
+		@raises OmapiSizeLimitError:
+		"""
+		if len(self.readbuffer) < size:
+			self.readbuffer = bytearray(size)
+		view = memoryview(self.readbuffer)
+		count = recv_into(view, size)
+		self.feed(view[:count])
+		return count
+
+	def room(self):
+		"""
+		>>> buff = InBuffer(sizelimit=10)
+		>>> buff.feed("abcd")
+		>>> buff.room()
+		6
+
+		@rtype: int
+		@returns: how many bytes can be fed before the size limit of the
+				unparsed data is exceeded
+		"""
+		return self.sizelimit - self.totalsize
+
+	def missing(self):
+		"""
+		@rtype: int
+		@returns: how many more bytes the next parse needs at least
+		"""
+		return self.needed - (len(self.buff) - self.offset)
+
 	def resetsize(self):
 		"""This method is to be called after handling a packet to
 		reset the total size to be parsed at once and that way not
 		overflow the size limit.
 		"""
-		self.totalsize = len(self.buff)
+		self.totalsize = len(self.buff) - self.offset
 
-	def parse_fixedbuffer(self, length):
+	def need(self, pos):
+		"""Record that parsing needs the buffer to extend up to pos.
+		@type pos: int
+		@returns: None
 		"""
-		@type length: int
+		self.needed = pos - self.offset
+
+	def parse_bindict(self, view, pos, entries):
+		"""Parse dictionary entries starting at the given offset and
+		append them to entries.
+		@type view: memoryview
+		@param view: a view on self.buff
+		@type pos: int
+		@type entries: [(str, str)]
+		@rtype: (bool, int)
+		@returns: whether the end marker was reached and the offset
+				following it or following the last complete entry
 		"""
-		while len(self.buff) < length:
-			yield None
-		result = self.buff[:length]
-		self.buff = self.buff[length:]
-		yield result
+		end = len(view)
+		while True:
+			if pos + 2 > end:
+				self.need(pos + 2)
+				return False, pos
+			keylen = net16int.unpack_from(view, pos)[0]
+			if not keylen:
+				return True, pos + 2
+			valuepos = pos + 2 + keylen + 4
+			if valuepos > end:
+				self.need(valuepos)
+				return False, pos
+			valuelen = net32int.unpack_from(view, valuepos - 4)[0]
+			if valuepos + valuelen > end:
+				self.need(valuepos + valuelen)
+				return False, pos
+			entries.append((view[pos + 2:valuepos - 4].tobytes(),
+					view[valuepos:valuepos + valuelen].tobytes()))
+			pos = valuepos + valuelen
 
-	def parse_net16int(self):
-		return parse_map(lambda data: struct.unpack("!H", data)[0],
-				self.parse_fixedbuffer(2))
+	def parse_startup_message(self):
+		"""
+		>>> buff = InBuffer()
+		>>> buff.feed("\\x00\\x00\\x00\\x64\\x00\\x00")
+		>>> buff.parse_startup_message() is None
+		True
+		>>> buff.feed("\\x00\\x18")
+		>>> buff.parse_startup_message()
+		(100, 24)
 
-	def parse_net32int(self):
-		return parse_map(lambda data: struct.unpack("!L", data)[0],
-				self.parse_fixedbuffer(4))
+		@rtype: (int, int) or None
+		@returns: (version, headersize) or None if more data is needed
+		"""
+		if len(self.buff) - self.offset < startup_header.size:
+			return self.need(self.offset + startup_header.size)
+		result = startup_header.unpack_from(self.buff, self.offset)
+		self.offset += startup_header.size
+		self.needed = 0
+		return result
 
-	def parse_net16string(self):
-		return parse_map(operator.itemgetter(1),
-				parse_chain(self.parse_net16int, self.parse_fixedbuffer))
+	def parse_message(self):
+		"""Messages may be fed in arbitrary pieces.
 
-	def parse_net32string(self):
-		return parse_map(operator.itemgetter(1),
-				parse_chain(self.parse_net32int, self.parse_fixedbuffer))
+		>>> message = OmapiMessage.open("host")
+		>>> message.obj.append(("name", "a"))
+		>>> data = message.as_string()
+		>>> buff = InBuffer()
+		>>> buff.feed(data[:30])
+		>>> buff.parse_message() is None
+		True
+		>>> buff.feed(data[30:])
+		>>> parsed = buff.parse_message()
+		>>> parsed.message, parsed.obj, parsed.tid == message.tid
+		([('type', 'host')], [('name', 'a')], True)
 
-	def parse_bindict(self):
-		entries = []
-		try:
-			while True:
-				key = None
-				for key in self.parse_net16string():
-					if key is None:
-						yield None
-					elif not key:
-						raise StopIteration()
-					else:
-						break
-				assert key is not None
-				value = None
-				for value in self.parse_net32string():
-					if value is None:
-						yield None
-					else:
-						break
-				assert value is not None
-				entries.append((key, value))
-		# Abusing StopIteration here, since nothing should be throwing
-		# it at us.
-		except StopIteration:
-			yield entries
+		Even byte by byte.
 
-	def parse_startup_message(self):
-		# results in (version, headersize)
-		return parse_chain(self.parse_net32int, lambda _: self.parse_net32int())
+		>>> buff = InBuffer()
+		>>> parsed = []
+		>>> for byte in data:
+		...     buff.feed(byte)
+		...     parsed.append(buff.parse_message())
+		>>> parsed.count(None) == len(data) - 1, parsed[-1].obj
+		(True, [('name', 'a')])
 
-	def parse_message(self):
-		parser = parse_chain(self.parse_net32int, # authid
-				lambda *_: self.parse_net32int(), # authlen
-				lambda *_: self.parse_net32int(), # opcode
-				lambda *_: self.parse_net32int(), # handle
-				lambda *_: self.parse_net32int(), # tid
-				lambda *_: self.parse_net32int(), # rid
-				lambda *_: self.parse_bindict(), # message
-				lambda *_: self.parse_bindict(), # object
-				lambda *args: self.parse_fixedbuffer(args[1])) # signature
-		return parse_map(lambda args: # skip authlen in args:
-				OmapiMessage.from_fields(*(args[0:1] + args[2:])), parser)
+		Several messages in the buffer are returned one by one.
+
+		>>> other = OmapiMessage.refresh(42)
+		>>> buff = InBuffer()
+		>>> buff.feed(data + other.as_string())
+		>>> buff.parse_message().tid == message.tid
+		True
+		>>> buff.parse_message().handle, buff.parse_message()
+		(42, None)
+
+		@rtype: OmapiMessage or None
+		@returns: the next message or None if more data is needed
+		"""
+		if len(self.buff) - self.offset < self.needed:
+			return None
+		if self.partial is None:
+			if len(self.buff) - self.offset < message_header.size:
+				return self.need(self.offset + message_header.size)
+			self.partial = [message_header.unpack_from(self.buff, self.offset),
+					[], [], message_header.size, 0]
+		partial = self.partial
+		header, pos, completed = partial[0], self.offset + partial[3], partial[4]
+		authlen = header[1]
+		view = memoryview(self.buff)
+		try:
+			while completed < 2:
+				complete, pos = self.parse_bindict(view, pos,
+						partial[1 + completed])
+				if not complete:
+					break
+				completed += 1
+			else:
+				if pos + authlen <= len(view):
+					signature = view[pos:pos + authlen].tobytes()
+					# everything but the authid is signed
+					signed_data = view[self.offset + 4:pos].tobytes()
+					completed += 1
+				else:
+					self.need(pos + authlen)
+		finally:
+			del view # release the buffer export, so buff can be resized
+		if completed < 3:
+			partial[3], partial[4] = pos - self.offset, completed
+			return None
+		self.partial = None
+		self.offset = pos + authlen
+		self.needed = 0
+		authid, _, opcode, handle, tid, rid = header
+		return OmapiMessage.from_fields(authid, opcode, handle, tid, rid,
+				partial[1], partial[2], signature, signed_data)
 
 def pack_ip(ipstr):
 	"""Converts an ip address given in dotted notation to a four byte
@@ -477,13 +870,23 @@ def pack_ip(ipstr):
 	@raises ValueError: for badly formatted ip addresses
 	"""
 	if not isinstance(ipstr, basestring):
+		if isinstance(ipstr, IPv4Address):
+			return ipstr.packed
 		raise ValueError("given ip address is not a string")
+	try: # accept what inet_aton parses the same way
+		packed = socket.inet_aton(ipstr)
+		if socket.inet_ntoa(packed) == ipstr:
+			return packed
+	except (socket.error, TypeError):
+		pass
 	parts = ipstr.split('.')
 	if len(parts) != 4:
 		raise ValueError("given ip address has an invalid number of dots")
-	parts = map(int, parts) # raises ValueError
-	parts = map(chr, parts) # raises ValueError
-	return "".join(parts) # network byte order
+	try:
+		return ip_struct.pack(int(parts[0]), int(parts[1]), int(parts[2]),
+				int(parts[3])) # int raises ValueError
+	except struct.error:
+		raise ValueError("given ip address has an invalid component")
 
 def unpack_ip(fourbytes):
 	"""Converts an ip address given in a four byte string in network
@@ -504,7 +907,7 @@ def unpack_ip(fourbytes):
 		raise ValueError("given buffer is not a string")
 	if len(fourbytes) != 4:
 		raise ValueError("given buffer is not exactly four bytes long")
-	return ".".join(map(str, map(ord, fourbytes)))
+	return socket.inet_ntoa(fourbytes)
 
 def pack_mac(macstr):
 	"""Converts a mac address given in colon delimited notation to a
@@ -523,13 +926,23 @@ def pack_mac(macstr):
 	@raises ValueError: for badly formatted mac addresses
 	"""
 	if not isinstance(macstr, basestring):
+		if isinstance(macstr, MacAddress):
+			return macstr.packed
 		raise ValueError("given mac addresses is not a string")
+	if len(macstr) == 17 and macstr[2::3] == ":::::":
+		try:
+			return binascii.unhexlify(macstr.replace(":", ""))
+		except TypeError: # not hexadecimal
+			pass
 	parts = macstr.split(":")
 	if len(parts) != 6:
 		raise ValueError("given mac addresses has an invalid number of colons")
-	parts = [int(part, 16) for part in parts] # raises ValueError
-	parts = map(chr, parts) # raises ValueError
-	return "".join(parts) # network byte order
+	try:
+		return mac_struct.pack(int(parts[0], 16), int(parts[1], 16),
+				int(parts[2], 16), int(parts[3], 16), int(parts[4], 16),
+				int(parts[5], 16)) # int raises ValueError
+	except struct.error:
+		raise ValueError("given mac address has an invalid component")
 
 def unpack_mac(sixbytes):
 	"""Converts a mac address given in a six byte string in network
@@ -550,189 +963,3107 @@ def unpack_mac(sixbytes):
 		raise ValueError("given buffer is not a string")
 	if len(sixbytes) != 6:
 		raise ValueError("given buffer is not exactly six bytes long")
-	return ":".join(map("%2.2x".__mod__, map(ord, sixbytes)))
+	digits = binascii.hexlify(sixbytes)
+	return ":".join((digits[0:2], digits[2:4], digits[4:6], digits[6:8],
+			digits[8:10], digits[10:12]))
 
-__all__.append("Omapi")
-class Omapi:
-	protocol_version = 100
+def pack_ips(ipstrs):
+	"""Batch version of pack_ip.
+
+	>>> pack_ips(["10.0.0.1", IPv4Address("10.0.0.2")])
+	['\\n\\x00\\x00\\x01', '\\n\\x00\\x00\\x02']
+
+	@type ipstrs: iterable of str or IPv4Address
+	@rtype: [str]
+	@raises ValueError: for badly formatted ip addresses
+	"""
+	ipstrs = list(ipstrs)
+	try: # see pack_ip
+		packed = map(socket.inet_aton, ipstrs)
+		if map(socket.inet_ntoa, packed) == ipstrs:
+			return packed
+	except (socket.error, TypeError):
+		pass
+	return map(pack_ip, ipstrs)
+
+def unpack_ips(packed):
+	"""Batch version of unpack_ip.
+
+	>>> unpack_ips("\\n\\x00\\x00\\x01\\n\\x00\\x00\\x02")
+	['10.0.0.1', '10.0.0.2']
+
+	@type packed: [str] or str
+	@param packed: four byte strings or their concatenation
+	@rtype: [str]
+	@raises ValueError: for bad input
+	"""
+	if isinstance(packed, basestring):
+		if len(packed) % 4:
+			raise ValueError("given buffer is not a multiple of four " +
+					"bytes long")
+		packed = [packed[pos:pos + 4] for pos in xrange(0, len(packed), 4)]
+	try:
+		return map(socket.inet_ntoa, packed)
+	except (socket.error, TypeError):
+		return map(unpack_ip, packed)
 
-	def __init__(self, hostname, port, username=None, key=None, debug=False):
+def pack_macs(macstrs):
+	"""Batch version of pack_mac.
+	@type macstrs: iterable of str or MacAddress
+	@rtype: [str]
+	@raises ValueError: for badly formatted mac addresses
+	"""
+	macstrs = list(macstrs)
+	if all(isinstance(macstr, str) and len(macstr) == 17 and
+			macstr[2::3] == ":::::" for macstr in macstrs):
+		try:
+			data = binascii.unhexlify("".join(macstrs).replace(":", ""))
+			return [data[pos:pos + 6] for pos in xrange(0, len(data), 6)]
+		except TypeError: # not hexadecimal
+			pass
+	return map(pack_mac, macstrs)
+
+def unpack_macs(packed):
+	"""Batch version of unpack_mac.
+
+	>>> unpack_macs(["012345", "abcdef"])
+	['30:31:32:33:34:35', '61:62:63:64:65:66']
+
+	@type packed: [str] or str
+	@param packed: six byte strings or their concatenation
+	@rtype: [str]
+	@raises ValueError: for bad input
+	"""
+	if not isinstance(packed, basestring):
+		packed = list(packed)
+		if not all(isinstance(item, str) and len(item) == 6
+				for item in packed):
+			return map(unpack_mac, packed)
+		packed = "".join(packed)
+	elif len(packed) % 6:
+		raise ValueError("given buffer is not a multiple of six bytes long")
+	digits = iter(binascii.hexlify(packed))
+	return map(mac_digits_format.__mod__, itertools.izip(*[digits] * 12))
+
+__all__.append("MacAddress")
+class MacAddress(object):
+	"""Compact ethernet address value, usable wherever a mac address
+	string is accepted.
+
+	>>> mac = MacAddress("0:11:22:33:44:55")
+	>>> mac
+	MacAddress('00:11:22:33:44:55')
+	>>> mac == MacAddress.from_packed(pack_mac(mac)), int(mac)
+	(True, 73588229205)
+	"""
+	__slots__ = ("value",)
+
+	def __init__(self, value):
 		"""
-		@type hostname: str
-		@type port: int
-		@type username: str or None
-		@type key: str or None
-		@type debug: bool
-		@param key: if given, it must be base64 encoded
-		@raises binascii.Error: for bad base64 encoding
-		@raises socket.error:
-		@raises OmapiError:
+		@type value: int or str or MacAddress
+		@param value: the address as integer or in colon notation
+		@raises ValueError:
 		"""
-		self.hostname = hostname
-		self.port = port
-		self.authenticators = {0: OmapiNullAuthenticator()}
-		self.defauth = 0
-		self.debug = debug
+		if isinstance(value, basestring):
+			high, low = mac_int_struct.unpack(pack_mac(value))
+			value = high << 32 | low
+		elif isinstance(value, MacAddress):
+			value = value.value
+		elif not 0 <= value < 1 << 48:
+			raise ValueError("mac address out of range")
+		self.value = int(value)
 
-		newauth = None
-		if username is not None and key is not None:
-			newauth = OmapiHMACMD5Authenticator(username, key)
+	@classmethod
+	def from_packed(cls, sixbytes):
+		"""
+		@type sixbytes: str
+		@rtype: MacAddress
+		@raises ValueError:
+		"""
+		if len(sixbytes) != 6:
+			raise ValueError("given buffer is not exactly six bytes long")
+		high, low = mac_int_struct.unpack(sixbytes)
+		return cls(high << 32 | low)
 
-		self.connection = socket.socket()
-		self.inbuffer = InBuffer()
-		self.connection.connect((hostname, port))
+	@property
+	def packed(self):
+		"""The address as six bytes in network byte order."""
+		return mac_int_struct.pack(self.value >> 32, self.value & 0xffffffff)
 
-		self.send_protocol_initialization()
-		self.recv_protocol_initialization()
+	def __getstate__(self):
+		return self.value
 
-		if newauth:
-			self.initialize_authenticator(newauth)
+	def __setstate__(self, value):
+		self.value = value
 
-	def close(self):
-		"""Close the omapi connection if it is open."""
-		if self.connection:
-			self.connection.close()
-			self.connection = None
+	def __int__(self):
+		return self.value
 
-	def check_connected(self):
-		"""Raise an OmapiError unless connected.
-		@raises OmapiError:
-		"""
-		if not self.connection:
-			raise OmapiError("not connected")
+	def __str__(self):
+		return unpack_mac(self.packed)
 
-	def recv_conn(self, length):
-		self.check_connected()
-		try:
-			return self.connection.recv(length)
-		except socket.error:
-			self.close()
-			raise
+	def __repr__(self):
+		return "MacAddress(%r)" % str(self)
 
-	def send_conn(self, data):
-		self.check_connected()
-		try:
-			self.connection.sendall(data)
-		except socket.error:
-			self.close()
-			raise
+	def __hash__(self):
+		return hash(self.value)
 
-	def fill_inbuffer(self):
+	def __eq__(self, other):
+		return isinstance(other, MacAddress) and self.value == other.value
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __lt__(self, other):
+		if not isinstance(other, MacAddress):
+			return NotImplemented
+		return self.value < other.value
+
+__all__.append("IPv4Address")
+class IPv4Address(object):
+	"""Compact IPv4 address value, usable wherever an ip address string
+	is accepted.
+
+	>>> ip = IPv4Address("10.0.0.1")
+	>>> ip, int(ip), ip == IPv4Address(167772161)
+	(IPv4Address('10.0.0.1'), 167772161, True)
+	"""
+	__slots__ = ("value",)
+
+	def __init__(self, value):
 		"""
-		@raises OmapiError:
-		@raises socket.error:
+		@type value: int or str or IPv4Address
+		@param value: the address as integer or in dotted notation
+		@raises ValueError:
 		"""
-		data = self.recv_conn(2048)
-		if not data:
-			self.close()
-			raise OmapiError("connection closed")
-		try:
-			self.inbuffer.feed(data)
-		except OmapiSizeLimitError:
-			self.close()
-			raise
+		if isinstance(value, basestring):
+			value = net32int.unpack(pack_ip(value))[0]
+		elif isinstance(value, IPv4Address):
+			value = value.value
+		elif not 0 <= value < 1 << 32:
+			raise ValueError("ip address out of range")
+		self.value = int(value)
 
-	def send_protocol_initialization(self):
+	@classmethod
+	def from_packed(cls, fourbytes):
 		"""
-		@raises OmapiError:
-		@raises socket.error:
+		@type fourbytes: str
+		@rtype: IPv4Address
+		@raises ValueError:
 		"""
-		self.check_connected()
-		buff = OutBuffer()
-		buff.add_net32int(self.protocol_version)
-		buff.add_net32int(4*6) # header size
-		self.send_conn(buff.getvalue())
+		if len(fourbytes) != 4:
+			raise ValueError("given buffer is not exactly four bytes long")
+		return cls(net32int.unpack(fourbytes)[0])
 
-	def recv_protocol_initialization(self):
+	@property
+	def packed(self):
+		"""The address as four bytes in network byte order."""
+		return net32int.pack(self.value)
+
+	def __getstate__(self):
+		return self.value
+
+	def __setstate__(self, value):
+		self.value = value
+
+	def __int__(self):
+		return self.value
+
+	def __str__(self):
+		return unpack_ip(self.packed)
+
+	def __repr__(self):
+		return "IPv4Address(%r)" % str(self)
+
+	def __hash__(self):
+		return hash(self.value)
+
+	def __eq__(self, other):
+		return isinstance(other, IPv4Address) and self.value == other.value
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __lt__(self, other):
+		if not isinstance(other, IPv4Address):
+			return NotImplemented
+		return self.value < other.value
+
+def unpack_int(data):
+	"""Converts an unsigned integer of one, two or four bytes in network
+	byte order to an int.
+
+	>>> unpack_int("\\x00\\x00\\x00\\x01")
+	1
+
+	@type data: str
+	@rtype: int
+	@raises ValueError: for bad input
+	"""
+	try:
+		return int_formats[len(data)].unpack(data)[0]
+	except KeyError:
+		raise ValueError("given buffer has an invalid integer length")
+
+int_formats = {1: struct.Struct("!B"), 2: net16int, 4: net32int}
+
+# Decoders for the values of known OMAPI host and lease attributes. Times
+# are seconds since the epoch, handles and states are integers. Attributes
+# not listed here are returned as raw strings.
+attribute_decoders = {
+	"hardware-address": unpack_mac,
+	"hardware-type": unpack_int,
+	"ip-address": unpack_ip,
+	"name": str,
+	"client-hostname": str,
+	"state": unpack_int, # binding state of a lease
+	"starts": unpack_int,
+	"ends": unpack_int,
+	"tstp": unpack_int,
+	"tsfp": unpack_int,
+	"atsfp": unpack_int,
+	"cltt": unpack_int,
+	"flags": unpack_int,
+	"subnet": unpack_int,
+	"pool": unpack_int,
+	"billing-class": unpack_int,
+	"group": unpack_int,
+}
+
+__all__.append("OmapiObject")
+class OmapiObject(object):
+	"""Read-only mapping view on the (key, value) pairs of an OMAPI
+	object. Values stay in their wire format until they are read and are
+	then decoded according to attribute_decoders.
+
+	>>> obj = OmapiObject([("ip-address", "\\x0a\\x00\\x00\\x01")])
+	>>> obj["ip-address"], obj.raw("ip-address")
+	('10.0.0.1', '\\n\\x00\\x00\\x01')
+	>>> obj.items(), dict(obj)
+	([('ip-address', '10.0.0.1')], {'ip-address': '10.0.0.1'})
+	"""
+	__slots__ = ("pairs",)
+
+	def __init__(self, pairs):
 		"""
-		@raises OmapiError:
-		@raises socket.error:
+		@type pairs: [(str, str)]
 		"""
-		for result in self.inbuffer.parse_startup_message():
-			if result is None:
-				self.fill_inbuffer()
-			else:
-				self.inbuffer.resetsize()
-				protocol_version, header_size = result
-				if protocol_version != self.protocol_version:
-					self.close()
-					raise OmapiError("protocol mismatch")
-				if header_size != 4*6:
-					self.close()
-					raise OmapiError("header size mismatch")
+		self.pairs = pairs
 
-	def receive_message(self):
-		"""Read the next message from the connection.
-		@rtype: OmapiMessage
-		@raises OmapiError:
-		@raises socket.error:
+	def raw(self, key):
 		"""
-		for message in self.inbuffer.parse_message():
-			if message is None:
-				self.fill_inbuffer()
-			else:
-				self.inbuffer.resetsize()
-				if not message.verify(self.authenticators):
-					self.close()
-					raise OmapiError("bad omapi message signature")
-				return message
+		@type key: str
+		@rtype: str
+		@returns: the undecoded value of the first attribute named key
+		@raises KeyError:
+		"""
+		for name, value in self.pairs:
+			if name == key:
+				return value
+		raise KeyError(key)
 
-	def receive_response(self, message, insecure=False):
-		"""Read the response for the given message.
-		@type message: OmapiMessage
-		@type insecure: bool
-		@rtype: OmapiMessage
-		@raises OmapiError:
-		@raises socket.error:
+	def __getitem__(self, key):
 		"""
-		response = self.receive_message()
-		if self.debug:
-			print "debug recv"
-			response.dump()
+		@type key: str
+		@raises KeyError:
+		@raises ValueError: if a known attribute has a malformed value
+		"""
+		value = self.raw(key)
+		decoder = attribute_decoders.get(key)
+		if decoder is None:
+			return value
+		return decoder(value)
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def __contains__(self, key):
+		for name, _ in self.pairs:
+			if name == key:
+				return True
+		return False
+
+	def __iter__(self):
+		for name, _ in self.pairs:
+			yield name
+
+	def __len__(self):
+		return len(self.pairs)
+
+	def keys(self):
+		return [name for name, _ in self.pairs]
+
+	def values(self):
+		return [self[name] for name, _ in self.pairs]
+
+	def items(self):
+		"""
+		@rtype: [(str, obj)]
+		@returns: all attributes, decoded
+		"""
+		return list(self.iteritems())
+
+	def iteritems(self):
+		"""
+		@rtype: iterable of (str, obj)
+		@returns: all attributes, decoded
+		"""
+		for name, _ in self.pairs:
+			yield name, self[name]
+
+	def as_dict(self):
+		"""
+		@rtype: {str: obj}
+		@returns: all attributes, decoded
+		"""
+		return dict(self.iteritems())
+
+	def __repr__(self):
+		return "OmapiObject(%r)" % (self.pairs,)
+
+def object_criteria(mac=None, ip=None, name=None):
+	"""Build the object attributes identifying a host or lease.
+
+	>>> object_criteria(ip="10.0.0.1")
+	[('ip-address', '\\n\\x00\\x00\\x01')]
+
+	@type mac: str or None
+	@type ip: str or None
+	@type name: str or None
+	@rtype: [(str, str)]
+	@raises ValueError: for malformed addresses or if nothing is given
+	"""
+	criteria = []
+	if mac is not None:
+		criteria.append(("hardware-address", pack_mac(mac)))
+	if ip is not None:
+		criteria.append(("ip-address", pack_ip(ip)))
+	if name is not None:
+		criteria.append(("name", name))
+	if not criteria:
+		raise ValueError("no identifying attribute given")
+	return criteria
+
+# Templates of the messages sent by the host and lookup methods.
+create_host_template = OmapiMessageTemplate(OMAPI_OP_OPEN,
+		[("type", "host"), ("create", struct.pack("!I", 1)),
+			("exclusive", struct.pack("!I", 1))],
+		[("hardware-address", None), ("hardware-type", struct.pack("!I", 1)),
+			("ip-address", None)])
+update_ip_template = OmapiMessageTemplate(OMAPI_OP_UPDATE, [],
+		[("ip-address", None)])
+host_by_mac_template = OmapiMessageTemplate(OMAPI_OP_OPEN,
+		[("type", "host")], [("hardware-address", None)])
+host_by_ip_template = OmapiMessageTemplate(OMAPI_OP_OPEN,
+		[("type", "host")], [("ip-address", None)])
+ethernet_host_template = OmapiMessageTemplate(OMAPI_OP_OPEN,
+		[("type", "host")],
+		[("hardware-address", None), ("hardware-type", struct.pack("!I", 1))])
+
+def create_host_message(packed_mac, packed_ip):
+	"""
+	@type packed_mac: str
+	@type packed_ip: str
+	@rtype: OmapiMessage
+	@returns: an open message creating a host with an ethernet address
+	"""
+	return create_host_template.build([packed_mac, packed_ip])
+
+def update_ip_message(handle, packed_ip):
+	"""
+	@type handle: int
+	@type packed_ip: str
+	@rtype: OmapiMessage
+	@returns: an update message setting the ip-address of an object
+	"""
+	return update_ip_template.build([packed_ip], handle)
+
+def open_message(typename, criteria):
+	"""Create an open message for an existing object. Lookups of a fixed
+	shape use the templates above instead.
+
+	>>> open_message("host", [("name", "foo")]).obj
+	[('name', 'foo')]
+
+	@type typename: str
+	@type criteria: [(str, str)]
+	@rtype: OmapiMessage
+	"""
+	msg = OmapiMessage.open(typename)
+	msg.obj.extend(criteria)
+	return msg
+
+__all__.append("OmapiLookupCache")
+class OmapiLookupCache:
+	"""Thread-safe read-through cache for Omapi.lookup_ip and
+	Omapi.lookup_mac. It holds at most maxsize entries, evicting the
+	least recently used ones, and every entry expires after a ttl. Not
+	found results are cached as negative entries with their own ttl.
+	Keys are ("ip", packed mac) for lookup_ip and ("mac", packed ip) for
+	lookup_mac, values are the strings returned by the lookups or None
+	for negative entries.
+	"""
+	def __init__(self, maxsize=1024, ttl=60.0, negative_ttl=10.0):
+		"""
+		@type maxsize: int
+		@type ttl: float
+		@param ttl: seconds a found result stays valid
+		@type negative_ttl: float
+		@param negative_ttl: seconds a not found result stays valid, 0
+				disables negative caching
+		"""
+		if maxsize < 1:
+			raise ValueError("cache size must be positive")
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict() # key -> (expiry, value)
+		self.bymac = {} # packed mac -> set of ("mac", packed ip) keys
+		self.hits = 0
+		self.misses = 0
+
+	def remove(self, key):
+		"""Remove an entry if present. Must be called with self.lock held.
+		@type key: (str, str)
+		"""
+		entry = self.entries.pop(key, None)
+		if entry is not None and key[0] == "mac" and entry[1] is not None:
+			keys = self.bymac.get(pack_mac(entry[1]))
+			if keys is not None:
+				keys.discard(key)
+				if not keys:
+					del self.bymac[pack_mac(entry[1])]
+
+	def get(self, key):
+		"""
+		@type key: (str, str)
+		@returns: the cached value, None for a negative entry
+		@raises KeyError: if there is no valid entry
+		"""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None or entry[0] < time.time():
+				self.remove(key)
+				self.misses += 1
+				raise KeyError(key)
+			del self.entries[key] # move to the most recently used end
+			self.entries[key] = entry
+			self.hits += 1
+			return entry[1]
+
+	def put(self, key, value):
+		"""
+		@type key: (str, str)
+		@type value: str or None
+		@param value: None records a not found result
+		"""
+		ttl = self.ttl if value is not None else self.negative_ttl
+		with self.lock:
+			self.remove(key)
+			if ttl <= 0:
+				return
+			self.entries[key] = (time.time() + ttl, value)
+			if key[0] == "mac" and value is not None:
+				self.bymac.setdefault(pack_mac(value), set()).add(key)
+			while len(self.entries) > self.maxsize:
+				self.remove(next(iter(self.entries)))
+
+	def lookup(self, key, fetch, *args):
+		"""Return the cached value for key or call fetch(*args) and cache
+		its result.
+		@type key: (str, str)
+		@raises OmapiErrorNotFound: for negative entries or if fetch
+				raises it
+		"""
+		try:
+			value = self.get(key)
+		except KeyError:
+			try:
+				value = fetch(*args)
+			except OmapiErrorNotFound:
+				self.put(key, None)
+				raise
+			self.put(key, value)
+			return value
+		if value is None:
+			raise OmapiErrorNotFound()
+		return value
+
+	def invalidate_host(self, mac):
+		"""Drop all entries involving the given mac address.
+		@type mac: str
+		@raises ValueError:
+		"""
+		packed = pack_mac(mac)
+		with self.lock:
+			entry = self.entries.get(("ip", packed))
+			if entry is not None and entry[1] is not None:
+				self.remove(("mac", pack_ip(entry[1])))
+			self.remove(("ip", packed))
+			for key in list(self.bymac.get(packed, ())):
+				self.remove(key)
+
+	def set_host(self, mac, ip):
+		"""Record that the given mac address now maps to the given ip
+		address.
+		@type mac: str
+		@type ip: str
+		@raises ValueError:
+		"""
+		packed_mac, packed_ip = pack_mac(mac), pack_ip(ip)
+		self.invalidate_host(mac)
+		self.put(("ip", packed_mac), unpack_ip(packed_ip))
+		self.put(("mac", packed_ip), unpack_mac(packed_mac))
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.bymac.clear()
+
+	def stats(self):
+		"""
+		@rtype: {str: int}
+		@returns: hits, misses and current size
+		"""
+		with self.lock:
+			return dict(hits=self.hits, misses=self.misses,
+					size=len(self.entries))
+
+__all__.append("OmapiMetrics")
+class OmapiMetrics:
+	"""Thread-safe instrumentation for Omapi clients. It records request
+	counts and latency histograms per opcode, bytes sent and received,
+	time spent signing and verifying, reconnects and errors by exception
+	type. One instance may be shared by many clients. Export the data
+	with snapshot or prometheus.
+	"""
+	latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+			0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # seconds
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		"""Set all counters to zero."""
+		with self.lock:
+			# opcode name -> [count, total seconds, per bucket counts]
+			self.requests = {}
+			self.bytes_sent = 0
+			self.bytes_received = 0
+			self.sign_count = 0
+			self.sign_seconds = 0.0
+			self.verify_count = 0
+			self.verify_seconds = 0.0
+			self.reconnects = 0
+			self.errors = {} # exception class name -> count
+
+	def record_request(self, opcode, seconds):
+		"""
+		@type opcode: int
+		@param opcode: opcode of the request
+		@type seconds: float
+		"""
+		bucket = bisect.bisect_left(self.latency_buckets, seconds)
+		name = repr_opcode(opcode)
+		with self.lock:
+			entry = self.requests.get(name)
+			if entry is None:
+				entry = self.requests[name] = \
+						[0, 0.0, [0] * (len(self.latency_buckets) + 1)]
+			entry[0] += 1
+			entry[1] += seconds
+			entry[2][bucket] += 1
+
+	def record_sent(self, length):
+		with self.lock:
+			self.bytes_sent += length
+
+	def record_received(self, length):
+		with self.lock:
+			self.bytes_received += length
+
+	def record_sign(self, seconds):
+		with self.lock:
+			self.sign_count += 1
+			self.sign_seconds += seconds
+
+	def record_verify(self, seconds):
+		with self.lock:
+			self.verify_count += 1
+			self.verify_seconds += seconds
+
+	def record_reconnect(self):
+		with self.lock:
+			self.reconnects += 1
+
+	def record_error(self, exc):
+		"""
+		@type exc: Exception
+		"""
+		name = exc.__class__.__name__
+		with self.lock:
+			self.errors[name] = self.errors.get(name, 0) + 1
+
+	def snapshot(self):
+		"""
+		@rtype: dict
+		@returns: a copy of all counters. Histograms are given as lists
+				of (upper bound, cumulative count) pairs.
+		"""
+		with self.lock:
+			requests = {}
+			for name, (count, seconds, buckets) in self.requests.items():
+				cumulative, total = [], 0
+				for bound, bucketcount in zip(self.latency_buckets +
+						(float("inf"),), buckets):
+					total += bucketcount
+					cumulative.append((bound, total))
+				requests[name] = dict(count=count, seconds=seconds,
+						buckets=cumulative)
+			return dict(requests=requests,
+					bytes_sent=self.bytes_sent,
+					bytes_received=self.bytes_received,
+					sign=dict(count=self.sign_count,
+						seconds=self.sign_seconds),
+					verify=dict(count=self.verify_count,
+						seconds=self.verify_seconds),
+					reconnects=self.reconnects,
+					errors=dict(self.errors))
+
+	def prometheus(self, prefix="omapi"):
+		"""
+		@type prefix: str
+		@rtype: str
+		@returns: the counters in the Prometheus text exposition format
+		"""
+		snapshot = self.snapshot()
+		lines = []
+		def metric(name, kind, samples):
+			lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+			for suffix, labels, value in samples:
+				labeltext = ",".join('%s="%s"' % label for label in labels)
+				lines.append("%s_%s%s%s %r" % (prefix, name, suffix,
+						"{%s}" % labeltext if labeltext else "", value))
+		samples = []
+		for name, request in sorted(snapshot["requests"].items()):
+			for bound, count in request["buckets"]:
+				samples.append(("_bucket", [("opcode", name), ("le",
+						"+Inf" if bound == float("inf") else repr(bound))],
+						count))
+			samples.append(("_sum", [("opcode", name)], request["seconds"]))
+			samples.append(("_count", [("opcode", name)], request["count"]))
+		metric("request_duration_seconds", "histogram", samples)
+		metric("sent_bytes_total", "counter",
+				[("", [], snapshot["bytes_sent"])])
+		metric("received_bytes_total", "counter",
+				[("", [], snapshot["bytes_received"])])
+		for name in ("sign", "verify"):
+			metric("%s_seconds" % name, "summary", [
+				("_sum", [], snapshot[name]["seconds"]),
+				("_count", [], snapshot[name]["count"])])
+		metric("reconnects_total", "counter",
+				[("", [], snapshot["reconnects"])])
+		metric("errors_total", "counter", [("", [("type", name)], count)
+				for name, count in sorted(snapshot["errors"].items())])
+		return "\n".join(lines) + "\n"
+
+__all__.append("Omapi")
+def bounded(method):
+	"""Decorator bounding each call of an Omapi method by the timeout of
+	the instance, see Omapi.deadline.
+	@type method: function
+	@rtype: function
+	"""
+	@functools.wraps(method)
+	def bounded_method(self, *args, **kwargs):
+		with self.deadline(self.timeout):
+			return method(self, *args, **kwargs)
+	return bounded_method
+
+class Omapi:
+	protocol_version = 100
+	reconnect_delay = 0.1 # initial backoff in seconds
+	reconnect_max_delay = 2.0
+	max_late_replies = 1024
+	min_read_size = 2048 # bounds of the adaptive size of reads
+	max_read_size = 65536
+
+	def __init__(self, hostname, port, username=None, key=None, debug=False,
+			pipeline_depth=32, lookup_cache=None, metrics=None,
+			auto_reconnect=False, retry_deadline=10.0,
+			algorithm="hmac-md5.SIG-ALG.REG.INT.", timeout=None,
+			connect_timeout=None, recorder=None, nodelay=True,
+			sizelimit=None):
+		"""
+		@type hostname: str
+		@type port: int
+		@type username: str or None
+		@type key: str or None
+		@type debug: bool
+		@type pipeline_depth: int
+		@type lookup_cache: OmapiLookupCache or None
+		@type metrics: OmapiMetrics or None
+		@type auto_reconnect: bool
+		@type retry_deadline: float
+		@param key: if given, it must be base64 encoded
+		@param pipeline_depth: default number of messages that
+				query_server_pipelined may have in flight at once
+		@param lookup_cache: if given, lookup_ip and lookup_mac are
+				answered from it and the host modifications of this
+				client keep it up to date
+		@param metrics: if given, the client records its traffic there
+		@param auto_reconnect: if True, a lost connection is reestablished
+				including authentication with jittered exponential
+				backoff on the next query, and lookup_ip and lookup_mac
+				are transparently retried after connection failures
+		@param retry_deadline: seconds to keep reconnecting and retrying
+				before giving up
+		@type algorithm: str
+		@param algorithm: signature algorithm of the key, see
+				hmac_algorithms
+		@type timeout: float or None
+		@param timeout: seconds each call of a public method like
+				update_host or query_server may take at most, including
+				all its round trips, reconnects and retries, see also
+				deadline
+		@type connect_timeout: float or None
+		@param connect_timeout: seconds connecting including the
+				handshake and authentication may take at most
+		@type recorder: pypureomapi_capture.OmapiRecorder or None
+		@param recorder: if given, the raw traffic of every connection
+				is written there, see pypureomapi_capture.OmapiRecorder
+		@type nodelay: bool
+		@param nodelay: whether to set TCP_NODELAY, so that small requests
+				are not held back while earlier ones are unacknowledged
+		@type sizelimit: int or None
+		@param sizelimit: maximum size of messages sent and received,
+				defaults to OutBuffer.sizelimit and InBuffer.sizelimit
+		@raises binascii.Error: for bad base64 encoding
+		@raises ValueError: for unknown algorithms
+		@raises socket.error:
+		@raises OmapiError:
+		@raises OmapiTimeoutError:
+		"""
+		self.hostname = hostname
+		self.port = port
+		self.debug = debug
+		if pipeline_depth < 1:
+			raise ValueError("pipeline depth must be positive")
+		self.pipeline_depth = pipeline_depth
+		self.lookup_cache = lookup_cache
+		self.metrics = metrics
+		self.auto_reconnect = auto_reconnect
+		self.retry_deadline = retry_deadline
+		self.timeout = timeout
+		self.connect_timeout = connect_timeout
+		self.call_deadline = None # time.time() value, see deadline
+		self.recorder = recorder
+		self.nodelay = nodelay
+		self.sizelimit = sizelimit
+		self.handles = {} # (type, packed key) -> handle on this connection
+		self.handles_lock = threading.Lock()
+
+		self.newauth = None
+		if username is not None and key is not None:
+			self.newauth = OmapiHMACAuthenticator(username, key, algorithm)
+
+		self.connection = None
+		self.generation = 0 # counts closes, see check_generation
+		self.connect()
+
+	def connect(self):
+		"""Establish a new connection, perform the protocol handshake and
+		initialize the authenticator. An existing connection is closed.
+		@raises socket.error:
+		@raises OmapiError:
+		"""
+		self.close()
+		self.authenticators = {0: OmapiNullAuthenticator()}
+		self.defauth = 0
+		self.inbuffer = InBuffer(self.sizelimit)
+		self.read_size = self.min_read_size
+		self.late_replies = set() # tids of requests that timed out
+		self.connection = socket.socket()
+		self.socket_timeout = None
+		if self.nodelay:
+			self.connection.setsockopt(socket.IPPROTO_TCP,
+					socket.TCP_NODELAY, 1)
+		if self.recorder is not None:
+			self.recorder.record_connect()
+		try:
+			with self.deadline(self.connect_timeout):
+				self.update_socket_timeout()
+				try:
+					self.connection.connect((self.hostname, self.port))
+				except socket.timeout:
+					raise OmapiTimeoutError()
+
+				self.send_protocol_initialization()
+				self.recv_protocol_initialization()
+
+				if self.newauth:
+					self.initialize_authenticator(self.newauth)
+		except:
+			self.close()
+			raise
+
+	def get_call_deadline(self):
+		"""
+		@rtype: float or None
+		@returns: the time.time() value by which the current call must be
+				done
+		"""
+		return self.call_deadline
+
+	def set_call_deadline(self, deadline):
+		"""
+		@type deadline: float or None
+		"""
+		self.call_deadline = deadline
+
+	@contextlib.contextmanager
+	def deadline(self, seconds):
+		"""Context manager bounding the duration of all calls within,
+		including reconnects. Nested deadlines can only shorten the
+		outer ones. A call missing its deadline raises
+		OmapiTimeoutError. If its request was sent completely, the
+		connection stays usable and the late reply is discarded,
+		otherwise the connection is closed.
+		@type seconds: float or None
+		@param seconds: None imposes no additional bound
+		"""
+		previous = self.get_call_deadline()
+		if seconds is None:
+			yield
+			return
+		deadline = time.time() + seconds
+		if previous is not None:
+			deadline = min(deadline, previous)
+		self.set_call_deadline(deadline)
+		try:
+			yield
+		finally:
+			self.set_call_deadline(previous)
+
+	def remaining_time(self):
+		"""
+		@rtype: float or None
+		@returns: seconds until the current deadline or None without one
+		@raises OmapiTimeoutError: if the deadline has passed
+		"""
+		deadline = self.get_call_deadline()
+		if deadline is None:
+			return None
+		remaining = deadline - time.time()
+		if remaining <= 0:
+			raise OmapiTimeoutError()
+		return remaining
+
+	def update_socket_timeout(self):
+		"""Make blocking socket operations return at the current
+		deadline.
+		@raises OmapiTimeoutError: if the deadline has passed
+		"""
+		timeout = self.remaining_time()
+		if timeout != self.socket_timeout:
+			self.connection.settimeout(timeout)
+			self.socket_timeout = timeout
+
+	def abandon(self, tids):
+		"""Record that the replies to the given requests will arrive late
+		and must be discarded. Too many of them suggest a stuck server,
+		so the connection is closed instead.
+		@type tids: iterable of int
+		"""
+		self.late_replies.update(tids)
+		if len(self.late_replies) > self.max_late_replies:
+			self.close()
+
+	def reconnect(self, deadline=None):
+		"""Connect again, retrying with jittered exponential backoff
+		until the given deadline.
+		@type deadline: float or None
+		@param deadline: time.time() value after which to give up, None
+				makes only one attempt
+		@raises socket.error:
+		@raises OmapiError:
+		"""
+		delay = self.reconnect_delay
+		while True:
+			try:
+				self.connect()
+				break
+			except (socket.error, OmapiError):
+				if deadline is None or time.time() + delay > deadline:
+					raise
+			time.sleep(sysrand.uniform(0, delay))
+			delay = min(2 * delay, self.reconnect_max_delay)
+		if self.metrics is not None:
+			self.metrics.record_reconnect()
+
+	def check_reconnect(self):
+		"""Reconnect if the connection was lost and auto_reconnect is
+		enabled.
+		@raises socket.error:
+		@raises OmapiError:
+		"""
+		if not self.connection and self.auto_reconnect:
+			self.reconnect(self.retry_until())
+
+	def retry_until(self):
+		"""
+		@rtype: float
+		@returns: the time.time() value after which to stop retrying
+		"""
+		deadline = time.time() + self.retry_deadline
+		if self.get_call_deadline() is not None:
+			deadline = min(deadline, self.get_call_deadline())
+		return deadline
+
+	def retry_idempotent(self, function, *args):
+		"""Call function and, if auto_reconnect is enabled, retry it
+		until retry_deadline whenever it fails in a way that closed the
+		connection. Only use this for operations that may be repeated.
+		@raises socket.error:
+		@raises OmapiError:
+		"""
+		if not self.auto_reconnect:
+			return function(*args)
+		deadline = self.retry_until()
+		while True:
+			if not self.connection:
+				self.reconnect(deadline)
+			try:
+				return function(*args)
+			except (socket.error, OmapiError):
+				if self.connection or time.time() >= deadline:
+					raise
+
+	def close(self):
+		"""Close the omapi connection if it is open. Cached handles are
+		dropped, since they are only valid on that connection."""
+		with self.handles_lock:
+			self.handles = {}
+			self.generation += 1
+		if self.connection:
+			self.connection.close()
+			self.connection = None
+
+	def check_connected(self):
+		"""Raise an OmapiError unless connected.
+		@raises OmapiError:
+		"""
+		if not self.connection:
+			raise OmapiError("not connected")
+
+	def cache_handle(self, key, handle, generation):
+		"""Remember the handle of an object for later requests.
+		@type key: (str, str)
+		@param key: object type and packed key attribute
+		@type handle: int
+		@type generation: int
+		@param generation: value of self.generation before the handle was
+				requested, the handle is not cached if the client has
+				reconnected since
+		"""
+		with self.handles_lock:
+			if generation == self.generation:
+				self.handles[key] = handle
+
+	def forget_handle(self, key, handle):
+		"""Drop a cached handle unless another thread has replaced it.
+		@type key: (str, str)
+		@type handle: int
+		"""
+		with self.handles_lock:
+			if self.handles.get(key) == handle:
+				del self.handles[key]
+
+	def check_generation(self, messages):
+		"""Make sure that messages addressing cached handles are only
+		sent on the connection the handles were obtained on. After a
+		reconnect the same handle may name a different object.
+		@type messages: [OmapiMessage]
+		@raises OmapiError:
+		"""
+		for message in messages:
+			if message.generation is not None and \
+					message.generation != self.generation:
+				raise OmapiError("handle of a closed connection")
+
+	def recv_conn(self, length):
+		self.check_connected()
+		self.update_socket_timeout()
+		try:
+			data = self.connection.recv(length)
+		except socket.timeout: # partial data stays in the inbuffer
+			raise OmapiTimeoutError()
+		except socket.error:
+			self.close()
+			raise
+		if self.metrics is not None:
+			self.metrics.record_received(len(data))
+		if self.recorder is not None and data:
+			self.recorder.record_received(data)
+		return data
+
+	def recv_conn_into(self, view, length):
+		"""Like recv_conn, but receiving into the given buffer.
+		@type view: memoryview
+		@type length: int
+		@rtype: int
+		@returns: the number of bytes received
+		@raises OmapiTimeoutError:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		self.check_connected()
+		self.update_socket_timeout()
+		try:
+			count = self.connection.recv_into(view, length)
+		except socket.timeout: # partial data stays in the inbuffer
+			raise OmapiTimeoutError()
+		except socket.error:
+			self.close()
+			raise
+		if self.metrics is not None:
+			self.metrics.record_received(count)
+		if self.recorder is not None and count:
+			self.recorder.record_received(view[:count].tobytes())
+		return count
+
+	def send_conn(self, data):
+		self.check_connected()
+		self.update_socket_timeout()
+		try:
+			self.connection.sendall(data)
+		except socket.timeout: # unknown amount of data sent
+			self.close()
+			raise OmapiTimeoutError()
+		except socket.error:
+			self.close()
+			raise
+		if self.metrics is not None:
+			self.metrics.record_sent(len(data))
+		if self.recorder is not None:
+			self.recorder.record_sent(data)
+
+	def fill_inbuffer(self):
+		"""Receive into the reusable read buffer of the inbuffer. The size
+		of reads adapts to the traffic: it doubles whenever a read fills
+		it and halves when reads stay small, but it is always large
+		enough for the rest of a partially received message up to
+		max_read_size. Reads never exceed the room left by the size limit,
+		so that replies already buffered behind a partial message do not
+		count against the limit of the next one.
+		@raises OmapiError:
+		@raises OmapiSizeLimitError: if a single message exceeds the limit
+		@raises socket.error:
+		"""
+		size = min(max(self.read_size, self.inbuffer.missing()),
+				self.max_read_size, self.inbuffer.room())
+		try:
+			if size <= 0:
+				raise OmapiSizeLimitError()
+			count = self.inbuffer.feed_from(self.recv_conn_into, size)
+		except OmapiSizeLimitError:
+			self.close()
+			raise
+		if not count:
+			self.close()
+			raise OmapiError("connection closed")
+		if count == size:
+			self.read_size = min(size * 2, self.max_read_size)
+		elif count < self.read_size // 4:
+			self.read_size = max(self.read_size // 2, self.min_read_size)
+
+	def send_protocol_initialization(self):
+		"""
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		self.check_connected()
+		buff = OutBuffer()
+		buff.add_net32int(self.protocol_version)
+		buff.add_net32int(4*6) # header size
+		self.send_conn(buff.getvalue())
+
+	def recv_protocol_initialization(self):
+		"""
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		result = self.inbuffer.parse_startup_message()
+		while result is None:
+			self.fill_inbuffer()
+			result = self.inbuffer.parse_startup_message()
+		self.inbuffer.resetsize()
+		protocol_version, header_size = result
+		if protocol_version != self.protocol_version:
+			self.close()
+			raise OmapiError("protocol mismatch")
+		if header_size != 4*6:
+			self.close()
+			raise OmapiError("header size mismatch")
+
+	def receive_message(self, wait=True):
+		"""Read the next message from the connection.
+		@type wait: bool
+		@param wait: if False, only a message that was already received
+				completely is returned
+		@rtype: OmapiMessage or None
+		@returns: the message or None if wait is False and there is no
+				complete message
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		message = self.inbuffer.parse_message()
+		while message is None:
+			if not wait:
+				return None
+			self.fill_inbuffer()
+			message = self.inbuffer.parse_message()
+		self.inbuffer.resetsize()
+		if self.metrics is not None:
+			start = time.time()
+			verified = message.verify(self.authenticators)
+			self.metrics.record_verify(time.time() - start)
+		else:
+			verified = message.verify(self.authenticators)
+		if not verified:
+			self.close()
+			raise OmapiError("bad omapi message signature")
+		return message
+
+	def receive_response(self, message, insecure=False):
+		"""Read the response for the given message.
+		@type message: OmapiMessage
+		@type insecure: bool
+		@rtype: OmapiMessage
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		response = self.receive_late_replies()
 		if not response.is_response(message):
 			raise OmapiError("received message is not the desired response")
-		# signature already verified
-		if response.authid != self.defauth and not insecure:
-			raise OmapiError("received message is signed with wrong " +
-						"authenticator")
+		self.check_response_authenticator(response, insecure)
 		return response
 
-	def send_message(self, message, sign=True):
-		"""Sends the given message to the connection.
+	def receive_late_replies(self, wait=True):
+		"""Read the next message that is not a late reply to a request
+		which timed out.
+		@type wait: bool
+		@param wait: see receive_message
+		@rtype: OmapiMessage or None
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		while True:
+			response = self.receive_message(wait)
+			if response is None:
+				return None
+			if self.debug:
+				print "debug recv"
+				response.dump()
+			if response.rid not in self.late_replies:
+				return response
+			self.late_replies.discard(response.rid)
+
+	def check_response_authenticator(self, response, insecure=False):
+		"""Check that the given response is signed with the default
+		authenticator.
+		@type response: OmapiMessage
+		@type insecure: bool
+		@raises OmapiError:
+		"""
+		# signature already verified
+		if response.authid != self.defauth and not insecure:
+			raise OmapiError("received message is signed with wrong " +
+						"authenticator")
+
+	def encode_message(self, message, sign=True):
+		"""
+		@type message: OmapiMessage
+		@type sign: bool
+		@param sign: whether the message needs to be signed
+		@rtype: str
+		@returns: the message in wire format
+		@raises OmapiError:
+		"""
+		if not sign:
+			data = message.as_string(sizelimit=self.sizelimit)
+		elif self.metrics is not None:
+			start = time.time()
+			data = message.sign(self.authenticators[self.defauth],
+					self.sizelimit)
+			self.metrics.record_sign(time.time() - start)
+		else:
+			data = message.sign(self.authenticators[self.defauth],
+					self.sizelimit)
+		if self.debug:
+			print "debug send"
+			message.dump()
+		return data
+
+	def send_message(self, message, sign=True):
+		"""Sends the given message to the connection.
+		@type message: OmapiMessage
+		@type sign: bool
+		@param sign: whether the message needs to be signed
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		self.check_connected()
+		self.send_conn(self.encode_message(message, sign))
+
+	def query_server(self, message):
+		"""Send the message and receive a response for it.
+		@type message: OmapiMessage
+		@rtype: OmapiMessage
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		if self.metrics is not None:
+			start = time.time()
+		sent = False
+		try:
+			with self.deadline(self.timeout):
+				self.check_reconnect()
+				self.send_message(message)
+				sent = True
+				response = self.receive_response(message)
+		except Exception, exc:
+			if sent and isinstance(exc, OmapiTimeoutError) and \
+					self.connection:
+				self.abandon([message.tid])
+			if self.metrics is not None:
+				self.metrics.record_error(exc)
+			raise
+		if self.metrics is not None:
+			self.metrics.record_request(message.opcode, time.time() - start)
+		return response
+
+	def query_server_pipelined(self, messages, depth=None):
+		"""Send the given messages back to back without waiting for
+		the individual responses and collect the responses in whatever
+		order they arrive. Responses are matched to their messages via
+		a table of outstanding transmission ids. Once at most half of
+		depth messages are outstanding, the pipeline is refilled with a
+		single write. If anything goes wrong while responses are still
+		outstanding, the connection is closed, because the stream can no
+		longer be associated with requests. Only if the deadline passes
+		while waiting for responses, their late replies are discarded
+		instead.
+		@type messages: [OmapiMessage]
+		@type depth: int or None
+		@param depth: maximum number of messages in flight, defaults to
+				self.pipeline_depth
+		@rtype: [OmapiMessage]
+		@returns: the responses in the order of the given messages
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		messages = list(messages)
+		if depth is None:
+			depth = self.pipeline_depth
+		if depth < 1:
+			raise ValueError("pipeline depth must be positive")
+		responses = [None] * len(messages)
+		outstanding = {} # tid -> index into messages
+		started = {} # tid -> send time, only used with metrics
+		nextindex = 0
+		try:
+			with self.deadline(self.timeout):
+				self.check_reconnect()
+				self.check_generation(messages)
+				while nextindex < len(messages) or outstanding:
+					batch, sending = [], {} # wire data, tid -> index
+					while nextindex < len(messages) and \
+							len(outstanding) <= depth // 2 and \
+							len(outstanding) + len(sending) < depth:
+						message = messages[nextindex]
+						while message.tid in outstanding or \
+								message.tid in sending or \
+								message.tid in self.late_replies:
+							message.generate_tid()
+						batch.append(self.encode_message(message))
+						if self.metrics is not None:
+							started[message.tid] = time.time()
+						sending[message.tid] = nextindex
+						nextindex += 1
+					if batch:
+						self.check_connected()
+						self.send_conn("".join(batch))
+						outstanding.update(sending)
+					response = self.receive_late_replies()
+					while response is not None:
+						try:
+							index = outstanding.pop(response.rid)
+						except KeyError:
+							raise OmapiError("received message is not a " +
+									"response to any outstanding message")
+						self.check_response_authenticator(response)
+						responses[index] = response
+						if self.metrics is not None:
+							self.metrics.record_request(
+									messages[index].opcode,
+									time.time() - started.pop(response.rid))
+						response = outstanding and \
+								self.receive_late_replies(wait=False) or None
+		except Exception, exc:
+			if self.metrics is not None:
+				self.metrics.record_error(exc)
+			if outstanding:
+				if isinstance(exc, OmapiTimeoutError) and self.connection:
+					self.abandon(outstanding)
+				else:
+					self.close()
+			raise
+		except:
+			if outstanding:
+				self.close()
+			raise
+		return responses
+
+
+	def initialize_authenticator(self, authenticator):
+		"""
+		@type authenticator: OmapiAuthenticatorBase
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		msg = OmapiMessage.open("authenticator")
+		msg.update_object(authenticator.auth_object())
+		response = self.query_server(msg)
+		if response.opcode != OMAPI_OP_UPDATE:
+			raise OmapiError("received non-update response for open")
+		authid = response.handle
+		if authid == 0:
+			raise OmapiError("received invalid authid from server")
+		self.authenticators[authid] = authenticator
+		authenticator.authid = authid
+		self.defauth = authid
+
+	@bounded
+	def add_host(self, ip, mac):
+		"""
+		@type ip: str
+		@type mac: str
+		@type name: str
+		@raises ValueError:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		packed_mac = pack_mac(mac)
+		msg = create_host_message(packed_mac, pack_ip(ip))
+
+		generation = self.generation
+		response = self.query_server(msg)
+		if response.opcode != OMAPI_OP_UPDATE:
+			raise OmapiError("add failed")
+		if response.handle != 0:
+			self.cache_handle(("host", packed_mac), response.handle,
+					generation)
+		if self.lookup_cache is not None:
+			self.lookup_cache.set_host(mac, ip)
+
+	def query_by_handle(self, key, open_message, request, fallback=None):
+		"""Send a message addressed to the handle of an object. The object
+		is only opened if its handle is not cached for this connection or
+		the server reports the cached handle as stale. A not found response
+		to a handle just opened is returned like any other response.
+		@type key: (str, str)
+		@param key: the object type and its packed identifying attribute
+		@type open_message: OmapiMessage
+		@type request: int -> OmapiMessage
+		@param request: creates the message for a given handle
+		@type fallback: OmapiMessage or None
+		@param fallback: an open message to send instead of the request if
+				open_message does not yield a handle, e.g. one creating
+				the object
+		@rtype: (int, OmapiMessage)
+		@returns: the handle and the response to the request or to a
+				successful fallback. If no handle was obtained, 0 and the
+				response to the last open message sent.
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		return self.query_by_handles([(key, open_message, request,
+				fallback)])[0]
+
+	@bounded
+	def query_by_handles(self, items):
+		"""Pipelined version of query_by_handle. Messages to cached handles
+		are sent together with the opens of uncached objects, so for
+		cached handles all items take a single round trip.
+		@type items: [((str, str), OmapiMessage, int -> OmapiMessage,
+				OmapiMessage or None)]
+		@param items: (key, open_message, request, fallback) tuples
+		@rtype: [(int, OmapiMessage)]
+		@returns: (handle, response) pairs as described for
+				query_by_handle
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		results = [None] * len(items)
+		# (index, handle or None for an open, message, whether the handle
+		# was taken from the cache)
+		queries = []
+		self.check_reconnect() # before reading the cache of the connection
+		generation = self.generation
+		for index, (key, open_message, request, _) in enumerate(items):
+			handle = self.handles.get(key)
+			if handle is None:
+				queries.append((index, None, open_message, False))
+			else:
+				queries.append((index, handle, request(handle), True))
+				queries[-1][2].generation = generation
+		while queries:
+			responses = self.query_server_pipelined(
+					[message for _, _, message, _ in queries])
+			generation = self.generation
+			followups = []
+			for (index, handle, message, cached), response in \
+					zip(queries, responses):
+				key, open_message, request, fallback = items[index]
+				if handle is not None:
+					if cached and response.is_stale(): # open once more
+						self.forget_handle(key, handle)
+						followups.append((index, None, open_message, False))
+					else:
+						results[index] = (handle, response)
+				elif response.opcode != OMAPI_OP_UPDATE or \
+						response.handle == 0:
+					if message is open_message and fallback is not None:
+						followups.append((index, None, fallback, False))
+					else:
+						results[index] = (0, response)
+				else:
+					self.cache_handle(key, response.handle, generation)
+					if message is fallback:
+						results[index] = (response.handle, response)
+					else:
+						followups.append((index, response.handle,
+								request(response.handle), False))
+						followups[-1][2].generation = generation
+			queries = followups
+		return results
+
+	@bounded
+	def update_host(self, mac, ip):
+		"""
+		@type mac: str
+		@type ip: str
+		@type name: str
+		@raises ValueError:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		result = self.update_hosts([(mac, ip)])[0]
+		if result is not None:
+			raise result
+
+	@bounded
+	def refresh_host(self, mac):
+		"""Fetch all attributes of a host, reusing its handle if it is
+		cached for this connection.
+		@type mac: str
+		@rtype: OmapiObject
+		@raises ValueError:
+		@raises OmapiErrorNotFound:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		msg = host_by_mac_template.build([pack_mac(mac)])
+		handle, response = self.query_by_handle(("host", pack_mac(mac)),
+				msg, OmapiMessage.refresh)
+		if handle == 0 or response.opcode != OMAPI_OP_UPDATE:
+			raise OmapiErrorNotFound()
+		return response.object_view()
+
+	@bounded
+	def del_host(self, mac):
+		"""
+		@type mac: str
+		@raises ValueError:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		result = self.del_hosts([mac])[0]
+		if result is not None:
+			raise result
+
+	@bounded
+	def add_hosts(self, hosts):
+		"""Add many hosts, sending all open messages without waiting for
+		the individual responses.
+		@type hosts: iterable of (str, str)
+		@param hosts: (mac, ip) pairs
+		@rtype: [Exception or None]
+		@returns: for each host None on success or the ValueError or
+				OmapiError that add_host would have raised
+		@raises OmapiError: for errors affecting the whole connection
+		@raises socket.error:
+		"""
+		hosts = list(hosts)
+		results = [None] * len(hosts)
+		indices, messages = [], []
+		for index, (mac, ip) in enumerate(hosts):
+			try:
+				messages.append(create_host_message(pack_mac(mac),
+						pack_ip(ip)))
+			except ValueError, exc:
+				results[index] = exc
+				continue
+			indices.append(index)
+		generation = self.generation
+		responses = self.query_server_pipelined(messages)
+		for index, response in zip(indices, responses):
+			if response.opcode != OMAPI_OP_UPDATE:
+				results[index] = OmapiError("add failed")
+				continue
+			if response.handle != 0:
+				self.cache_handle(("host", pack_mac(hosts[index][0])),
+						response.handle, generation)
+			if self.lookup_cache is not None:
+				self.lookup_cache.set_host(*hosts[index])
+		return results
+
+	@bounded
+	def update_hosts(self, hosts):
+		"""Update or add many hosts. Updates to hosts whose handles are
+		cached for this connection are sent right away, together with the
+		opens of all other hosts. The updates and adds depending on those
+		opens are then sent in a second pipelined batch.
+		@type hosts: iterable of (str, str)
+		@param hosts: (mac, ip) pairs
+		@rtype: [Exception or None]
+		@returns: for each host None on success or the ValueError or
+				OmapiError that update_host would have raised
+		@raises OmapiError: for errors affecting the whole connection
+		@raises socket.error:
+		"""
+		hosts = list(hosts)
+		results = [None] * len(hosts)
+		indices, items = [], []
+		for index, (mac, ip) in enumerate(hosts):
+			try:
+				packed_mac, packed_ip = pack_mac(mac), pack_ip(ip)
+			except ValueError, exc:
+				results[index] = exc
+				continue
+			msg = host_by_mac_template.build([packed_mac])
+			def request(handle, packed_ip=packed_ip):
+				return update_ip_message(handle, packed_ip)
+			# This host may not exist
+			items.append((("host", packed_mac), msg, request,
+					create_host_message(packed_mac, packed_ip)))
+			indices.append(index)
+		if self.lookup_cache is not None:
+			for index in indices:
+				self.lookup_cache.invalidate_host(hosts[index][0])
+		responses = self.query_by_handles(items)
+		for index, (handle, response) in zip(indices, responses):
+			if handle == 0:
+				results[index] = OmapiError("add failed")
+			elif response.opcode not in (OMAPI_OP_UPDATE, OMAPI_OP_STATUS) \
+					or response.result() != ISC_R_SUCCESS:
+				results[index] = OmapiError('Could not update host with ' +
+						'mac: %s' % (hosts[index][0],))
+			elif self.lookup_cache is not None:
+				self.lookup_cache.set_host(*hosts[index])
+		return results
+
+	@bounded
+	def del_hosts(self, macs):
+		"""Delete many hosts. Deletes of hosts whose handles are cached for
+		this connection are sent right away, together with the opens of
+		all other hosts. The deletes depending on those opens are then
+		sent in a second pipelined batch.
+		@type macs: iterable of str
+		@rtype: [Exception or None]
+		@returns: for each mac None on success or the ValueError or
+				OmapiError that del_host would have raised
+		@raises OmapiError: for errors affecting the whole connection
+		@raises socket.error:
+		"""
+		macs = list(macs)
+		results = [None] * len(macs)
+		indices, items = [], []
+		for index, mac in enumerate(macs):
+			try:
+				packed_mac = pack_mac(mac)
+			except ValueError, exc:
+				results[index] = exc
+				continue
+			msg = ethernet_host_template.build([packed_mac])
+			items.append((("host", packed_mac), msg, OmapiMessage.delete,
+					None))
+			indices.append(index)
+		if self.lookup_cache is not None:
+			for index in indices:
+				self.lookup_cache.invalidate_host(macs[index])
+		responses = self.query_by_handles(items)
+		for index, (handle, response), (key, _, _, _) in \
+				zip(indices, responses, items):
+			if handle == 0:
+				if response.opcode != OMAPI_OP_UPDATE:
+					results[index] = OmapiErrorNotFound()
+				else:
+					results[index] = OmapiError("received invalid handle " +
+							"from server")
+				continue
+			self.forget_handle(key, handle)
+			if response.opcode != OMAPI_OP_STATUS or \
+					response.result() != ISC_R_SUCCESS:
+				results[index] = OmapiError("delete failed")
+		return results
+
+	@bounded
+	def sync_hosts(self, desired, dry_run=False):
+		"""Bring the given hosts into the desired state with as few writes
+		as possible. The current state of all of them is looked up in one
+		pipelined batch, then only the differing hosts are deleted,
+		updated and added, again pipelined. Since OMAPI cannot enumerate
+		hosts, hosts to be removed have to be named explicitly.
+		@type desired: {str: str or None}
+		@param desired: mac addresses mapped to their ip addresses or to
+				None for hosts that should not exist
+		@type dry_run: bool
+		@param dry_run: only look up and report the necessary changes
+		@rtype: {str: list or dict}
+		@returns: a report with the keys "add" [(mac, ip)], "update"
+				[(mac, current ip or None, ip)], "delete" [(mac, current
+				ip or None)] listing the changes needed, "unchanged"
+				[mac] and "errors" {mac: Exception} for malformed
+				addresses and changes that failed
+		@raises OmapiError: for errors affecting the whole connection
+		@raises socket.error:
+		"""
+		report = dict(add=[], update=[], delete=[], unchanged=[], errors={})
+		items, messages = [], []
+		for mac, ip in sorted(desired.items()):
+			try:
+				packed_mac = pack_mac(mac)
+				packed_ip = None if ip is None else pack_ip(ip)
+			except ValueError, exc:
+				report["errors"][mac] = exc
+				continue
+			msg = host_by_mac_template.build([packed_mac])
+			items.append((mac, packed_mac, ip, packed_ip))
+			messages.append(msg)
+		generation = self.generation
+		responses = self.query_server_pipelined(messages)
+		for (mac, packed_mac, ip, packed_ip), response in \
+				zip(items, responses):
+			if response.opcode != OMAPI_OP_UPDATE:
+				if ip is None:
+					report["unchanged"].append(mac)
+				else:
+					report["add"].append((mac, ip))
+				continue
+			if response.handle != 0: # makes the writes single round trips
+				self.cache_handle(("host", packed_mac), response.handle,
+						generation)
+			current = response.object_view()
+			current_ip = current.get("ip-address")
+			if ip is None:
+				report["delete"].append((mac, current_ip))
+			elif "ip-address" not in current or \
+					current.raw("ip-address") != packed_ip:
+				report["update"].append((mac, current_ip, ip))
+			else:
+				report["unchanged"].append(mac)
+		if dry_run:
+			return report
+		# deletes first to free the addresses of updated and added hosts
+		changes = [
+			(report["delete"], lambda: self.del_hosts(
+				[mac for mac, _ in report["delete"]])),
+			(report["update"], lambda: self.update_hosts(
+				[(mac, ip) for mac, _, ip in report["update"]])),
+			(report["add"], lambda: self.add_hosts(report["add"])),
+		]
+		for changed, apply_changes in changes:
+			if not changed:
+				continue
+			for change, error in zip(changed, apply_changes()):
+				if error is not None:
+					report["errors"][change[0]] = error
+		return report
+
+	@bounded
+	def lookup_ip(self, mac):
+		"""
+		@type mac: str
+		@rtype: str or None
+		@raises ValueError:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		if self.lookup_cache is not None:
+			return self.lookup_cache.lookup(("ip", pack_mac(mac)),
+					self.fetch_ip, mac)
+		return self.fetch_ip(mac)
+
+	@bounded
+	def fetch_ip(self, mac):
+		"""Like lookup_ip, but bypassing the lookup cache."""
+		try:
+			return self.retry_idempotent(self.open_template,
+					host_by_mac_template, [pack_mac(mac)])["ip-address"]
+		except KeyError: # ip-address
+			raise OmapiErrorNotFound()
+
+	@bounded
+	def lookup_mac(self, ip):
+		"""
+		@type ip: str
+		@rtype: str or None
+		@raises ValueError:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		if self.lookup_cache is not None:
+			return self.lookup_cache.lookup(("mac", pack_ip(ip)),
+					self.fetch_mac, ip)
+		return self.fetch_mac(ip)
+
+	@bounded
+	def fetch_mac(self, ip):
+		"""Like lookup_mac, but bypassing the lookup cache."""
+		try:
+			return self.retry_idempotent(self.open_template,
+					host_by_ip_template, [pack_ip(ip)])["hardware-address"]
+		except KeyError: # hardware-address
+			raise OmapiErrorNotFound()
+
+	@bounded
+	def open_object(self, typename, criteria):
+		"""Open an object in a single round trip.
+		@type typename: str
+		@type criteria: [(str, str)]
+		@rtype: OmapiObject
+		@returns: all attributes sent by the server
+		@raises OmapiErrorNotFound:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		response = self.query_server(open_message(typename, criteria))
+		if response.opcode != OMAPI_OP_UPDATE:
+			raise OmapiErrorNotFound()
+		return response.object_view()
+
+	@bounded
+	def open_template(self, template, values):
+		"""Like open_object, but with a message built from a template.
+		@type template: OmapiMessageTemplate
+		@type values: [str]
+		@rtype: OmapiObject
+		@raises OmapiErrorNotFound:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		response = self.query_server(template.build(values))
+		if response.opcode != OMAPI_OP_UPDATE:
+			raise OmapiErrorNotFound()
+		return response.object_view()
+
+	@bounded
+	def get_host(self, mac=None, ip=None, name=None):
+		"""Look up a host object by any combination of its hardware
+		address, ip address and name and return all of its attributes.
+		This is retried like lookup_ip if auto_reconnect is enabled.
+		@type mac: str or None
+		@type ip: str or None
+		@type name: str or None
+		@rtype: OmapiObject
+		@raises ValueError: for malformed addresses or if nothing is given
+		@raises OmapiErrorNotFound:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		return self.retry_idempotent(self.open_object, "host",
+				object_criteria(mac, ip, name))
+
+	@bounded
+	def get_lease(self, ip=None, mac=None):
+		"""Look up a lease by its ip address or hardware address and
+		return all of its attributes, e.g. state, starts and ends.
+		This is retried like lookup_ip if auto_reconnect is enabled.
+		@type ip: str or None
+		@type mac: str or None
+		@rtype: OmapiObject
+		@raises ValueError: for malformed addresses or if nothing is given
+		@raises OmapiErrorNotFound:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		return self.retry_idempotent(self.open_object, "lease",
+				object_criteria(mac, ip))
+
+__all__.append("OmapiPool")
+class OmapiPool:
+	"""Thread-safe pool of connected and authenticated Omapi instances.
+	Connections are checked out with get or the connection context
+	manager and must be returned with put. Connections that were closed
+	due to errors are discarded on return, idle connections are health
+	checked before reuse and evicted after maxidle seconds. After a fork
+	the pool drops all connections inherited from the parent process.
+	Whenever connections were dropped, the pool is refilled to minsize.
+	"""
+	def __init__(self, hostname, port, username=None, key=None, minsize=1,
+			maxsize=8, maxidle=300.0, algorithm="hmac-md5.SIG-ALG.REG.INT.",
+			timeout=None, connect_timeout=None, **options):
+		"""
+		@type hostname: str
+		@type port: int
+		@type username: str or None
+		@type key: str or None
+		@param key: if given, it must be base64 encoded
+		@type minsize: int
+		@param minsize: number of warm connections to keep around
+		@type maxsize: int
+		@param maxsize: maximum number of connections
+		@type maxidle: float
+		@param maxidle: seconds after which surplus idle connections are
+				closed
+		@type algorithm: str
+		@param algorithm: signature algorithm of the key, see
+				hmac_algorithms
+		@type timeout: float or None
+		@param timeout: see Omapi.__init__
+		@type connect_timeout: float or None
+		@param connect_timeout: see Omapi.__init__
+		@param options: further keyword arguments of Omapi.__init__ such
+				as auto_reconnect or metrics, used for every connection
+		@raises ValueError: for inconsistent sizes or unknown algorithms
+		@raises binascii.Error: for bad base64 encoding
+		@raises socket.error:
+		@raises OmapiError:
+		"""
+		if minsize < 0 or maxsize < 1 or minsize > maxsize:
+			raise ValueError("invalid pool size")
+		self.hostname = hostname
+		self.port = port
+		self.username = username
+		self.key = key
+		self.algorithm = algorithm
+		self.minsize = minsize
+		self.maxsize = maxsize
+		self.maxidle = maxidle
+		self.timeout = timeout
+		self.connect_timeout = connect_timeout
+		self.options = options
+		self.closed = False
+		self.reset()
+		self.fill()
+
+	def reset(self):
+		"""Forget all connections without closing them."""
+		self.pid = os.getpid()
+		self.cond = threading.Condition()
+		self.idle = [] # [(Omapi, last use)], most recently used last
+		self.checkedout = set()
+		self.size = 0 # idle, checked out and currently connecting
+
+	def check_fork(self):
+		"""Drop the connections of the parent process after a fork and
+		open new ones."""
+		if self.pid != os.getpid():
+			idle = self.idle
+			self.reset()
+			for omapi, _ in idle:
+				omapi.close() # only closes the file descriptor of the child
+			self.refill()
+
+	def create_connection(self):
+		"""
+		@rtype: Omapi
+		@raises socket.error:
+		@raises OmapiError:
+		"""
+		return Omapi(self.hostname, self.port, self.username, self.key,
+				algorithm=self.algorithm, timeout=self.timeout,
+				connect_timeout=self.connect_timeout, **self.options)
+
+	def fill(self):
+		"""Open connections until minsize connections exist.
+		@raises socket.error:
+		@raises OmapiError:
+		"""
+		while True:
+			with self.cond:
+				if self.closed or self.size >= self.minsize:
+					return
+				self.size += 1
+			try:
+				omapi = self.create_connection()
+			except:
+				with self.cond:
+					self.size -= 1
+				raise
+			with self.cond:
+				self.idle.append((omapi, time.time()))
+				self.cond.notify()
+
+	def refill(self):
+		"""Open connections until minsize connections exist again after
+		some were discarded. Errors are ignored, since get opens
+		connections on demand as well."""
+		try:
+			self.fill()
+		except (socket.error, OmapiError):
+			pass
+
+	def is_healthy(self, omapi):
+		"""Check whether an idle connection can be used. An idle
+		connection must not be readable, because that would either mean
+		that the server closed it or that it sent unexpected data.
+		@type omapi: Omapi
+		@rtype: bool
+		"""
+		if not omapi.connection:
+			return False
+		try:
+			readable = select.select([omapi.connection], [], [], 0)[0]
+		except (select.error, socket.error, ValueError):
+			return False
+		return not readable
+
+	def discard(self, omapi):
+		"""Close a connection and release its slot. Must be called with
+		self.cond held.
+		@type omapi: Omapi
+		"""
+		omapi.close()
+		self.size -= 1
+		self.cond.notify()
+
+	def evict_idle(self):
+		"""Close idle connections that exceed minsize and have not been
+		used for maxidle seconds."""
+		self.check_fork()
+		with self.cond:
+			limit = time.time() - self.maxidle
+			while self.idle and self.size > self.minsize and \
+					self.idle[0][1] < limit:
+				self.discard(self.idle.pop(0)[0])
+
+	def get(self, timeout=None):
+		"""Check out a connection. Idle connections are reused, new ones
+		are opened while the pool has fewer than maxsize connections.
+		@type timeout: float or None
+		@param timeout: seconds to wait for a connection to be returned
+				if the pool is exhausted, None waits forever
+		@rtype: Omapi
+		@raises OmapiError: if the pool is closed or no connection
+				became available in time
+		@raises socket.error:
+		"""
+		self.evict_idle()
+		self.refill()
+		deadline = None if timeout is None else time.time() + timeout
+		with self.cond:
+			while True:
+				if self.closed:
+					raise OmapiError("pool closed")
+				while self.idle:
+					omapi = self.idle.pop()[0]
+					if self.is_healthy(omapi):
+						self.checkedout.add(omapi)
+						return omapi
+					self.discard(omapi)
+				if self.size < self.maxsize:
+					self.size += 1
+					break
+				if deadline is None:
+					self.cond.wait()
+				else:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						raise OmapiError("no connection available")
+					self.cond.wait(remaining)
+		try:
+			omapi = self.create_connection()
+		except:
+			with self.cond:
+				self.size -= 1
+				self.cond.notify()
+			raise
+		with self.cond:
+			self.checkedout.add(omapi)
+		return omapi
+
+	def put(self, omapi):
+		"""Return a connection obtained from get. Closed connections are
+		discarded.
+		@type omapi: Omapi
+		"""
+		self.check_fork()
+		with self.cond:
+			if omapi not in self.checkedout:
+				# from before a fork or not ours
+				omapi.close()
+				return
+			self.checkedout.remove(omapi)
+			if self.closed or not omapi.connection:
+				self.discard(omapi)
+			else:
+				self.idle.append((omapi, time.time()))
+				self.cond.notify()
+		self.evict_idle()
+		self.refill()
+
+	@contextlib.contextmanager
+	def connection(self, timeout=None):
+		"""Context manager checking out a connection and returning it
+		afterwards. Connections are closed when the block is left with an
+		exception other than OmapiError or ValueError, because they may
+		still have a response in flight.
+		@type timeout: float or None
+		"""
+		omapi = self.get(timeout)
+		try:
+			yield omapi
+		except (OmapiError, ValueError):
+			self.put(omapi)
+			raise
+		except:
+			omapi.close()
+			self.put(omapi)
+			raise
+		else:
+			self.put(omapi)
+
+	def close(self):
+		"""Close all idle connections. Checked out connections are closed
+		when they are returned."""
+		with self.cond:
+			self.closed = True
+		self.check_fork()
+		with self.cond:
+			while self.idle:
+				self.discard(self.idle.pop()[0])
+			self.cond.notify_all()
+
+__all__.append("OmapiFuture")
+class OmapiFuture:
+	"""Minimal thread-safe future for results computed by worker
+	threads."""
+	def __init__(self):
+		self.cond = threading.Condition()
+		self.finished = False
+		self.value = None
+		self.error = None
+		self.callbacks = []
+
+	def set_result(self, value):
+		self.finish(value, None)
+
+	def set_exception(self, exc):
+		"""
+		@type exc: Exception
+		"""
+		self.finish(None, exc)
+
+	def finish(self, value, error):
+		with self.cond:
+			if self.finished:
+				return
+			self.value, self.error, self.finished = value, error, True
+			callbacks, self.callbacks = self.callbacks, []
+			self.cond.notify_all()
+		for callback in callbacks:
+			callback(self)
+
+	def done(self):
+		return self.finished
+
+	def add_done_callback(self, callback):
+		"""Call callback with this future once it is done. If it is done
+		already, callback is called immediately.
+		@type callback: OmapiFuture -> None
+		"""
+		with self.cond:
+			if not self.finished:
+				self.callbacks.append(callback)
+				return
+		callback(self)
+
+	def wait(self, timeout=None):
+		"""
+		@type timeout: float or None
+		@rtype: bool
+		@returns: whether the future is done
+		"""
+		with self.cond:
+			if not self.finished:
+				self.cond.wait(timeout)
+			return self.finished
+
+	def exception(self, timeout=None):
+		"""
+		@type timeout: float or None
+		@rtype: Exception or None
+		@raises OmapiTimeoutError: if the future is not done within timeout
+		"""
+		if not self.wait(timeout):
+			raise OmapiTimeoutError()
+		return self.error
+
+	def result(self, timeout=None):
+		"""
+		@type timeout: float or None
+		@raises OmapiTimeoutError: if the future is not done within timeout
+		@raises Exception: the exception the future failed with
+		"""
+		if self.exception(timeout) is not None:
+			raise self.error
+		return self.value
+
+def wait_any(futures, timeout=None):
+	"""Wait until at least one of the given futures is done.
+	@type futures: [OmapiFuture]
+	@type timeout: float or None
+	@rtype: [OmapiFuture]
+	@returns: the futures that are done, empty on timeout
+	"""
+	event = threading.Event()
+	for future in futures:
+		future.add_done_callback(lambda _: event.set())
+	event.wait(timeout)
+	return [future for future in futures if future.done()]
+
+__all__.append("OmapiMultiplexed")
+class OmapiMultiplexed(Omapi):
+	"""Thread-safe Omapi client sharing one connection between any number
+	of threads. Writers serialize on a send lock, while a dedicated
+	reader thread receives all responses and hands them to the futures
+	of the waiting requests by their rid. All methods of Omapi may be
+	called concurrently; they block until their responses arrive.
+	Deadlines are kept per thread. Once the reader runs, they bound the
+	waiting for responses, and together with send_timeout the sending of
+	requests, so that a server that stops reading cannot hold the send
+	lock forever.
+	"""
+	def __init__(self, *args, **kwargs):
+		"""See Omapi.__init__. The additional keyword argument
+		send_timeout (float or None, default None) bounds each send in
+		seconds; a send missing it closes the connection.
+		@raises binascii.Error: for bad base64 encoding
+		@raises socket.error:
+		@raises OmapiError:
+		"""
+		self.lock = threading.Lock() # guards connection and pending
+		self.cond = threading.Condition(self.lock)
+		self.send_lock = threading.Lock()
+		self.connect_lock = threading.RLock()
+		self.pending = {} # tid -> (OmapiMessage, OmapiFuture, send time)
+		self.connecting = None # thread running connect
+		self.reader = None
+		self.connection = None
+		self.local = threading.local() # per thread call deadline
+		self.send_timeout = kwargs.pop("send_timeout", None)
+		Omapi.__init__(self, *args, **kwargs)
+
+	def get_call_deadline(self):
+		"""See Omapi.get_call_deadline."""
+		return getattr(self.local, "deadline", None)
+
+	def set_call_deadline(self, deadline):
+		"""See Omapi.set_call_deadline."""
+		self.local.deadline = deadline
+
+	def update_socket_timeout(self):
+		"""See Omapi.update_socket_timeout. Only applies until the reader
+		thread starts, because a timeout on the shared socket would also
+		hit the reader and the senders of other threads.
+		@raises OmapiTimeoutError: if the deadline has passed
+		"""
+		if self.reader is None:
+			Omapi.update_socket_timeout(self)
+
+	def send_conn(self, data):
+		"""See Omapi.send_conn. The shared socket stays blocking for the
+		reader, so the data is sent without blocking while select waits
+		for the socket to become writable until the call deadline or
+		send_timeout. A send missing them closes the connection, since
+		part of the data may have been sent.
+		@type data: str
+		@raises OmapiError:
+		@raises OmapiTimeoutError:
+		@raises socket.error:
+		"""
+		self.check_connected()
+		connection = self.connection
+		deadline = self.get_call_deadline()
+		if self.send_timeout is not None:
+			expires = time.time() + self.send_timeout
+			deadline = expires if deadline is None else min(deadline, expires)
+		view = memoryview(data)
+		try:
+			while len(view):
+				timeout = None
+				if deadline is not None:
+					timeout = deadline - time.time()
+					if timeout <= 0:
+						raise OmapiTimeoutError()
+				if not select.select([], [connection], [], timeout)[1]:
+					raise OmapiTimeoutError()
+				try:
+					view = view[connection.send(view, socket.MSG_DONTWAIT):]
+				except socket.error, exc:
+					if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+						raise
+		except (OmapiTimeoutError, socket.error, select.error):
+			self.close()
+			raise
+		if self.metrics is not None:
+			self.metrics.record_sent(len(data))
+		if self.recorder is not None:
+			self.recorder.record_sent(data)
+
+	def connect(self):
+		"""See Omapi.connect. Other threads wait until the new connection
+		is authenticated.
+		@raises socket.error:
+		@raises OmapiError:
+		"""
+		with self.connect_lock:
+			with self.lock:
+				self.connecting = threading.current_thread()
+			try:
+				Omapi.connect(self)
+			finally:
+				with self.lock:
+					self.connecting = None
+					self.cond.notify_all()
+
+	def check_reconnect(self):
+		"""See Omapi.check_reconnect. Only one thread reconnects."""
+		if not self.connection and self.auto_reconnect:
+			with self.connect_lock:
+				Omapi.check_reconnect(self)
+
+	def recv_protocol_initialization(self):
+		"""See Omapi.recv_protocol_initialization. Afterwards the reader
+		thread takes over the receiving side of the connection.
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		Omapi.recv_protocol_initialization(self)
+		self.connection.settimeout(None)
+		self.socket_timeout = None
+		self.reader = threading.Thread(target=self.read_responses,
+				name="omapi reader")
+		self.reader.daemon = True
+		self.reader.start()
+
+	def close(self):
+		"""Close the connection, drop cached handles, fail all outstanding
+		requests and wait for the reader thread to finish."""
+		with self.lock:
+			connection, self.connection = self.connection, None
+			pending, self.pending = self.pending, {}
+		with self.handles_lock:
+			self.handles = {}
+			self.generation += 1
+		if connection:
+			try: # wakes up the reader
+				connection.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+			connection.close()
+		for _, future, _ in pending.values():
+			future.set_exception(OmapiError("connection closed"))
+		reader, self.reader = self.reader, None
+		if reader is not None and reader is not threading.current_thread():
+			reader.join()
+
+	def read_responses(self):
+		"""Body of the reader thread. Responses to unknown transmission
+		ids, e.g. of requests failed by a previous close, are dropped.
+		"""
+		try:
+			while True:
+				response = self.receive_message()
+				if self.debug:
+					print "debug recv"
+					response.dump()
+				with self.lock:
+					entry = self.pending.pop(response.rid, None)
+				if entry is None:
+					continue
+				message, future, started = entry
+				try:
+					self.check_response_authenticator(response)
+				except OmapiError, exc:
+					future.set_exception(exc)
+					continue
+				if self.metrics is not None:
+					self.metrics.record_request(message.opcode,
+							time.time() - started)
+				future.set_result(response)
+		except Exception:
+			self.close()
+
+	def query_server_async(self, message):
+		"""Send the message without waiting for its response.
 		@type message: OmapiMessage
-		@type sign: bool
-		@param sign: whether the message needs to be signed
+		@rtype: OmapiFuture
+		@returns: a future for the response
 		@raises OmapiError:
 		@raises socket.error:
 		"""
-		self.check_connected()
-		if sign:
-			message.sign(self.authenticators[self.defauth])
-		if self.debug:
-			print "debug send"
-			message.dump()
-		self.send_conn(message.as_string())
+		return self.query_server_async_many([message])[0]
+
+	def query_server_async_many(self, messages):
+		"""Send the messages in a single write without waiting for their
+		responses.
+		@type messages: [OmapiMessage]
+		@rtype: [OmapiFuture]
+		@returns: futures for the responses
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		self.check_reconnect()
+		futures = [OmapiFuture() for _ in messages]
+		current = threading.current_thread()
+		with self.lock:
+			while self.connecting not in (None, current):
+				self.cond.wait(self.remaining_time())
+			self.check_connected()
+			self.check_generation(messages)
+			generation = self.generation
+			now = time.time()
+			for message, future in zip(messages, futures):
+				while message.tid in self.pending:
+					message.generate_tid()
+				self.pending[message.tid] = (message, future, now)
+		try:
+			data = "".join([self.encode_message(message)
+					for message in messages])
+			with self.send_lock:
+				if self.generation != generation: # reconnected meanwhile
+					raise OmapiError("connection closed")
+				self.send_conn(data)
+		except:
+			self.forget([message.tid for message in messages])
+			raise
+		return futures
 
 	def query_server(self, message):
-		"""Send the message and receive a response for it.
+		"""Send the message and wait for its response.
 		@type message: OmapiMessage
 		@rtype: OmapiMessage
 		@raises OmapiError:
+		@raises OmapiTimeoutError:
 		@raises socket.error:
 		"""
-		self.send_message(message)
-		return self.receive_response(message)
-		
+		try:
+			with self.deadline(self.timeout):
+				future = self.query_server_async(message)
+				try:
+					return future.result(self.remaining_time())
+				except OmapiTimeoutError:
+					self.forget([message.tid])
+					raise
+		except Exception, exc:
+			if self.metrics is not None:
+				self.metrics.record_error(exc)
+			raise
+
+	def forget(self, tids):
+		"""Stop waiting for the responses to the given requests. The
+		reader drops them when they arrive late.
+		@type tids: iterable of int
+		"""
+		with self.lock:
+			for tid in tids:
+				self.pending.pop(tid, None)
 
-	def initialize_authenticator(self, authenticator):
+	def query_server_pipelined(self, messages, depth=None):
+		"""Send the given messages without waiting for the individual
+		responses. Other threads may use the connection at the same time.
+		Once at most half of depth messages of this call are in flight,
+		the pipeline is refilled with a single write.
+		@type messages: [OmapiMessage]
+		@type depth: int or None
+		@param depth: maximum number of messages of this call in flight,
+				defaults to self.pipeline_depth
+		@rtype: [OmapiMessage]
+		@returns: the responses in the order of the given messages
+		@raises OmapiError:
+		@raises OmapiTimeoutError:
+		@raises socket.error:
 		"""
-		@type authenticator: OmapiAuthenticatorBase
+		messages = list(messages)
+		if depth is None:
+			depth = self.pipeline_depth
+		if depth < 1:
+			raise ValueError("pipeline depth must be positive")
+		futures = []
+		oldest = 0 # all futures before it are done
+		try:
+			with self.deadline(self.timeout):
+				while len(futures) < len(messages):
+					while oldest < len(futures) and futures[oldest].done():
+						oldest += 1
+					free = depth - (len(futures) - oldest)
+					if len(futures) - oldest > depth // 2:
+						if not futures[oldest].wait(self.remaining_time()):
+							raise OmapiTimeoutError()
+						continue
+					futures.extend(self.query_server_async_many(
+							messages[len(futures):len(futures) + free]))
+				return [future.result(self.remaining_time())
+						for future in futures]
+		except Exception, exc:
+			if isinstance(exc, OmapiTimeoutError):
+				self.forget([message.tid
+						for message in messages[:len(futures)]])
+			if self.metrics is not None:
+				self.metrics.record_error(exc)
+			raise
+
+class OmapiPeer:
+	"""A server of an OmapiFailover client. All operations on its
+	connection run serially on a dedicated worker thread.
+	"""
+	def __init__(self, hostname, port, username=None, key=None,
+			algorithm="hmac-md5.SIG-ALG.REG.INT.", timeout=None,
+			connect_timeout=None):
+		"""
+		@type hostname: str
+		@type port: int
+		@type username: str or None
+		@type key: str or None
+		@type algorithm: str
+		@type timeout: float or None
+		@param timeout: see Omapi.__init__
+		@type connect_timeout: float or None
+		@param connect_timeout: see Omapi.__init__
+		"""
+		self.hostname = hostname
+		self.port = port
+		self.username = username
+		self.key = key
+		self.algorithm = algorithm
+		self.timeout = timeout
+		self.connect_timeout = connect_timeout
+		self.omapi = None
+		self.healthy = False
+		self.latencies = collections.deque(maxlen=100) # seconds
+		self.queue = collections.deque()
+		self.cond = threading.Condition()
+		self.stopped = False
+		self.thread = threading.Thread(target=self.run,
+				name="omapi peer %s:%d" % (hostname, port))
+		self.thread.daemon = True
+		self.thread.start()
+
+	def submit(self, function, *args):
+		"""Schedule function(omapi, *args) on the worker thread. The
+		connection is (re)established first if needed.
+		@rtype: OmapiFuture
+		"""
+		future = OmapiFuture()
+		with self.cond:
+			if self.stopped:
+				future.set_exception(OmapiError("client closed"))
+				return future
+			self.queue.append((future, function, args))
+			self.cond.notify()
+		return future
+
+	def withdraw(self, future):
+		"""Remove an operation from the queue unless it has started.
+		@type future: OmapiFuture
+		@rtype: bool
+		@returns: whether the operation was withdrawn
+		"""
+		with self.cond:
+			for index, (queued, _, _) in enumerate(self.queue):
+				if queued is future:
+					del self.queue[index]
+					future.set_exception(OmapiTimeoutError())
+					return True
+		return False
+
+	def pending(self):
+		"""
+		@rtype: int
+		@returns: the number of queued operations
+		"""
+		return len(self.queue)
+
+	def run(self):
+		while True:
+			with self.cond:
+				while not self.queue and not self.stopped:
+					self.cond.wait()
+				if self.stopped:
+					break
+				future, function, args = self.queue.popleft()
+			start = time.time()
+			try:
+				if self.omapi is None:
+					self.omapi = Omapi(self.hostname, self.port,
+							self.username, self.key,
+							algorithm=self.algorithm, timeout=self.timeout,
+							connect_timeout=self.connect_timeout)
+				elif not self.omapi.connection:
+					self.omapi.connect()
+				self.healthy = True
+				result = function(self.omapi, *args)
+			except Exception, exc:
+				if self.omapi is None or not self.omapi.connection:
+					self.healthy = False
+				future.set_exception(exc)
+			else:
+				self.latencies.append(time.time() - start)
+				future.set_result(result)
+		if self.omapi is not None:
+			self.omapi.close()
+		for future, _, _ in self.queue:
+			future.set_exception(OmapiError("client closed"))
+
+	def hedge_delay(self, percentile, mindelay, maxdelay):
+		"""
+		@type percentile: float
+		@type mindelay: float
+		@type maxdelay: float
+		@rtype: float
+		@returns: the given percentile of recent latencies, bounded by
+				mindelay and maxdelay
+		"""
+		latencies = sorted(self.latencies)
+		if len(latencies) < 10:
+			return maxdelay
+		delay = latencies[int(percentile * (len(latencies) - 1))]
+		return min(max(delay, mindelay), maxdelay)
+
+	def stop(self):
+		"""Make the worker thread close the connection and exit once the
+		running operation is done. Queued operations fail."""
+		with self.cond:
+			self.stopped = True
+			self.cond.notify()
+
+	def join(self, timeout=None):
+		"""Wait until the worker thread has closed the connection.
+		@type timeout: float or None
+		"""
+		self.thread.join(timeout)
+
+__all__.append("OmapiFailover")
+class OmapiFailover:
+	"""Thread-safe client for a group of servers such as an ISC dhcpd
+	failover pair. Writes go to the primary, the first given server.
+	Lookups are balanced across healthy servers and hedged: if the first
+	server does not answer within the hedge_percentile of its recent
+	latencies, the lookup is sent to the next server as well and the
+	first definitive answer wins. Since other servers may lag behind
+	writes to the primary, a not found answer of theirs is confirmed on
+	the primary unless it is unhealthy. Servers whose connection fails are
+	ejected from the lookup rotation and probed in the background until
+	they can be reached again.
+	"""
+	def __init__(self, servers, username=None, key=None, hedge=True,
+			hedge_percentile=0.95, hedge_min_delay=0.002,
+			hedge_max_delay=0.5, probe_interval=5.0,
+			algorithm="hmac-md5.SIG-ALG.REG.INT.", timeout=None,
+			connect_timeout=None):
+		"""
+		@type servers: [(str, int)]
+		@param servers: (hostname, port) pairs, the primary first
+		@type username: str or None
+		@type key: str or None
+		@param key: if given, it must be base64 encoded
+		@type hedge: bool
+		@type hedge_percentile: float
+		@type hedge_min_delay: float
+		@type hedge_max_delay: float
+		@param hedge_max_delay: hedge delay while too few latencies are
+				known and upper bound otherwise
+		@type probe_interval: float
+		@param probe_interval: seconds between attempts to reach
+				unhealthy servers
+		@type algorithm: str
+		@param algorithm: signature algorithm of the key, see
+				hmac_algorithms
+		@type timeout: float or None
+		@param timeout: seconds an operation may take including the time
+				it waits for its server, None waits forever
+		@type connect_timeout: float or None
+		@param connect_timeout: see Omapi.__init__
+		@raises ValueError: if no servers are given
+		"""
+		if not servers:
+			raise ValueError("no servers given")
+		self.peers = [OmapiPeer(hostname, port, username, key, algorithm,
+				timeout, connect_timeout) for hostname, port in servers]
+		self.timeout = timeout
+		self.hedge = hedge
+		self.hedge_percentile = hedge_percentile
+		self.hedge_min_delay = hedge_min_delay
+		self.hedge_max_delay = hedge_max_delay
+		self.probe_interval = probe_interval
+		self.nextpeer = 0
+		self.closing = threading.Event()
+		for peer in self.peers: # connect
+			peer.submit(lambda _: None).wait(connect_timeout)
+		self.prober = threading.Thread(target=self.probe, name="omapi prober")
+		self.prober.daemon = True
+		self.prober.start()
+
+	def probe(self):
+		"""Background loop reconnecting unhealthy servers."""
+		while not self.closing.wait(self.probe_interval):
+			for peer in self.peers:
+				if not peer.healthy and not peer.pending():
+					peer.submit(lambda _: None)
+
+	def close(self):
+		"""Stop all servers and wait until their connections are closed."""
+		self.closing.set()
+		for peer in self.peers:
+			peer.stop()
+		if self.prober is not threading.current_thread():
+			self.prober.join()
+		for peer in self.peers:
+			peer.join()
+
+	def read_order(self):
+		"""
+		@rtype: [OmapiPeer]
+		@returns: healthy peers in round robin order followed by the
+				unhealthy ones
+		"""
+		count = len(self.peers)
+		self.nextpeer = start = (self.nextpeer + 1) % count
+		ordered = self.peers[start:] + self.peers[:start]
+		return [peer for peer in ordered if peer.healthy] + \
+				[peer for peer in ordered if not peer.healthy]
+
+	def read(self, function, *args):
+		"""Run a lookup with hedging and failover.
+		@raises socket.error:
+		@raises OmapiError:
+		@raises OmapiTimeoutError: if no answer arrived within timeout
+		"""
+		deadline = None if self.timeout is None else \
+				time.time() + self.timeout
+		primary = self.peers[0]
+		candidates = self.read_order()
+		peer = candidates.pop(0)
+		running = {peer.submit(function, *args): peer} # future -> peer
+		failures = []
+		notfound = None # future of a not found answer yet to be confirmed
+		while True:
+			if self.hedge and candidates:
+				timeout = peer.hedge_delay(self.hedge_percentile,
+						self.hedge_min_delay, self.hedge_max_delay)
+			else:
+				timeout = None
+			if deadline is not None:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					for future, source in running.items():
+						source.withdraw(future)
+					raise OmapiTimeoutError()
+				timeout = remaining if timeout is None else \
+						min(timeout, remaining)
+			finished = wait_any(list(running), timeout)
+			for future in finished:
+				source = running.pop(future)
+				error = future.exception()
+				if isinstance(error, OmapiErrorNotFound) and \
+						source is not primary and primary.healthy:
+					notfound = notfound or future
+					if primary in candidates: # confirm on the primary
+						candidates.remove(primary)
+						running[primary.submit(function, *args)] = primary
+					continue
+				if error is None or \
+						isinstance(error, (OmapiErrorNotFound, ValueError)):
+					return future.result() # definitive answer
+				failures.append(error)
+			if not running and not candidates:
+				if notfound is not None: # the primary could not confirm
+					return notfound.result()
+				raise failures[0]
+			if candidates and (not finished or not running):
+				# hedge after timeout or fail over after error
+				peer = candidates.pop(0)
+				running[peer.submit(function, *args)] = peer
+
+	def write(self, function, *args):
+		"""Run an operation on the primary server. If it times out before
+		it started, it is withdrawn, otherwise its outcome is unknown.
+		@raises socket.error:
+		@raises OmapiError:
+		@raises OmapiTimeoutError: if it did not finish within timeout
+		"""
+		future = self.peers[0].submit(function, *args)
+		try:
+			return future.result(self.timeout)
+		except OmapiTimeoutError:
+			self.peers[0].withdraw(future)
+			raise
+
+	def lookup_ip(self, mac):
+		"""
+		@type mac: str
+		@rtype: str
+		@raises ValueError:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		return self.read(Omapi.lookup_ip, mac)
+
+	def lookup_mac(self, ip):
+		"""
+		@type ip: str
+		@rtype: str
+		@raises ValueError:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		return self.read(Omapi.lookup_mac, ip)
+
+	def get_host(self, mac=None, ip=None, name=None):
+		"""See Omapi.get_host."""
+		return self.read(Omapi.get_host, mac, ip, name)
+
+	def get_lease(self, ip=None, mac=None):
+		"""See Omapi.get_lease."""
+		return self.read(Omapi.get_lease, ip, mac)
+
+	def refresh_host(self, mac):
+		"""See Omapi.refresh_host."""
+		return self.read(Omapi.refresh_host, mac)
+
+	def add_host(self, ip, mac):
+		"""See Omapi.add_host."""
+		return self.write(Omapi.add_host, ip, mac)
+
+	def update_host(self, mac, ip):
+		"""See Omapi.update_host."""
+		return self.write(Omapi.update_host, mac, ip)
+
+	def del_host(self, mac):
+		"""See Omapi.del_host."""
+		return self.write(Omapi.del_host, mac)
+
+	def add_hosts(self, hosts):
+		"""See Omapi.add_hosts."""
+		return self.write(Omapi.add_hosts, list(hosts))
+
+	def update_hosts(self, hosts):
+		"""See Omapi.update_hosts."""
+		return self.write(Omapi.update_hosts, list(hosts))
+
+	def del_hosts(self, macs):
+		"""See Omapi.del_hosts."""
+		return self.write(Omapi.del_hosts, list(macs))
+
+	def sync_hosts(self, desired, dry_run=False):
+		"""See Omapi.sync_hosts."""
+		return self.write(Omapi.sync_hosts, dict(desired), dry_run)
+
+__all__.append("AsyncOmapi")
+class AsyncOmapi:
+	"""OMAPI client for trollius, the asyncio backport for Python 2, which
+	must be installed to use it. It runs over asyncio streams and reuses
+	the message codec of Omapi. All query methods are coroutines, so many
+	concurrent users can share one authenticated connection. A receiver
+	task dispatches the responses by their rid. Handles of opened hosts
+	are cached per connection like in Omapi. If auto_reconnect is
+	enabled, a lost connection is reestablished by the next query and
+	lookups are retried until retry_deadline. Cancelled queries, e.g. of
+	asyncio.wait_for, are forgotten and their late responses discarded.
+	Use AsyncOmapi.connect to create a connected instance.
+	"""
+	protocol_version = Omapi.protocol_version
+	max_late_replies = Omapi.max_late_replies
+	reconnect_delay = Omapi.reconnect_delay
+	reconnect_max_delay = Omapi.reconnect_max_delay
+
+	def __init__(self, hostname, port, username=None, key=None, loop=None,
+			algorithm="hmac-md5.SIG-ALG.REG.INT.", auto_reconnect=False,
+			retry_deadline=10.0, sizelimit=None):
+		"""Create an unconnected client, see connect.
+		@type hostname: str
+		@type port: int
+		@type username: str or None
+		@type key: str or None
+		@param key: if given, it must be base64 encoded
+		@param loop: an asyncio event loop or None for the default loop
+		@type algorithm: str
+		@param algorithm: signature algorithm of the key, see
+				hmac_algorithms
+		@type auto_reconnect: bool
+		@type retry_deadline: float
+		@param retry_deadline: seconds to retry lookups and reconnects
+		@type sizelimit: int or None
+		@param sizelimit: maximum size of messages sent and received
+		@raises OmapiError: if trollius is not available
+		@raises binascii.Error: for bad base64 encoding
+		@raises ValueError: for unknown algorithms
+		"""
+		if asyncio is None:
+			raise OmapiError("trollius is not available")
+		self.hostname = hostname
+		self.port = port
+		self.loop = loop or asyncio.get_event_loop()
+		self.auto_reconnect = auto_reconnect
+		self.retry_deadline = retry_deadline
+		self.sizelimit = sizelimit
+		self.newauth = None
+		if username is not None and key is not None:
+			self.newauth = OmapiHMACAuthenticator(username, key, algorithm)
+		self.connect_lock = asyncio.Lock(loop=self.loop)
+		self.writer = None
+		self.receiver = None # task running receive
+		self.authenticators = {0: OmapiNullAuthenticator()}
+		self.defauth = 0
+		self.pending = {} # tid -> future
+		self.late_replies = set() # tids of cancelled requests
+		self.handles = {} # (type, packed key) -> handle on this connection
+		self.generation = 0 # counts closes
+
+	@classmethod
+	@coroutine
+	def connect(cls, hostname, port, username=None, key=None, loop=None,
+			algorithm="hmac-md5.SIG-ALG.REG.INT.", **kwargs):
+		"""Connect to an OMAPI server and authenticate if a username and
+		key are given. Coroutine. See __init__ for the arguments.
+		@rtype: AsyncOmapi
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		self = cls(hostname, port, username, key, loop, algorithm, **kwargs)
+		yield From(self.establish())
+		raise Return(self)
+
+	@coroutine
+	def establish(self):
+		"""Open the connection unless it is open. Concurrent callers wait
+		for the same attempt. Coroutine.
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		with (yield From(self.connect_lock)):
+			if self.writer is not None:
+				return
+			reader, writer = yield From(asyncio.open_connection(
+					self.hostname, self.port, loop=self.loop))
+			try:
+				buff = OutBuffer()
+				buff.add_net32int(self.protocol_version)
+				buff.add_net32int(4*6) # header size
+				writer.write(buff.getvalue())
+				inbuffer = InBuffer(self.sizelimit)
+				inbuffer.feed((yield From(reader.readexactly(8))))
+				protocol_version, header_size = \
+						inbuffer.parse_startup_message()
+				inbuffer.resetsize()
+				if protocol_version != self.protocol_version:
+					raise OmapiError("protocol mismatch")
+				if header_size != 4*6:
+					raise OmapiError("header size mismatch")
+			except asyncio.IncompleteReadError:
+				writer.close()
+				raise OmapiError("connection closed")
+			except:
+				writer.close()
+				raise
+			self.writer = writer
+			self.authenticators = {0: OmapiNullAuthenticator()}
+			self.defauth = 0
+			ensure_future = getattr(asyncio, "ensure_future", None) or \
+					getattr(asyncio, "async")
+			self.receiver = ensure_future(self.receive(reader, inbuffer),
+					loop=self.loop)
+			if self.newauth:
+				try:
+					yield From(self.initialize_authenticator(self.newauth))
+				except:
+					self.close()
+					raise
+
+	@coroutine
+	def receive(self, reader, inbuffer):
+		"""Body of the receiver task of a connection. Reads never exceed
+		the room left by the size limit of the inbuffer, so that a burst
+		of responses cannot exceed it. Coroutine.
+		@type reader: asyncio.StreamReader
+		@type inbuffer: InBuffer
+		"""
+		try:
+			while True:
+				if inbuffer.room() <= 0:
+					raise OmapiSizeLimitError()
+				data = yield From(reader.read(inbuffer.room()))
+				if not data:
+					raise OmapiError("connection closed")
+				inbuffer.feed(data)
+				message = inbuffer.parse_message()
+				while message is not None:
+					inbuffer.resetsize()
+					self.handle_message(message)
+					message = inbuffer.parse_message()
+		except asyncio.CancelledError:
+			pass
+		except (OmapiError, EnvironmentError), exc:
+			if self.receiver is asyncio.Task.current_task(loop=self.loop):
+				self.fail(exc)
+
+	def handle_message(self, message):
+		"""Verify a received message and resolve the future of the
+		message it responds to.
+		@type message: OmapiMessage
+		@raises OmapiError: for messages that are not valid responses
+		"""
+		if not message.verify(self.authenticators):
+			raise OmapiError("bad omapi message signature")
+		future = self.pending.pop(message.rid, None)
+		if future is None and message.rid in self.late_replies:
+			self.late_replies.remove(message.rid)
+		elif future is None:
+			raise OmapiError("received message is not a response to any " +
+					"outstanding message")
+		elif future.cancelled():
+			pass
+		elif message.authid != self.defauth:
+			future.set_exception(OmapiError("received message is " +
+					"signed with wrong authenticator"))
+		else:
+			future.set_result(message)
+
+	def fail(self, exc):
+		"""Close the connection and fail all outstanding queries.
+		@type exc: Exception
+		"""
+		for future in self.pending.values():
+			if not future.done():
+				future.set_exception(exc)
+		self.close()
+
+	def close(self):
+		"""Close the omapi connection if it is open. Outstanding queries
+		fail and cached handles are dropped."""
+		writer, self.writer = self.writer, None
+		receiver, self.receiver = self.receiver, None
+		pending, self.pending = self.pending, {}
+		self.late_replies = set()
+		self.handles = {}
+		self.generation += 1
+		if receiver is not None:
+			receiver.cancel()
+		if writer is not None:
+			writer.close()
+		for future in pending.values():
+			if not future.done():
+				future.set_exception(OmapiError("connection closed"))
+
+	def send_query(self, message):
+		"""Send the message on the current connection.
+		@type message: OmapiMessage
+		@rtype: asyncio.Future
+		@returns: a future for the response
+		@raises OmapiError:
+		@raises ValueError:
+		"""
+		if self.writer is None:
+			raise OmapiError("not connected")
+		while message.tid in self.pending or message.tid in self.late_replies:
+			message.generate_tid()
+		data = message.sign(self.authenticators[self.defauth],
+				self.sizelimit)
+		future = asyncio.Future(loop=self.loop)
+		self.pending[message.tid] = future
+		future.add_done_callback(
+				lambda future, tid=message.tid: self.forget(tid, future))
+		self.writer.write(data)
+		return future
+
+	def forget(self, tid, future):
+		"""Stop waiting for the response to a cancelled query. Too many
+		of them suggest a stuck server, so the connection is failed.
+		@type tid: int
+		@type future: asyncio.Future
+		"""
+		if not future.cancelled() or self.pending.get(tid) is not future:
+			return
+		del self.pending[tid]
+		self.late_replies.add(tid)
+		if len(self.late_replies) > self.max_late_replies:
+			self.fail(OmapiError("too many cancelled requests"))
+
+	@coroutine
+	def check_reconnect(self):
+		"""Reconnect if the connection was lost and auto_reconnect is
+		enabled. Coroutine.
+		@raises OmapiError: if not connected
+		@raises socket.error:
+		"""
+		if self.writer is None and self.auto_reconnect:
+			yield From(self.establish())
+		if self.writer is None:
+			raise OmapiError("not connected")
+
+	@coroutine
+	def query_server(self, message):
+		"""Send the message and wait for its response. Coroutine.
+		@type message: OmapiMessage
+		@rtype: OmapiMessage
+		@raises OmapiError:
+		@raises ValueError:
+		@raises socket.error:
+		"""
+		yield From(self.check_reconnect())
+		response = yield From(self.send_query(message))
+		raise Return(response)
+
+	@coroutine
+	def retry_idempotent(self, function, *args):
+		"""Run the coroutine function and, if auto_reconnect is enabled,
+		retry it with backoff until retry_deadline whenever it fails in a
+		way that closed the connection. Coroutine.
 		@raises OmapiError:
 		@raises socket.error:
 		"""
+		deadline = time.time() + self.retry_deadline
+		delay = self.reconnect_delay
+		while True:
+			try:
+				result = yield From(function(*args))
+				raise Return(result)
+			except (OmapiError, EnvironmentError):
+				if not self.auto_reconnect or self.writer is not None or \
+						time.time() + delay > deadline:
+					raise
+			yield From(asyncio.sleep(sysrand.uniform(0, delay),
+					loop=self.loop))
+			delay = min(2 * delay, self.reconnect_max_delay)
+
+	@coroutine
+	def initialize_authenticator(self, authenticator):
+		"""Coroutine.
+		@type authenticator: OmapiAuthenticatorBase
+		@raises OmapiError:
+		"""
 		msg = OmapiMessage.open("authenticator")
 		msg.update_object(authenticator.auth_object())
-		response = self.query_server(msg)
+		response = yield From(self.send_query(msg))
 		if response.opcode != OMAPI_OP_UPDATE:
 			raise OmapiError("received non-update response for open")
 		authid = response.handle
@@ -742,106 +4073,196 @@ class Omapi:
 		authenticator.authid = authid
 		self.defauth = authid
 
-	def add_host(self, ip, mac):
+	@coroutine
+	def query_by_handle(self, key, open_message, request, fallback=None):
+		"""See Omapi.query_by_handle. Coroutine.
+		@rtype: (int, OmapiMessage)
+		@raises OmapiError:
+		@raises socket.error:
 		"""
+		yield From(self.check_reconnect())
+		generation = self.generation
+		handle = self.handles.get(key)
+		if handle is not None: # read and sent on the same connection
+			response = yield From(self.send_query(request(handle)))
+			if not response.is_stale():
+				raise Return((handle, response))
+			if self.handles.get(key) == handle:
+				del self.handles[key]
+			yield From(self.check_reconnect())
+			generation = self.generation
+		response = yield From(self.send_query(open_message))
+		if (response.opcode != OMAPI_OP_UPDATE or response.handle == 0) \
+				and fallback is not None:
+			open_message = fallback
+			response = yield From(self.send_query(fallback))
+		if response.opcode != OMAPI_OP_UPDATE or response.handle == 0:
+			raise Return((0, response))
+		handle = response.handle
+		if generation == self.generation:
+			self.handles[key] = handle
+		if open_message is fallback:
+			raise Return((handle, response))
+		response = yield From(self.send_query(request(handle)))
+		raise Return((handle, response))
+
+	@coroutine
+	def add_host(self, ip, mac):
+		"""Coroutine.
 		@type ip: str
 		@type mac: str
-		@type name: str
 		@raises ValueError:
 		@raises OmapiError:
 		@raises socket.error:
 		"""
-		msg = OmapiMessage.open("host")
-		msg.message.append(("create", struct.pack("!I", 1)))
-		msg.message.append(("exclusive", struct.pack("!I", 1)))
-		msg.obj.append(("hardware-address", pack_mac(mac)))
-		msg.obj.append(("hardware-type", struct.pack("!I", 1)))
-		msg.obj.append(("ip-address", pack_ip(ip)))
-
-		response = self.query_server(msg)
+		packed_mac = pack_mac(mac)
+		yield From(self.check_reconnect())
+		generation = self.generation
+		response = yield From(self.send_query(create_host_message(
+				packed_mac, pack_ip(ip))))
 		if response.opcode != OMAPI_OP_UPDATE:
 			raise OmapiError("add failed")
+		if response.handle != 0 and generation == self.generation:
+			self.handles[("host", packed_mac)] = response.handle
 
+	@coroutine
 	def update_host(self, mac, ip):
-		"""
+		"""Update a host or add it if it does not exist. Coroutine.
 		@type mac: str
 		@type ip: str
-		@type name: str
 		@raises ValueError:
 		@raises OmapiError:
 		@raises socket.error:
 		"""
-		msg = OmapiMessage.open("host")
-		msg.obj.append(("hardware-address", pack_mac(mac)))
-
-		response = self.query_server(msg)
-
-		if response.opcode != OMAPI_OP_UPDATE:
-			# This host does not exist
-			return self.add_host(ip, mac)
-
-		update = OmapiMessage.update(response.handle)
-
-		update.obj = [('ip-address', pack_ip(ip))]
-
-		response = self.query_server(update)
-
-		if response.opcode != OMAPI_OP_STATUS:
-			raise OmapiError('Could not update host with mac: ' + mac)
+		packed_mac, packed_ip = pack_mac(mac), pack_ip(ip)
+		handle, response = yield From(self.query_by_handle(
+				("host", packed_mac), host_by_mac_template.build([packed_mac]),
+				lambda handle: update_ip_message(handle, packed_ip),
+				create_host_message(packed_mac, packed_ip)))
+		if handle == 0:
+			raise OmapiError("add failed")
+		if response.opcode not in (OMAPI_OP_UPDATE, OMAPI_OP_STATUS) or \
+				response.result() != ISC_R_SUCCESS:
+			raise OmapiError('Could not update host with mac: %s' % (mac,))
 
+	@coroutine
 	def del_host(self, mac):
-		"""
+		"""Coroutine.
 		@type mac: str
 		@raises ValueError:
+		@raises OmapiErrorNotFound:
 		@raises OmapiError:
 		@raises socket.error:
 		"""
-		msg = OmapiMessage.open("host")
-		msg.obj.append(("hardware-address", pack_mac(mac)))
-		msg.obj.append(("hardware-type", struct.pack("!I", 1)))
-		response = self.query_server(msg)
-		if response.opcode != OMAPI_OP_UPDATE:
-			raise OmapiErrorNotFound()
-		if response.handle == 0:
+		packed_mac = pack_mac(mac)
+		key = ("host", packed_mac)
+		handle, response = yield From(self.query_by_handle(key,
+				ethernet_host_template.build([packed_mac]),
+				OmapiMessage.delete))
+		if handle == 0:
+			if response.opcode != OMAPI_OP_UPDATE:
+				raise OmapiErrorNotFound()
 			raise OmapiError("received invalid handle from server")
-		response = self.query_server(OmapiMessage.delete(response.handle))
-		if response.opcode != OMAPI_OP_STATUS:
+		if self.handles.get(key) == handle:
+			del self.handles[key]
+		if response.opcode != OMAPI_OP_STATUS or \
+				response.result() != ISC_R_SUCCESS:
 			raise OmapiError("delete failed")
 
-	def lookup_ip(self, mac):
+	@coroutine
+	def refresh_host(self, mac):
+		"""See Omapi.refresh_host. Coroutine.
+		@rtype: OmapiObject
 		"""
-		@type mac: str
-		@rtype: str or None
-		@raises ValueError:
+		packed_mac = pack_mac(mac)
+		handle, response = yield From(self.query_by_handle(
+				("host", packed_mac), host_by_mac_template.build([packed_mac]),
+				OmapiMessage.refresh))
+		if handle == 0 or response.opcode != OMAPI_OP_UPDATE:
+			raise OmapiErrorNotFound()
+		raise Return(response.object_view())
+
+	@coroutine
+	def query_object(self, msg):
+		"""Coroutine.
+		@type msg: OmapiMessage
+		@param msg: an open message
+		@rtype: OmapiObject
+		@returns: all attributes of the object
+		@raises OmapiErrorNotFound:
 		@raises OmapiError:
 		@raises socket.error:
 		"""
-		msg = OmapiMessage.open("host")
-		msg.obj.append(("hardware-address", pack_mac(mac)))
-		response = self.query_server(msg)
+		response = yield From(self.query_server(msg))
 		if response.opcode != OMAPI_OP_UPDATE:
 			raise OmapiErrorNotFound()
+		raise Return(response.object_view())
+
+	def open_object(self, typename, criteria):
+		"""Open an object, see Omapi.open_object. Coroutine.
+		@type typename: str
+		@type criteria: [(str, str)]
+		@rtype: OmapiObject
+		"""
+		return self.retry_idempotent(
+				lambda: self.query_object(open_message(typename, criteria)))
+
+	def open_template(self, template, values):
+		"""Like open_object, but with a message built from a template.
+		Coroutine.
+		@type template: OmapiMessageTemplate
+		@type values: [str]
+		@rtype: OmapiObject
+		"""
+		return self.retry_idempotent(
+				lambda: self.query_object(template.build(values)))
+
+	def get_host(self, mac=None, ip=None, name=None):
+		"""See Omapi.get_host. Coroutine.
+		@rtype: OmapiObject
+		@raises ValueError:
+		"""
+		return self.open_object("host", object_criteria(mac, ip, name))
+
+	def get_lease(self, ip=None, mac=None):
+		"""See Omapi.get_lease. Coroutine.
+		@rtype: OmapiObject
+		@raises ValueError:
+		"""
+		return self.open_object("lease", object_criteria(mac, ip))
+
+	@coroutine
+	def lookup_ip(self, mac):
+		"""Coroutine.
+		@type mac: str
+		@rtype: str
+		@raises ValueError:
+		@raises OmapiErrorNotFound:
+		@raises OmapiError:
+		@raises socket.error:
+		"""
+		obj = yield From(self.open_template(host_by_mac_template,
+				[pack_mac(mac)]))
 		try:
-			return unpack_ip(dict(response.obj)["ip-address"])
-		except KeyError: # ip-address
+			raise Return(obj["ip-address"])
+		except KeyError:
 			raise OmapiErrorNotFound()
 
+	@coroutine
 	def lookup_mac(self, ip):
-		"""
+		"""Coroutine.
 		@type ip: str
-		@rtype: str or None
+		@rtype: str
 		@raises ValueError:
+		@raises OmapiErrorNotFound:
 		@raises OmapiError:
 		@raises socket.error:
 		"""
-		msg = OmapiMessage.open("host")
-		msg.obj.append(("ip-address", pack_ip(ip)))
-		response = self.query_server(msg)
-		if response.opcode != OMAPI_OP_UPDATE:
-			raise OmapiErrorNotFound()
+		obj = yield From(self.open_template(host_by_ip_template,
+				[pack_ip(ip)]))
 		try:
-			return unpack_mac(dict(response.obj)["hardware-address"])
-		except KeyError: # hardware-address
+			raise Return(obj["hardware-address"])
+		except KeyError:
 			raise OmapiErrorNotFound()
 
 if __name__ == '__main__':
@@ -0,0 +1,495 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Bulk application of host records to an OMAPI server.
+
+Records are streamed from CSV or JSON lines input and applied with the
+semantics of Omapi.add_host, Omapi.update_host and Omapi.del_host over
+a number of parallel authenticated connections, each sending pipelined
+batches. All records for one mac address go to the same connection in
+input order, so their relative order is preserved.
+
+CSV rows are "action,mac,ip", "mac,ip" (an update) or "delete,mac". A
+leading header row naming the columns is skipped. JSON lines are objects
+with the keys "mac", "ip" and optionally "action". Actions are "add",
+"update" (the default, adding missing hosts) and "delete".
+
+Progress is reported periodically on stderr. If a checkpoint file is
+given, the numbers of all applied records are saved there, so an
+interrupted run started again with the same input and checkpoint skips
+them. Failed records, e.g. rejected by the server or in a batch that
+failed as a whole because the server could not be reached, are not
+recorded and are retried on the next run.
+
+Usage:
+	pypureomapi-bulk --server host[:port] --user name --key-file file
+			[--connections 4] [--checkpoint file] records.csv
+"""
+
+__author__      = "Helmut Grohne, Torge Szczepanek"
+__copyright__   = "Cygnus Networks GmbH"
+__licence__     = "GPL-3"
+__version__     = "0.1"
+__maintainer__  = "Torge Szczepanek"
+__email__       = "info@cygnusnetworks.de"
+
+__all__ = []
+
+import os
+import sys
+import csv
+import json
+import time
+import bisect
+import socket
+import optparse
+import threading
+import Queue
+
+from pypureomapi import Omapi, OmapiError, OmapiErrorNotFound, pack_ip, \
+		pack_mac
+
+actions = ("add", "update", "delete")
+
+__all__.append("BatchFailed")
+class BatchFailed(Exception):
+	"""A record was not applied, because its batch failed as a whole."""
+
+def read_csv(lines):
+	"""
+	>>> list(read_csv(["action,mac,ip", "add,0:1:2:3:4:5,10.0.0.1",
+	...     "0:1:2:3:4:6,10.0.0.2", "delete,0:1:2:3:4:7"]))
+	[None, ('add', '0:1:2:3:4:5', '10.0.0.1'), ('update', '0:1:2:3:4:6', '10.0.0.2'), ('delete', '0:1:2:3:4:7', None)]
+
+	@type lines: iterable of str
+	@rtype: iterable of (str, str, str or None)
+	@returns: (action, mac, ip) for every row or None for empty and
+			header rows, so that record numbers match row numbers
+	@raises ValueError: for rows not matching any of the formats
+	"""
+	for number, row in enumerate(csv.reader(lines)):
+		row = [field.strip() for field in row]
+		if not row or row == [""] or \
+				(number == 0 and row[0].lower() in ("action", "mac")):
+			yield None
+			continue
+		if row[0].lower() in actions:
+			action, row = row[0].lower(), row[1:]
+		else:
+			action = "update"
+		if len(row) == 2 and action != "delete":
+			yield action, row[0], row[1]
+		elif len(row) == 1 and action == "delete":
+			yield action, row[0], None
+		else:
+			raise ValueError("malformed csv row %d" % (number + 1))
+
+def read_jsonl(lines):
+	"""
+	>>> list(read_jsonl(['{"mac": "0:1:2:3:4:5", "ip": "10.0.0.1"}']))
+	[('update', u'0:1:2:3:4:5', u'10.0.0.1')]
+
+	@type lines: iterable of str
+	@rtype: iterable of (str, str, str or None)
+	@returns: (action, mac, ip) for every line or None for empty lines
+	@raises ValueError: for malformed lines
+	"""
+	for number, line in enumerate(lines):
+		if not line.strip():
+			yield None
+			continue
+		try:
+			record = json.loads(line)
+			action = record.get("action", "update")
+			mac, ip = record["mac"], record.get("ip")
+		except (ValueError, KeyError, AttributeError):
+			raise ValueError("malformed json line %d" % (number + 1))
+		if action not in actions:
+			raise ValueError("unknown action on line %d" % (number + 1))
+		yield action, mac, ip
+
+class Checkpoint:
+	"""Set of applied record numbers, kept as sorted disjoint ranges.
+
+	>>> checkpoint = Checkpoint()
+	>>> for number in (0, 1, 5, 2, 4):
+	...     checkpoint.add(number)
+	>>> checkpoint.ranges()
+	[[0, 3], [4, 6]]
+	>>> checkpoint.contains(3), checkpoint.contains(4)
+	(False, True)
+	"""
+	def __init__(self, path=None, source="-"):
+		"""
+		@type path: str or None
+		@param path: file to load from and save to
+		@type source: str
+		@param source: name of the input the record numbers refer to
+		@raises ValueError: for malformed checkpoint files or those
+				written for a different input
+		@raises IOError:
+		"""
+		self.path = path
+		self.source = source
+		self.starts = []
+		self.ends = [] # exclusive
+		if path is not None and os.path.exists(path):
+			with open(path) as checkpoint:
+				state = json.load(checkpoint)
+			if state.get("source") != source:
+				raise ValueError("checkpoint %s belongs to input %s" %
+						(path, state.get("source")))
+			for start, end in state["done"]:
+				self.starts.append(start)
+				self.ends.append(end)
+
+	def contains(self, number):
+		"""
+		@type number: int
+		@rtype: bool
+		"""
+		position = bisect.bisect_right(self.starts, number) - 1
+		return position >= 0 and number < self.ends[position]
+
+	def add(self, number):
+		"""
+		@type number: int
+		"""
+		position = bisect.bisect_right(self.starts, number) - 1
+		if position >= 0 and number < self.ends[position]:
+			return
+		if position >= 0 and self.ends[position] == number:
+			self.ends[position] += 1
+		else:
+			position += 1
+			self.starts.insert(position, number)
+			self.ends.insert(position, number + 1)
+		if position + 1 < len(self.starts) and \
+				self.starts[position + 1] == self.ends[position]:
+			self.ends[position] = self.ends.pop(position + 1)
+			del self.starts[position + 1]
+
+	def copy(self):
+		"""
+		@rtype: Checkpoint
+		@returns: a copy of the applied ranges that is never saved
+		"""
+		other = Checkpoint(None, self.source)
+		other.starts = list(self.starts)
+		other.ends = list(self.ends)
+		return other
+
+	def ranges(self):
+		"""
+		@rtype: [[int, int]]
+		@returns: [start, end) ranges of applied record numbers
+		"""
+		return map(list, zip(self.starts, self.ends))
+
+	def save(self):
+		"""Atomically write the checkpoint file if a path was given.
+		@raises IOError:
+		"""
+		if self.path is None:
+			return
+		tmppath = self.path + ".tmp"
+		with open(tmppath, "w") as output:
+			json.dump(dict(source=self.source, done=self.ranges()), output)
+		os.rename(tmppath, self.path)
+
+class Progress:
+	"""Thread-safe accounting of applied records, reporting throughput
+	and errors and saving the checkpoint periodically. Only applied
+	records enter the checkpoint, so failed ones are retried on resume.
+
+	>>> import StringIO
+	>>> errors = StringIO.StringIO()
+	>>> progress = Progress(Checkpoint(), errors, StringIO.StringIO())
+	>>> progress.record_batch([(0, ("update", "00:00:00:00:00:01", "10.0.0.1")),
+	...         (1, ("delete", "00:00:00:00:00:02", None))],
+	...         [None, OmapiErrorNotFound()])
+	>>> progress.checkpoint.ranges(), progress.applied, progress.failed
+	([[0, 1]], 1, 1)
+	>>> errors.getvalue()
+	'line 2 delete,00:00:00:00:00:02,: not found\\n'
+	"""
+	def __init__(self, checkpoint, errors=sys.stderr, report=sys.stderr,
+			interval=5.0):
+		"""
+		@type checkpoint: Checkpoint
+		@type errors: file
+		@param errors: receives one line per failed record
+		@type report: file
+		@type interval: float
+		@param interval: seconds between progress reports and saves
+		"""
+		self.checkpoint = checkpoint
+		self.errors = errors
+		self.report = report
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.started = self.last = time.time()
+		self.applied = self.lastapplied = 0
+		self.failed = 0
+		self.unapplied = 0
+
+	def record_batch(self, batch, results):
+		"""
+		@type batch: [(int, (str, str, str or None))]
+		@param batch: numbered records
+		@type results: [Exception or None]
+		@param results: for each record None or its error. Only records
+				without error are recorded in the checkpoint.
+		"""
+		with self.lock:
+			for (number, record), error in zip(batch, results):
+				if error is None:
+					self.checkpoint.add(number)
+					self.applied += 1
+				elif isinstance(error, BatchFailed):
+					self.unapplied += 1
+				if error is not None:
+					self.failed += 1
+					self.errors.write("line %d %s: %s\n" % (number + 1,
+							",".join(field or "" for field in record),
+							error))
+			now = time.time()
+			if now - self.last >= self.interval:
+				self.report.write("%d records applied, %d errors, %.0f "
+						"records/s\n" % (self.applied, self.failed,
+						(self.applied - self.lastapplied) / (now - self.last)))
+				self.last, self.lastapplied = now, self.applied
+				self.checkpoint.save()
+
+	def finish(self):
+		with self.lock:
+			self.checkpoint.save()
+			duration = max(time.time() - self.started, 1e-9)
+			self.report.write("%d records applied in %.1fs (%.0f records/s), "
+					"%d errors, %d not applied\n" % (self.applied, duration,
+					self.applied / duration, self.failed, self.unapplied))
+
+def confirm_retried(omapi, action, records, results):
+	"""Records of a retried run may have been applied by the failed
+	attempt already. A retried delete then fails as not found and a
+	retried add fails, because the host exists. Such records are
+	checked on the server and counted as applied.
+	@type omapi: Omapi
+	@type action: str
+	@type records: [(str, str, str or None)]
+	@type results: [Exception or None]
+	@param results: of the retry
+	@rtype: [Exception or None]
+	"""
+	confirmed = []
+	for (_, mac, ip), error in zip(records, results):
+		if action == "delete" and isinstance(error, OmapiErrorNotFound):
+			error = None
+		elif action == "add" and isinstance(error, OmapiError):
+			try:
+				if pack_ip(omapi.fetch_ip(mac)) == pack_ip(ip):
+					error = None
+			except (socket.error, ValueError, OmapiError):
+				pass
+		confirmed.append(error)
+	return confirmed
+
+def apply_batch(omapi, batch, retries=2):
+	"""Apply numbered records over one connection. Runs of consecutive
+	records with the same action are sent as one pipelined bulk
+	operation. Runs failing as a whole are retried after reconnecting,
+	see confirm_retried.
+	@type omapi: Omapi
+	@param omapi: a client with auto_reconnect enabled
+	@type batch: [(int, (str, str, str or None))]
+	@type retries: int
+	@rtype: [Exception or None]
+	@returns: for each record None on success or its error, which is a
+			BatchFailed if its run failed as a whole
+	"""
+	results = []
+	start = 0
+	while start < len(batch):
+		action = batch[start][1][0]
+		end = start + 1
+		while end < len(batch) and batch[end][1][0] == action:
+			end += 1
+		records = [record for _, record in batch[start:end]]
+		for attempt in range(retries + 1):
+			try:
+				if action == "delete":
+					run = omapi.del_hosts([mac for _, mac, _ in records])
+				elif action == "add":
+					run = omapi.add_hosts([(mac, ip) for _, mac, ip in records])
+				else:
+					run = omapi.update_hosts([(mac, ip)
+							for _, mac, ip in records])
+			except (socket.error, OmapiError), exc:
+				run = [BatchFailed(str(exc))] * len(records)
+			else:
+				if attempt > 0:
+					run = confirm_retried(omapi, action, records, run)
+				break
+		results.extend(run)
+		start = end
+	return results
+
+def shard(mac, count):
+	"""
+	@type mac: str
+	@type count: int
+	@rtype: int
+	@returns: the connection responsible for the given mac address
+	"""
+	try:
+		return hash(pack_mac(mac)) % count
+	except ValueError:
+		return 0
+
+def worker(omapi, queue, progress, retries):
+	"""Apply batches from queue until None is received.
+	@type omapi: Omapi
+	@type queue: Queue.Queue
+	@type progress: Progress
+	@type retries: int
+	"""
+	while True:
+		batch = queue.get()
+		if batch is None:
+			return
+		progress.record_batch(batch, apply_batch(omapi, batch, retries))
+
+def run(records, omapis, progress, batchsize=256, retries=2):
+	"""Apply records over the given connections.
+	@type records: iterable of (str, str, str or None) or None
+	@param records: None entries are skipped but counted
+	@type omapis: [Omapi]
+	@type progress: Progress
+	@type batchsize: int
+	@type retries: int
+	"""
+	queues = [Queue.Queue(4) for _ in omapis]
+	threads = [threading.Thread(target=worker,
+			args=(omapi, queue, progress, retries))
+			for omapi, queue in zip(omapis, queues)]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	done = progress.checkpoint.copy() # workers modify the checkpoint
+	pending = [[] for _ in omapis]
+	try:
+		for number, record in enumerate(records):
+			if record is None or done.contains(number):
+				continue
+			index = shard(record[1], len(omapis))
+			pending[index].append((number, record))
+			if len(pending[index]) >= batchsize:
+				queues[index].put(pending[index])
+				pending[index] = []
+	finally:
+		for queue, batch in zip(queues, pending):
+			if batch:
+				queue.put(batch)
+			queue.put(None)
+		for thread in threads:
+			while thread.is_alive(): # join without blocking signals
+				thread.join(1)
+
+def parse_server(server):
+	"""
+	>>> parse_server("dhcp.example.org"), parse_server("127.0.0.1:7912")
+	(('dhcp.example.org', 7911), ('127.0.0.1', 7912))
+
+	@type server: str
+	@rtype: (str, int)
+	@raises ValueError:
+	"""
+	hostname, _, port = server.partition(":")
+	return hostname, int(port or 7911)
+
+def main(argv):
+	parser = optparse.OptionParser(usage="%prog [options] [FILE]",
+			description="Apply host records from FILE or stdin to an OMAPI "
+			"server.")
+	parser.add_option("--server", default="127.0.0.1",
+			help="OMAPI server as host[:port] [default: %default]")
+	parser.add_option("--user", help="OMAPI key name")
+	parser.add_option("--key", help="base64 encoded OMAPI key")
+	parser.add_option("--key-file", metavar="FILE",
+			help="read the base64 encoded OMAPI key from FILE")
+	parser.add_option("--algorithm", default="hmac-md5.SIG-ALG.REG.INT.",
+			help="signature algorithm of the key [default: %default]")
+	parser.add_option("--format", choices=("csv", "jsonl"),
+			help="input format, guessed from the file name by default")
+	parser.add_option("--connections", type="int", default=4,
+			help="number of parallel connections [default: %default]")
+	parser.add_option("--batch", type="int", default=256,
+			help="records per pipelined batch [default: %default]")
+	parser.add_option("--retries", type="int", default=2,
+			help="retries of batches failing as a whole "
+			"[default: %default]")
+	parser.add_option("--checkpoint", metavar="FILE",
+			help="record applied records in FILE and skip those already "
+			"recorded")
+	parser.add_option("--errors", metavar="FILE",
+			help="write failed records to FILE instead of stderr")
+	parser.add_option("--interval", type="float", default=5.0,
+			help="seconds between progress reports [default: %default]")
+	options, args = parser.parse_args(argv)
+	if len(args) > 1:
+		parser.error("at most one input file expected")
+	if options.connections < 1 or options.batch < 1:
+		parser.error("connections and batch must be positive")
+	if options.key_file:
+		with open(options.key_file) as keyfile:
+			options.key = keyfile.read().strip()
+	if (options.user is None) != (options.key is None):
+		parser.error("user and key must be given together")
+	try:
+		hostname, port = parse_server(options.server)
+	except ValueError:
+		parser.error("invalid server %r" % options.server)
+	path = args[0] if args else "-"
+	fmt = options.format or ("jsonl" if path.endswith((".jsonl", ".json"))
+			else "csv")
+
+	try:
+		checkpoint = Checkpoint(options.checkpoint, path)
+	except ValueError, exc:
+		parser.error(str(exc))
+	try:
+		omapis = [Omapi(hostname, port, options.user, options.key,
+				auto_reconnect=True, algorithm=options.algorithm)
+				for _ in range(options.connections)]
+	except (socket.error, OmapiError, ValueError), exc:
+		sys.stderr.write("cannot connect to %s: %s\n" % (options.server, exc))
+		return 2
+	errors = open(options.errors, "w") if options.errors else sys.stderr
+	progress = Progress(checkpoint, errors, interval=options.interval)
+	source = sys.stdin if path == "-" else open(path)
+	try:
+		reader = read_jsonl if fmt == "jsonl" else read_csv
+		try:
+			run(reader(source), omapis, progress, options.batch,
+					options.retries)
+		except ValueError, exc:
+			sys.stderr.write("%s\n" % exc)
+			return 2
+		except KeyboardInterrupt: # queued batches were still applied
+			sys.stderr.write("interrupted\n")
+			return 130
+		finally:
+			progress.finish()
+	finally:
+		for omapi in omapis:
+			omapi.close()
+		if errors is not sys.stderr:
+			errors.close()
+		if source is not sys.stdin:
+			source.close()
+	return 1 if progress.failed or progress.unapplied else 0
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
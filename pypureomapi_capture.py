@@ -0,0 +1,314 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Recording of raw OMAPI traffic and its offline replay.
+
+An OmapiRecorder passed to Omapi (or any of its subclasses) as recorder
+writes every chunk of data sent or received by the client, with the
+time it was sent or received, to a capture file. Chunks are recorded as
+returned by recv, so a capture preserves the segmentation of the real
+traffic. replay feeds a capture back through InBuffer.parse_message and
+OmapiMessage.verify without a server, which allows reproducing parser
+and verification problems and benchmarking them against real traffic.
+
+Capture file format:
+
+magic (8 bytes, "OMAPICAP")
+version (netint32)
+records: kind (1 byte) time (network order double) length (netint32)
+		data (length bytes)
+
+The kinds are "c" for a new connection (without data), "s" for data
+sent and "r" for data received. A truncated last record, e.g. of a
+recording process that was killed, is ignored.
+
+Usage:
+	pypureomapi-replay [--user name --key-file file] [--repeat 10]
+			[--chunk-size 1] [--direction both] [--dump] capture
+"""
+
+__author__      = "Helmut Grohne, Torge Szczepanek"
+__copyright__   = "Cygnus Networks GmbH"
+__licence__     = "GPL-3"
+__version__     = "0.1"
+__maintainer__  = "Torge Szczepanek"
+__email__       = "info@cygnusnetworks.de"
+
+__all__ = []
+
+import sys
+import time
+import struct
+import optparse
+import threading
+
+from pypureomapi import InBuffer, OmapiError, OmapiHMACAuthenticator, \
+		OmapiNullAuthenticator, repr_opcode
+
+capture_magic = "OMAPICAP"
+capture_version = 1
+capture_header = struct.Struct("!8sL") # magic, version
+record_header = struct.Struct("!cdL") # kind, time, length
+
+kind_connect = "c"
+kind_sent = "s"
+kind_received = "r"
+kinds = (kind_connect, kind_sent, kind_received)
+
+__all__.append("OmapiRecorder")
+class OmapiRecorder:
+	"""Thread-safe writer of capture files. Once the capture would exceed
+	maxbytes, recording stops, so that a capture never ends in the middle
+	of a stream.
+	"""
+	def __init__(self, output, maxbytes=None):
+		"""
+		@type output: str or file
+		@param output: path of the capture file or a file opened for
+				binary writing
+		@type maxbytes: int or None
+		@raises IOError:
+		"""
+		if isinstance(output, basestring):
+			output = open(output, "wb")
+		self.output = output
+		self.maxbytes = maxbytes
+		self.lock = threading.Lock()
+		self.output.write(capture_header.pack(capture_magic, capture_version))
+		self.size = capture_header.size
+		self.stopped = False
+
+	def record(self, kind, data):
+		"""
+		@type kind: str
+		@param kind: one of kinds
+		@type data: str
+		@raises IOError:
+		"""
+		with self.lock:
+			if self.stopped:
+				return
+			length = record_header.size + len(data)
+			if self.maxbytes is not None and \
+					self.size + length > self.maxbytes:
+				self.stopped = True
+				return
+			self.output.write(record_header.pack(kind, time.time(),
+					len(data)))
+			self.output.write(data)
+			self.size += length
+
+	def record_connect(self):
+		self.record(kind_connect, "")
+
+	def record_sent(self, data):
+		self.record(kind_sent, data)
+
+	def record_received(self, data):
+		self.record(kind_received, data)
+
+	def flush(self):
+		with self.lock:
+			self.output.flush()
+
+	def close(self):
+		with self.lock:
+			self.stopped = True
+			self.output.close()
+
+__all__.append("read_capture")
+def read_capture(infile):
+	"""
+	@type infile: file
+	@param infile: a capture file opened for binary reading
+	@rtype: iterable of (str, float, str)
+	@returns: (kind, time, data) for each record
+	@raises ValueError: if the file is not a capture of a supported version
+			or contains an invalid record
+	@raises IOError:
+	"""
+	header = infile.read(capture_header.size)
+	if len(header) != capture_header.size or \
+			capture_header.unpack(header) != (capture_magic, capture_version):
+		raise ValueError("not a capture file of a supported version")
+	while True:
+		header = infile.read(record_header.size)
+		if len(header) != record_header.size:
+			return
+		kind, timestamp, length = record_header.unpack(header)
+		if kind not in kinds:
+			raise ValueError("invalid record kind %r" % kind)
+		data = infile.read(length)
+		if len(data) != length:
+			return
+		yield kind, timestamp, data
+
+def rechunk(records, size):
+	"""Split the data of the records into chunks of at most size bytes
+	to replay other segmentations than the recorded one. Consecutive
+	chunks of the same kind are joined first.
+
+	>>> list(rechunk([("s", 1.0, "ab"), ("s", 2.0, "cde"), ("c", 3.0, "")],
+	...     2))
+	[('s', 1.0, 'ab'), ('s', 1.0, 'cd'), ('s', 1.0, 'e'), ('c', 3.0, '')]
+
+	@type records: iterable of (str, float, str)
+	@type size: int
+	@rtype: iterable of (str, float, str)
+	"""
+	kind, timestamp, parts = None, None, []
+	for record in records:
+		if record[0] != kind or record[0] == kind_connect:
+			data = "".join(parts)
+			for offset in xrange(0, len(data), size):
+				yield kind, timestamp, data[offset:offset + size]
+			if record[0] == kind_connect:
+				yield record
+				kind, timestamp, parts = None, None, []
+				continue
+			kind, timestamp, parts = record[0], record[1], []
+		parts.append(record[2])
+	data = "".join(parts)
+	for offset in xrange(0, len(data), size):
+		yield kind, timestamp, data[offset:offset + size]
+
+__all__.append("replay")
+def replay(records, authenticator=None, directions=(kind_received,),
+		callback=None):
+	"""Parse and verify the messages of a capture like Omapi does.
+	Every nonzero authid is assumed to belong to the given authenticator.
+	A stream that cannot be parsed is counted as an error and skipped up
+	to the next connection.
+	@type records: iterable of (str, float, str)
+	@type authenticator: OmapiAuthenticatorBase or None
+	@param authenticator: without one, only unsigned messages verify
+	@type directions: (str)
+	@param directions: the kinds of streams to replay, kind_sent and/or
+			kind_received
+	@type callback: (str, float, OmapiMessage, bool) -> None or None
+	@param callback: called with kind, time, message and whether it
+			verified for every message
+	@rtype: {str: int or float}
+	@returns: statistics with the keys sessions, chunks, bytes, messages,
+			bad_signatures, errors, parse_seconds and verify_seconds
+	"""
+	stats = dict(sessions=0, chunks=0, bytes=0, messages=0,
+			bad_signatures=0, errors=0, parse_seconds=0.0,
+			verify_seconds=0.0)
+	buffers = {} # kind -> InBuffer or None after an error
+	started = set() # kinds whose startup message was parsed
+	authenticators = {0: OmapiNullAuthenticator()}
+	for kind, timestamp, data in records:
+		if kind == kind_connect or not stats["sessions"]:
+			stats["sessions"] += 1
+			buffers = dict((direction, InBuffer())
+					for direction in directions)
+			started.clear()
+			if kind == kind_connect:
+				continue
+		inbuffer = buffers.get(kind)
+		if inbuffer is None:
+			continue
+		stats["chunks"] += 1
+		stats["bytes"] += len(data)
+		start = time.time()
+		try:
+			inbuffer.feed(data)
+			if kind not in started:
+				if inbuffer.parse_startup_message() is None:
+					continue
+				inbuffer.resetsize()
+				started.add(kind)
+			message = inbuffer.parse_message()
+			while message is not None:
+				inbuffer.resetsize()
+				stats["parse_seconds"] += time.time() - start
+				if message.authid not in authenticators and \
+						authenticator is not None:
+					authenticators[message.authid] = authenticator
+				start = time.time()
+				verified = message.verify(authenticators)
+				stats["verify_seconds"] += time.time() - start
+				stats["messages"] += 1
+				if not verified:
+					stats["bad_signatures"] += 1
+				if callback is not None:
+					callback(kind, timestamp, message, verified)
+				start = time.time()
+				message = inbuffer.parse_message()
+		except OmapiError:
+			stats["errors"] += 1
+			buffers[kind] = None
+		finally:
+			stats["parse_seconds"] += time.time() - start
+	return stats
+
+def print_message(kind, timestamp, message, verified):
+	print "%.6f %s %-8s authid=%d handle=%d tid=%d rid=%d %s" % (
+			timestamp, "->" if kind == kind_sent else "<-",
+			repr_opcode(message.opcode), message.authid, message.handle,
+			message.tid, message.rid, "" if verified else "BAD SIGNATURE")
+
+def main(argv):
+	parser = optparse.OptionParser(usage="%prog [options] CAPTURE",
+			description="Parse and verify the OMAPI messages of a capture "
+			"written by OmapiRecorder and report the time it took.")
+	parser.add_option("--user", help="OMAPI key name")
+	parser.add_option("--key", help="base64 encoded OMAPI key")
+	parser.add_option("--key-file", metavar="FILE",
+			help="read the base64 encoded OMAPI key from FILE")
+	parser.add_option("--algorithm", default="hmac-md5.SIG-ALG.REG.INT.",
+			help="signature algorithm of the key [default: %default]")
+	parser.add_option("--direction", default="received",
+			choices=("received", "sent", "both"),
+			help="streams to replay [default: %default]")
+	parser.add_option("--chunk-size", type="int",
+			help="replay in chunks of this size instead of the recorded "
+			"ones")
+	parser.add_option("--repeat", type="int", default=1,
+			help="number of replays [default: %default]")
+	parser.add_option("--dump", action="store_true", default=False,
+			help="print every message")
+	options, args = parser.parse_args(argv)
+	if len(args) != 1:
+		parser.error("exactly one capture file expected")
+	if options.repeat < 1 or \
+			(options.chunk_size is not None and options.chunk_size < 1):
+		parser.error("repeat and chunk size must be positive")
+	if options.key_file:
+		with open(options.key_file) as keyfile:
+			options.key = keyfile.read().strip()
+	authenticator = None
+	if options.key is not None:
+		try:
+			authenticator = OmapiHMACAuthenticator(options.user or "",
+					options.key, options.algorithm)
+		except ValueError, exc:
+			parser.error(str(exc))
+	directions = dict(received=(kind_received,), sent=(kind_sent,),
+			both=(kind_sent, kind_received))[options.direction]
+	try:
+		with open(args[0], "rb") as capture:
+			records = list(read_capture(capture))
+	except (IOError, ValueError), exc:
+		sys.stderr.write("cannot read %s: %s\n" % (args[0], exc))
+		return 2
+	if options.chunk_size:
+		records = list(rechunk(records, options.chunk_size))
+	callback = print_message if options.dump else None
+	for _ in range(options.repeat):
+		stats = replay(records, authenticator, directions, callback)
+		callback = None
+		seconds = stats["parse_seconds"] + stats["verify_seconds"]
+		print ("%(sessions)d sessions, %(chunks)d chunks, %(bytes)d bytes, "
+				"%(messages)d messages, %(bad_signatures)d bad signatures, "
+				"%(errors)d errors" % stats)
+		print "parse %.6fs, verify %.6fs, %.0f messages/s" % (
+				stats["parse_seconds"], stats["verify_seconds"],
+				stats["messages"] / seconds if seconds > 0 else 0)
+	return 1 if stats["bad_signatures"] or stats["errors"] else 0
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
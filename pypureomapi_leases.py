@@ -0,0 +1,329 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Offline mac <-> ip lookups from an ISC dhcpd.leases file.
+
+The leases file is streamed statement by statement, so parsing needs
+constant memory regardless of the file size. The resulting mapping is
+written to a compact index file and queried through mmap and binary
+search, without loading it into memory.
+
+Index file format:
+
+magic (8 bytes, "OMAPIIDX")
+version (netint32)
+ipcount (netint32)
+maccount (netint32)
+ipcount records sorted by ip: ip (4 bytes) mac (6 bytes)
+maccount records sorted by mac: mac (6 bytes) ip (4 bytes)
+
+Host declarations (as written by dhcpd for hosts created via OMAPI)
+take precedence over leases, since Omapi.lookup_ip and Omapi.lookup_mac
+query host objects as well. Within each kind the latest statement in the
+file wins.
+"""
+
+__author__      = "Helmut Grohne, Torge Szczepanek"
+__copyright__   = "Cygnus Networks GmbH"
+__licence__     = "GPL-3"
+__version__     = "0.1"
+__maintainer__  = "Torge Szczepanek"
+__email__       = "info@cygnusnetworks.de"
+
+__all__ = []
+
+import os
+import re
+import mmap
+import struct
+
+from pypureomapi import OmapiErrorNotFound, pack_ip, pack_mac, unpack_ip, \
+		unpack_mac
+
+index_magic = "OMAPIIDX"
+index_version = 1
+index_header = struct.Struct("!8sLLL") # magic, version, ipcount, maccount
+
+token_re = re.compile(r'"(?:[^"\\]|\\.)*"|[{};,]|[^\s{};,"#]+|#.*')
+
+def tokenize(lines):
+	"""Split the lines of a dhcpd configuration or leases file into
+	tokens, dropping whitespace and comments.
+
+	>>> list(tokenize(['lease 10.0.0.1 { # comment', 'uid "a;b";']))
+	['lease', '10.0.0.1', '{', 'uid', '"a;b"', ';']
+
+	@type lines: iterable of str
+	@rtype: iterable of str
+	"""
+	for line in lines:
+		for token in token_re.findall(line):
+			if not token.startswith("#"):
+				yield token
+
+def read_block(tokens):
+	"""Read the statements of a block after its opening brace up to and
+	including its closing brace.
+	@type tokens: iterator of str
+	@rtype: [([str], list or None)]
+	@returns: (words, nested statements or None) for each statement
+	@raises ValueError: if the input ends within the block
+	"""
+	statements = []
+	words = []
+	for token in tokens:
+		if token == ";":
+			statements.append((words, None))
+			words = []
+		elif token == "{":
+			statements.append((words, read_block(tokens)))
+			words = []
+		elif token == "}":
+			if words:
+				statements.append((words, None))
+			return statements
+		else:
+			words.append(token)
+	raise ValueError("unexpected end of input within a block")
+
+def read_statements(tokens):
+	"""Read top level statements one at a time.
+
+	>>> list(read_statements(iter(['a', ';', 'b', '{', 'c', ';', '}'])))
+	[(['a'], None), (['b'], [(['c'], None)])]
+
+	@type tokens: iterator of str
+	@rtype: iterable of ([str], list or None)
+	@raises ValueError: for unbalanced braces
+	"""
+	words = []
+	for token in tokens:
+		if token == ";":
+			yield words, None
+			words = []
+		elif token == "{":
+			yield words, read_block(tokens)
+			words = []
+		elif token == "}":
+			raise ValueError("unbalanced closing brace")
+		else:
+			words.append(token)
+
+def parse_hardware(words):
+	"""
+	@type words: [str]
+	@rtype: str or None
+	@returns: the packed hardware address of a hardware statement
+	"""
+	if len(words) >= 3 and words[0] == "hardware":
+		try:
+			return pack_mac(words[2])
+		except ValueError:
+			pass
+	return None
+
+def parse_leases(lines, lease_states=("active",)):
+	"""Stream the host declarations and leases of a dhcpd.leases file.
+
+	>>> list(parse_leases(['host h { hardware ethernet 0:1:2:3:4:5;',
+	...     'fixed-address 10.0.0.1; }']))
+	[('host', 'h', '\\n\\x00\\x00\\x01', '\\x00\\x01\\x02\\x03\\x04\\x05')]
+
+	@type lines: iterable of str
+	@type lease_states: [str]
+	@param lease_states: binding states of leases to report as bound
+	@rtype: iterable of (str, str, str or None, str or None)
+	@returns: (kind, name, packed ip, packed mac) tuples in file order
+			where kind is "host" or "lease" and name is the host name
+			or the lease ip. Deleted hosts and leases not in one of
+			lease_states are reported with ip and mac set to None.
+	@raises ValueError: for malformed input
+	"""
+	for words, block in read_statements(tokenize(lines)):
+		if block is None or len(words) != 2:
+			continue
+		if words[0] == "lease":
+			try:
+				packed_ip = pack_ip(words[1])
+			except ValueError:
+				continue
+			mac, state = None, None
+			for statement, _ in block:
+				if statement[:1] == ["hardware"]:
+					mac = parse_hardware(statement)
+				elif statement[:2] == ["binding", "state"] and \
+						len(statement) > 2:
+					state = statement[2]
+			if mac is None or state not in lease_states:
+				yield "lease", words[1], None, None
+			else:
+				yield "lease", words[1], packed_ip, mac
+		elif words[0] == "host":
+			mac, packed_ip, deleted = None, None, False
+			for statement, _ in block:
+				if statement[:1] == ["hardware"]:
+					mac = parse_hardware(statement)
+				elif statement[:1] == ["fixed-address"]:
+					for address in statement[1:]:
+						try:
+							packed_ip = pack_ip(address)
+							break
+						except ValueError: # comma or host name
+							continue
+				elif statement == ["deleted"]:
+					deleted = True
+			if deleted or mac is None or packed_ip is None:
+				yield "host", words[1], None, None
+			else:
+				yield "host", words[1], packed_ip, mac
+
+def collect_mappings(records):
+	"""Reduce the records of parse_leases to the final mappings.
+	@type records: iterable of (str, str, str or None, str or None)
+	@rtype: ({str: str}, {str: str})
+	@returns: packed ip to packed mac and packed mac to packed ip
+	"""
+	current = {} # (kind, name) -> (sequence, packed ip, packed mac)
+	for sequence, (kind, name, packed_ip, mac) in enumerate(records):
+		if packed_ip is None:
+			current.pop((kind, name), None)
+		else:
+			current[(kind, name)] = (sequence, packed_ip, mac)
+	entries = sorted((kind == "host", sequence, packed_ip, mac)
+			for (kind, _), (sequence, packed_ip, mac) in current.iteritems())
+	del current
+	byip, bymac = {}, {}
+	for _, _, packed_ip, mac in entries: # later entries win
+		byip[packed_ip] = mac
+		bymac[mac] = packed_ip
+	return byip, bymac
+
+def write_index(path, byip, bymac):
+	"""Atomically write an index file.
+	@type path: str
+	@type byip: {str: str}
+	@type bymac: {str: str}
+	"""
+	tmppath = path + ".tmp"
+	with open(tmppath, "wb") as output:
+		output.write(index_header.pack(index_magic, index_version,
+				len(byip), len(bymac)))
+		for packed_ip in sorted(byip):
+			output.write(packed_ip + byip[packed_ip])
+		for mac in sorted(bymac):
+			output.write(mac + bymac[mac])
+	os.rename(tmppath, path)
+
+__all__.append("build_index")
+def build_index(leasespath, indexpath, lease_states=("active",)):
+	"""Parse a dhcpd.leases file and write an index file for it.
+	@type leasespath: str
+	@type indexpath: str
+	@type lease_states: [str]
+	@param lease_states: binding states of leases to include
+	@rtype: int
+	@returns: the number of ip addresses indexed
+	@raises ValueError: for malformed input
+	@raises IOError:
+	"""
+	with open(leasespath) as leases:
+		byip, bymac = collect_mappings(parse_leases(leases, lease_states))
+	write_index(indexpath, byip, bymac)
+	return len(byip)
+
+__all__.append("LeaseIndex")
+class LeaseIndex:
+	"""Memory-mapped index file as written by build_index. The lookup
+	methods mirror Omapi.lookup_ip and Omapi.lookup_mac."""
+	def __init__(self, path):
+		"""
+		@type path: str
+		@raises ValueError: if the file is not a valid index
+		@raises IOError:
+		"""
+		with open(path, "rb") as indexfile:
+			self.map = mmap.mmap(indexfile.fileno(), 0,
+					access=mmap.ACCESS_READ)
+		try:
+			if len(self.map) < index_header.size:
+				raise ValueError("index file too short")
+			magic, version, self.ipcount, self.maccount = \
+					index_header.unpack_from(self.map, 0)
+			if magic != index_magic or version != index_version:
+				raise ValueError("not an index file of a supported version")
+			if len(self.map) != index_header.size + \
+					10 * (self.ipcount + self.maccount):
+				raise ValueError("index file has an invalid size")
+		except:
+			self.map.close()
+			raise
+		self.ipoffset = index_header.size
+		self.macoffset = self.ipoffset + 10 * self.ipcount
+
+	def close(self):
+		self.map.close()
+
+	def __len__(self):
+		return self.ipcount
+
+	def search(self, offset, count, keylen, key):
+		"""Binary search fixed size records for a key.
+		@type offset: int
+		@param offset: start of the sorted records
+		@type count: int
+		@type keylen: int
+		@type key: str
+		@rtype: int or None
+		@returns: the offset of the record following the key or None
+		"""
+		low, high = 0, count
+		while low < high:
+			middle = (low + high) // 2
+			position = offset + 10 * middle
+			candidate = self.map[position:position + keylen]
+			if candidate < key:
+				low = middle + 1
+			elif candidate > key:
+				high = middle
+			else:
+				return position + keylen
+		return None
+
+	def lookup_ip(self, mac):
+		"""
+		@type mac: str
+		@rtype: str
+		@raises ValueError:
+		@raises OmapiErrorNotFound:
+		"""
+		position = self.search(self.macoffset, self.maccount, 6,
+				pack_mac(mac))
+		if position is None:
+			raise OmapiErrorNotFound()
+		return unpack_ip(self.map[position:position + 4])
+
+	def lookup_mac(self, ip):
+		"""
+		@type ip: str
+		@rtype: str
+		@raises ValueError:
+		@raises OmapiErrorNotFound:
+		"""
+		position = self.search(self.ipoffset, self.ipcount, 4, pack_ip(ip))
+		if position is None:
+			raise OmapiErrorNotFound()
+		return unpack_mac(self.map[position:position + 6])
+
+	def iteritems(self):
+		"""
+		@rtype: iterable of (str, str)
+		@returns: (ip, mac) pairs ordered by ip
+		"""
+		for position in xrange(self.ipoffset, self.macoffset, 10):
+			yield (unpack_ip(self.map[position:position + 4]),
+					unpack_mac(self.map[position + 4:position + 10]))
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
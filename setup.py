@@ -12,7 +12,9 @@ distutils.core.setup(name='pypureomapi',
 	maintainer_email='info@cygnusnetworks.de',
 	license='GPL',
 	url='http://code.google.com/p/pypureomapi/',
-	py_modules=['pypureomapi'],
+	py_modules=['pypureomapi', 'pypureomapi_leases', 'pypureomapi_bulk',
+		'pypureomapi_capture'],
+	scripts=['pypureomapi-bulk', 'pypureomapi-replay'],
 	classifiers=[
 		"Development Status :: 3 - Alpha",
 		"Intended Audience :: System Administrators",
@@ -0,0 +1,543 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Tests of the pypureomapi clients against a fake OMAPI server on
+localhost. The codec itself is covered by the doctests of pypureomapi.
+
+Usage:
+	python test_pypureomapi.py [-v]
+"""
+
+import os
+import time
+import struct
+import socket
+import threading
+import unittest
+
+import pypureomapi
+from pypureomapi import InBuffer, Omapi, OmapiPool, OmapiMultiplexed, \
+		OmapiFailover, AsyncOmapi, OmapiError, \
+		OmapiErrorNotFound, OmapiTimeoutError, OmapiMessage, \
+		OMAPI_OP_OPEN, OMAPI_OP_REFRESH, OMAPI_OP_UPDATE, OMAPI_OP_STATUS, \
+		OMAPI_OP_DELETE, ISC_R_SUCCESS, ISC_R_NOTFOUND, pack_mac, pack_ip
+
+def status(result=ISC_R_SUCCESS):
+	"""
+	@type result: int
+	@rtype: OmapiMessage
+	@returns: a status response with the given result
+	"""
+	response = OmapiMessage()
+	response.opcode = OMAPI_OP_STATUS
+	response.message.append(("result", struct.pack("!L", result)))
+	return response
+
+def update(handle, obj=()):
+	"""
+	@type handle: int
+	@type obj: [(str, str)]
+	@rtype: OmapiMessage
+	@returns: an update response describing an object
+	"""
+	response = OmapiMessage()
+	response.opcode = OMAPI_OP_UPDATE
+	response.handle = handle
+	response.obj = list(obj)
+	return response
+
+class HostStore:
+	"""Handler of FakeServer keeping host objects like dhcpd does."""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.objects = {} # handle -> {attribute: value}
+		self.nexthandle = 100
+
+	def find(self, criteria):
+		for handle, attributes in self.objects.items():
+			if all(attributes.get(key) == value for key, value in criteria):
+				return handle
+		return None
+
+	def __call__(self, message):
+		with self.lock:
+			if message.opcode == OMAPI_OP_OPEN:
+				handle = self.find(message.obj)
+				if handle is None and ("create", "\0\0\0\1") in \
+						message.message:
+					self.nexthandle += 1
+					handle = self.nexthandle
+					self.objects[handle] = dict(message.obj)
+				if handle is None:
+					return [status(ISC_R_NOTFOUND)]
+				return [update(handle, sorted(self.objects[handle].items()))]
+			if message.handle not in self.objects:
+				return [status(ISC_R_NOTFOUND)]
+			if message.opcode == OMAPI_OP_UPDATE:
+				self.objects[message.handle].update(message.obj)
+				return [status()]
+			if message.opcode == OMAPI_OP_REFRESH:
+				return [update(message.handle,
+						sorted(self.objects[message.handle].items()))]
+			if message.opcode == OMAPI_OP_DELETE:
+				del self.objects[message.handle]
+				return [status()]
+			return [status(1)]
+
+class FakeServer:
+	"""OMAPI server on localhost for unsigned messages. Every received
+	message is passed to handler, which returns the responses to send
+	or None to stay silent. The responses are sent as one write. Responses
+	without a rid answer the message passed.
+	"""
+	def __init__(self, handler):
+		"""
+		@type handler: OmapiMessage -> [OmapiMessage] or None
+		"""
+		self.handler = handler
+		self.received = []
+		self.connections = []
+		self.listener = socket.socket()
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(("127.0.0.1", 0))
+		self.listener.listen(8)
+		self.port = self.listener.getsockname()[1]
+		thread = threading.Thread(target=self.accept)
+		thread.daemon = True
+		thread.start()
+
+	def accept(self):
+		while True:
+			try:
+				connection = self.listener.accept()[0]
+			except socket.error:
+				return
+			self.connections.append(connection)
+			thread = threading.Thread(target=self.serve, args=(connection,))
+			thread.daemon = True
+			thread.start()
+
+	def serve(self, connection):
+		inbuffer = InBuffer()
+		started = False
+		try:
+			connection.sendall(struct.pack("!LL", 100, 24))
+			while True:
+				data = connection.recv(65536)
+				if not data:
+					return
+				inbuffer.feed(data)
+				if not started:
+					if inbuffer.parse_startup_message() is None:
+						continue
+					inbuffer.resetsize()
+					started = True
+				message = inbuffer.parse_message()
+				while message is not None:
+					inbuffer.resetsize()
+					self.received.append(message)
+					responses = self.handler(message) or []
+					for response in responses:
+						if not response.rid:
+							response.rid = message.tid
+					if responses:
+						connection.sendall("".join(response.as_string()
+								for response in responses))
+					message = inbuffer.parse_message()
+		except (socket.error, OmapiError):
+			pass
+		finally:
+			connection.close()
+
+	def close(self):
+		self.listener.close()
+		for connection in self.connections:
+			try:
+				connection.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+
+class ServerTestCase(unittest.TestCase):
+	"""Starts a FakeServer with the handler returned by make_handler."""
+	def make_handler(self):
+		return HostStore()
+
+	def setUp(self):
+		self.handler = self.make_handler()
+		self.server = FakeServer(self.handler)
+		self.clients = []
+
+	def tearDown(self):
+		for client in self.clients:
+			client.close()
+		self.server.close()
+
+	def connect(self, cls=Omapi, **kwargs):
+		client = cls("127.0.0.1", self.server.port, **kwargs)
+		self.clients.append(client)
+		return client
+
+class HandleCacheTest(ServerTestCase):
+	def test_stale_cached_handle_is_reopened_once(self):
+		omapi = self.connect()
+		omapi.add_host("10.0.0.1", "00:00:00:00:00:01")
+		key = ("host", pack_mac("00:00:00:00:00:01"))
+		self.handler.objects[999] = self.handler.objects.pop(
+				omapi.handles[key])
+		omapi.update_host("00:00:00:00:00:01", "10.0.0.2")
+		self.assertEqual(omapi.handles[key], 999)
+		self.assertEqual(self.handler.objects[999]["ip-address"],
+				pack_ip("10.0.0.2"))
+
+	def test_not_found_on_opened_handle_is_final(self):
+		store = self.handler
+		def handler(message):
+			if message.opcode == OMAPI_OP_UPDATE:
+				return [status(ISC_R_NOTFOUND)] # e.g. deleted meanwhile
+			return store(message)
+		self.server.handler = handler
+		omapi = self.connect()
+		omapi.add_host("10.0.0.1", "00:00:00:00:00:01")
+		omapi.close()
+		omapi.connect()
+		del self.server.received[:]
+		self.assertRaises(OmapiError, omapi.update_host,
+				"00:00:00:00:00:01", "10.0.0.2")
+		self.assertEqual([message.opcode for message in self.server.received],
+				[OMAPI_OP_OPEN, OMAPI_OP_UPDATE])
+
+class TimeoutTest(ServerTestCase):
+	def make_handler(self):
+		self.delay = None # None never replies
+		store = HostStore()
+		def handler(message):
+			if self.delay is None:
+				return None
+			time.sleep(self.delay)
+			return store(message)
+		return handler
+
+	def assertTimesOut(self, seconds, function, *args):
+		start = time.time()
+		self.assertRaises(OmapiTimeoutError, function, *args)
+		self.assertTrue(time.time() - start < seconds + 0.2)
+
+	def test_lookup_with_auto_reconnect_is_bounded_by_timeout(self):
+		omapi = self.connect(timeout=0.2, auto_reconnect=True,
+				retry_deadline=10.0)
+		self.assertTimesOut(0.2, omapi.lookup_ip, "00:00:00:00:00:01")
+
+	def test_timeout_bounds_all_round_trips(self):
+		omapi = self.connect(timeout=0.3)
+		self.delay = 0.2 # an open and an add take 0.4s
+		self.assertTimesOut(0.3, omapi.update_host, "00:00:00:00:00:01",
+				"10.0.0.1")
+
+class PoolTest(ServerTestCase):
+	def make_pool(self, **kwargs):
+		pool = OmapiPool("127.0.0.1", self.server.port, **kwargs)
+		self.clients.append(pool)
+		return pool
+
+	def test_checkout_and_return(self):
+		pool = self.make_pool(minsize=1, maxsize=2)
+		first = pool.get()
+		pool.put(first)
+		self.assertTrue(pool.get() is first)
+		second = pool.get()
+		self.assertTrue(second is not first)
+		self.assertRaises(OmapiError, pool.get, 0.05)
+		second.close() # failed connections are discarded on return
+		pool.put(second)
+		pool.put(first)
+		self.assertEqual(pool.size, 1)
+		with pool.connection() as omapi:
+			omapi.add_host("10.0.0.1", "00:00:00:00:00:01")
+			self.assertTrue(omapi is first)
+		self.assertEqual([omapi for omapi, _ in pool.idle], [first])
+
+	def test_idle_eviction(self):
+		pool = self.make_pool(minsize=1, maxsize=3, maxidle=60.0)
+		connections = [pool.get() for _ in range(3)]
+		for omapi in connections:
+			pool.put(omapi)
+		self.assertEqual(pool.size, 3)
+		pool.idle[0] = (pool.idle[0][0], time.time() - 61)
+		pool.idle[1] = (pool.idle[1][0], time.time() - 61)
+		pool.evict_idle()
+		self.assertEqual([omapi for omapi, _ in pool.idle], connections[2:])
+		self.assertEqual(pool.size, 1)
+		self.assertFalse(connections[0].connection)
+
+	def test_close_with_connections_checked_out(self):
+		pool = self.make_pool(minsize=2, maxsize=2)
+		omapi = pool.get()
+		idle = pool.idle[0][0]
+		pool.close()
+		self.assertFalse(idle.connection)
+		omapi.add_host("10.0.0.1", "00:00:00:00:00:01") # still usable
+		pool.put(omapi)
+		self.assertFalse(omapi.connection)
+		self.assertEqual((pool.size, pool.idle), (0, []))
+		self.assertRaises(OmapiError, pool.get)
+
+	def test_fork_drops_inherited_connections(self):
+		pool = self.make_pool(minsize=1, maxsize=2)
+		checkedout = pool.get()
+		inherited = pool.get()
+		pool.put(inherited)
+		pid = os.fork()
+		if pid == 0:
+			status = 1
+			try:
+				pool.put(checkedout) # from the parent, closed
+				omapi = pool.get()
+				omapi.add_host("10.0.0.2", "00:00:00:00:00:02")
+				if omapi is not inherited and omapi is not checkedout and \
+						not checkedout.connection and pool.size == 1:
+					status = 0
+			finally:
+				os._exit(status)
+		self.assertEqual(os.waitpid(pid, 0)[1], 0)
+		self.assertEqual(len(self.server.connections), 3)
+		# the connections of the parent survived the child closing them
+		checkedout.add_host("10.0.0.1", "00:00:00:00:00:01")
+		pool.put(checkedout)
+		with pool.connection() as omapi:
+			self.assertEqual(omapi.lookup_ip("00:00:00:00:00:02"), "10.0.0.2")
+
+class MultiplexedTest(ServerTestCase):
+	def make_handler(self):
+		self.held = [] # requests not answered yet
+		self.hold = 0 # number of requests to collect before answering
+		def handler(message):
+			"""Answer refreshes in reverse order once enough arrived."""
+			self.held.append(message)
+			if len(self.held) < self.hold:
+				return None
+			responses = []
+			for request in reversed(self.held):
+				response = update(request.handle)
+				response.rid = request.tid
+				responses.append(response)
+			del self.held[:]
+			return responses
+		return handler
+
+	def test_reader_routes_responses_by_rid(self):
+		omapi = self.connect(OmapiMultiplexed, timeout=5.0)
+		self.assertTrue(omapi.reader.is_alive())
+		self.hold = 4
+		results = {}
+		def refresh(handle):
+			results[handle] = omapi.query_server(
+					OmapiMessage.refresh(handle)).handle
+		threads = [threading.Thread(target=refresh, args=(handle,))
+				for handle in range(1, 5)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(results, dict((handle, handle)
+				for handle in range(1, 5)))
+		self.assertEqual(omapi.pending, {})
+
+	def test_late_reply_is_dropped(self):
+		omapi = self.connect(OmapiMultiplexed, timeout=0.1)
+		self.hold = 2
+		self.assertRaises(OmapiTimeoutError, omapi.query_server,
+				OmapiMessage.refresh(1))
+		self.assertEqual(omapi.pending, {})
+		# the reply to the first request arrives late, after the second
+		response = omapi.query_server(OmapiMessage.refresh(2))
+		self.assertEqual(response.handle, 2)
+		self.assertTrue(omapi.connection and omapi.reader.is_alive())
+		self.hold = 0
+		self.assertEqual(omapi.query_server(OmapiMessage.refresh(3)).handle, 3)
+
+	def test_close_fails_pending_futures(self):
+		omapi = self.connect(OmapiMultiplexed)
+		self.hold = 2
+		future = omapi.query_server_async(OmapiMessage.refresh(1))
+		reader = omapi.reader
+		omapi.close()
+		self.assertTrue(isinstance(future.exception(1.0), OmapiError))
+		self.assertFalse(reader.is_alive())
+		self.assertEqual((omapi.reader, omapi.pending), (None, {}))
+
+class FailoverTest(ServerTestCase):
+	def make_handler(self):
+		self.delay = 0 # of the primary
+		store = HostStore()
+		def handler(message):
+			time.sleep(self.delay)
+			return store(message)
+		return handler
+
+	def setUp(self):
+		ServerTestCase.setUp(self)
+		self.secondary = FakeServer(HostStore())
+
+	def tearDown(self):
+		ServerTestCase.tearDown(self)
+		self.secondary.close()
+
+	def make_failover(self, **kwargs):
+		failover = OmapiFailover([("127.0.0.1", self.server.port),
+				("127.0.0.1", self.secondary.port)], timeout=5.0, **kwargs)
+		self.clients.append(failover)
+		failover.nextpeer = 1 # the next read starts with the primary
+		return failover
+
+	def add_host(self, server, ip, mac):
+		omapi = Omapi("127.0.0.1", server.port)
+		omapi.add_host(ip, mac)
+		omapi.close()
+		del server.received[:]
+
+	def test_hedged_read(self):
+		self.add_host(self.server, "10.0.0.1", "00:00:00:00:00:01")
+		self.add_host(self.secondary, "10.0.0.1", "00:00:00:00:00:01")
+		failover = self.make_failover(hedge_max_delay=0.05)
+		self.delay = 1.0
+		start = time.time()
+		self.assertEqual(failover.lookup_ip("00:00:00:00:00:01"), "10.0.0.1")
+		self.assertTrue(time.time() - start < 0.5)
+		self.assertEqual([message.opcode
+				for message in self.secondary.received], [OMAPI_OP_OPEN])
+
+	def test_not_found_on_primary_is_final(self):
+		self.add_host(self.secondary, "10.0.0.1", "00:00:00:00:00:01")
+		failover = self.make_failover()
+		self.assertRaises(OmapiErrorNotFound, failover.lookup_ip,
+				"00:00:00:00:00:01")
+		self.assertEqual(self.secondary.received, [])
+
+	def test_not_found_on_secondary_is_confirmed_on_primary(self):
+		self.add_host(self.server, "10.0.0.1", "00:00:00:00:00:01")
+		failover = self.make_failover()
+		failover.nextpeer = 0 # the next read starts with the secondary
+		self.assertEqual(failover.lookup_ip("00:00:00:00:00:01"), "10.0.0.1")
+		self.assertEqual(len(self.secondary.received), 1)
+
+class ReceiveTest(ServerTestCase):
+	def make_handler(self):
+		self.requests = []
+		def handler(message):
+			"""Answer 64 refreshes at once with 3 KiB objects each."""
+			self.requests.append(message)
+			if len(self.requests) < 64:
+				return None
+			responses = []
+			for request in self.requests:
+				response = update(request.handle, [("name", "x" * 3072)])
+				response.rid = request.tid
+				responses.append(response)
+			return responses
+		return handler
+
+	def test_pipelined_replies_beyond_size_limit(self):
+		omapi = self.connect(pipeline_depth=64)
+		responses = omapi.query_server_pipelined(
+				[OmapiMessage.refresh(handle) for handle in range(1, 65)])
+		self.assertEqual([response.handle for response in responses],
+				range(1, 65))
+		self.assertTrue(omapi.connection)
+
+@unittest.skipIf(pypureomapi.asyncio is None, "trollius is not installed")
+class AsyncOmapiTest(ReceiveTest):
+	def setUp(self):
+		ReceiveTest.setUp(self)
+		self.loop = pypureomapi.asyncio.new_event_loop()
+
+	def tearDown(self):
+		ReceiveTest.tearDown(self)
+		self.loop.close()
+
+	def make_handler(self):
+		self.store = HostStore()
+		self.silent = False
+		burst = ReceiveTest.make_handler(self)
+		def handler(message):
+			if self.silent:
+				return None
+			if message.opcode == OMAPI_OP_REFRESH and message.handle < 100:
+				return burst(message)
+			return self.store(message)
+		return handler
+
+	def run_async(self, coroutine):
+		return self.loop.run_until_complete(coroutine)
+
+	def connect(self, **kwargs):
+		client = self.run_async(AsyncOmapi.connect("127.0.0.1",
+				self.server.port, loop=self.loop, **kwargs))
+		self.clients.append(client)
+		return client
+
+	def test_host_round_trip(self):
+		omapi = self.connect()
+		self.run_async(omapi.add_host("10.0.0.1", "00:00:00:00:00:01"))
+		self.assertEqual(self.run_async(omapi.lookup_ip("00:00:00:00:00:01")),
+				"10.0.0.1")
+		self.run_async(omapi.update_host("00:00:00:00:00:01", "10.0.0.2"))
+		self.assertEqual(self.run_async(omapi.lookup_mac("10.0.0.2")),
+				"00:00:00:00:00:01")
+		self.run_async(omapi.del_host("00:00:00:00:00:01"))
+		self.assertRaises(OmapiErrorNotFound, self.run_async,
+				omapi.lookup_ip("00:00:00:00:00:01"))
+
+	def test_stale_cached_handle_is_reopened_once(self):
+		omapi = self.connect()
+		self.run_async(omapi.add_host("10.0.0.1", "00:00:00:00:00:01"))
+		key = ("host", pack_mac("00:00:00:00:00:01"))
+		self.store.objects[999] = self.store.objects.pop(omapi.handles[key])
+		self.run_async(omapi.update_host("00:00:00:00:00:01", "10.0.0.2"))
+		self.assertEqual(omapi.handles[key], 999)
+		self.assertEqual(self.store.objects[999]["ip-address"],
+				pack_ip("10.0.0.2"))
+
+	def test_pipelined_replies_beyond_size_limit(self):
+		omapi = self.connect()
+		responses = self.run_async(pypureomapi.asyncio.gather(
+				*[omapi.query_server(OmapiMessage.refresh(handle))
+				for handle in range(1, 65)], loop=self.loop))
+		self.assertEqual([response.handle for response in responses],
+				range(1, 65))
+		self.assertTrue(omapi.writer)
+
+	def test_cancelled_query_reply_is_dropped(self):
+		asyncio = pypureomapi.asyncio
+		omapi = self.connect()
+		self.run_async(omapi.add_host("10.0.0.1", "00:00:00:00:00:01"))
+		self.silent = True
+		self.assertRaises(asyncio.TimeoutError, self.run_async,
+				asyncio.wait_for(omapi.lookup_ip("00:00:00:00:00:01"), 0.1,
+				loop=self.loop))
+		self.run_async(asyncio.sleep(0.01, loop=self.loop))
+		self.assertEqual(omapi.pending, {})
+		self.assertEqual(len(omapi.late_replies), 1)
+		late = self.server.received[-1]
+		self.silent = False
+		self.server.connections[-1].sendall(self.reply_to(late))
+		self.assertEqual(self.run_async(omapi.lookup_ip("00:00:00:00:00:01")),
+				"10.0.0.1")
+		self.assertEqual(omapi.late_replies, set())
+
+	def reply_to(self, message):
+		response = status(ISC_R_NOTFOUND)
+		response.rid = message.tid
+		return response.as_string()
+
+	def test_close_fails_pending_queries(self):
+		omapi = self.connect()
+		self.silent = True
+		future = pypureomapi.asyncio.ensure_future(
+				omapi.lookup_ip("00:00:00:00:00:01"), loop=self.loop)
+		self.run_async(pypureomapi.asyncio.sleep(0.05, loop=self.loop))
+		omapi.close()
+		self.assertRaises(OmapiError, self.run_async, future)
+
+if __name__ == '__main__':
+	unittest.main()